@@ -4,6 +4,23 @@ import os
 import random
 import math
 import json # ★★★ JSONモジュールを追加 ★★★
+import struct
+import zlib
+import argparse
+import shutil
+import time
+import collections
+import csv
+import hashlib
+import mmap
+import threading
+import concurrent.futures
+import tempfile
+
+try:
+    import numpy  # ★ 任意: あれば矢の当たり判定の候補探しを配列でまとめて行う
+except ImportError:
+    numpy = None
 
 # スクリプトのディレクトリをワーキングディレクトリに設定
 if getattr(sys, "frozen", False):
@@ -24,9 +41,30 @@ SCREEN_HEIGHT = 600
 GAME_WIDTH = 640
 GAME_HEIGHT = 480
 
-FPS = 60
+FPS = 60  # 描画のフレームレート上限 (0 なら上限なし)
 TILE_SIZE = 40  # 1マスのサイズ
 
+# ★★★ 固定タイムステップ (物理演算は描画と関係なく一定間隔で進める) ★★★
+SIM_HZ = 60  # 1秒あたりのティック数
+SIM_DT = 1.0 / SIM_HZ  # 1ティックの長さ (秒)
+MAX_FRAME_SECONDS = 0.25  # 1フレームで追いつく実時間の上限 (秒)
+
+# ★★★ メニュー画面の部分更新 (変わった所だけ描き直し、変化がなければイベントを待って眠る) ★★★
+USE_DIRTY_RECT_MENUS = True
+MENU_STATES = ("TITLE_SCREEN", "BEST_TIME_SCREEN", "GAME_OVER", "GAME_CLEAR")
+
+# ★★★ 静的レイヤー (動かないタイルをチャンク画像に焼き込んで描画) ★★★
+USE_STATIC_LAYER = True
+STATIC_CHUNK_SIZE = 512  # チャンク1枚の大きさ (ピクセル)
+STATIC_LAYER_COLORKEY = (255, 0, 255)  # チャンクの透過色 (背景の星が見えるように)
+
+# ★★★ 静的レイヤーのストリーミング (カメラの近くのチャンク画像だけを作って持つ) ★★★
+USE_LEVEL_STREAMING = True  # (静的レイヤーを使うときだけ有効)
+STREAM_CHUNK_TILES = 16  # ストリーミングのチャンク1枚の大きさ (マス)
+
+# ★★★ 足場テクスチャのキャッシュ (種類ごとに用意するまだら模様の数) ★★★
+PLATFORM_TEXTURE_VARIANTS = 8
+
 # 色の定義
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
@@ -37,6 +75,17 @@ GAME_BACKGROUND_COLOR = (10, 10, 25)
 STAR_COLORS = [(255, 255, 255), (200, 200, 200), (255, 255, 220)]
 NUM_STARS = 300  # 星の数
 PARALLAX_FACTOR = 0.5  # 星のスクロール速度 (0.5 = カメラの半分の速度)
+# 星空の層 (Parallax 係数, 星の割合)。奥行きを出すなら
+# ((0.25, 0.6), (PARALLAX_FACTOR, 0.4)) のように層を増やす
+STAR_LAYERS = ((PARALLAX_FACTOR, 1.0),)
+
+# 重力反転の回転アニメーション中は、この倍率に縮小した画像を回転させる
+ROTATE_RENDER_SCALE = 0.5
+
+# ★★★ スプライトの描画レイヤー (奥 -> 手前の順に描く) ★★★
+# (足場の静的レイヤー / タイルマップはこの前に、HUD は拡大後の画面にこの後で描く)
+RENDER_LAYERS = ("hazards", "pickups", "player")
+RENDER_CULL_MARGIN = TILE_SIZE  # 補間で少しずれても欠けないよう、カメラより広めに探す
 
 # プレイヤーの新しい色
 PLAYER_FILL_COLOR = (60, 160, 220)  # 明るい青
@@ -145,6 +194,16 @@ WALL_SLIDE_SPEED = 1  # 壁ずり落ちる速度
 # 弓矢の発射間隔 (ミリ秒)のランダム範囲を設定
 MIN_ARROW_INTERVAL = 1500  # 最小間隔 (1.5秒)
 MAX_ARROW_INTERVAL = 3000  # 最大間隔 (3.0秒)
+MAX_LIVE_ARROWS = 64  # ★ 同時に飛んでいられる矢の上限 (超えた分は発射しない)
+
+# ★★★ 矢の当たり判定のブロードフェーズ (矩形を配列に並べて候補をまとめて探す) ★★★
+USE_NUMPY_BROADPHASE = numpy is not None  # (NumPy がなければ Rect.collidelistall を使う)
+BROADPHASE_NUMPY_THRESHOLD = 1024  # この数より少ないときは配列を持たない (collidelistall のほうが速い)
+
+# ★★★ 活動範囲: カメラの外側この距離 (px) までの発射台・パトロールするトゲだけを動かす ★★★
+# (飛んでいる矢と落ち始めたトゲは範囲の外でも動かす)
+ACTIVITY_RADIUS = 400
+ACTIVITY_CELL_SIZE = TILE_SIZE * 8  # 活動範囲の検索に使うグリッドのセルサイズ
 
 MOVE_SPEED = 5
 MAX_SPEED = 6
@@ -159,16 +218,42 @@ def get_angle_from_gravity(direction):
     return 0
 
 
+def ms_to_ticks(ms):
+    """ミリ秒をシミュレーションのティック数に変換する"""
+    return round(ms * SIM_HZ / 1000)
+
+
 # 物理定数 (慣性・摩擦あり)
 GRAVITY = 0.4  # 重力
 JUMP_STRENGTH = -10  # ジャンプ力
 MAX_SPEED = 6  # プレイヤーの最高速度
 ACCELERATION = 0.4  # 加速の度合い
 FRICTION_FORCE = 0.1  # 摩擦力 (★滑りを増やすため 0.1)
+BOOSTER_SPEED_MULTIPLIER = 2.0  # ブースターの上での速度の倍率
+BOOSTER_JUMP_MULTIPLIER = 2.0  # ブースターからのジャンプ力の倍率
 
 # ファイル名
 BEST_TIME_FILE = "best_time.json"
 
+# ★★★ リプレイ (入力の記録と再生) ★★★
+REPLAY_DIR = "replays"
+LAST_RUN_REPLAY_FILE = os.path.join(REPLAY_DIR, "last_run.mxr")  # 直前のプレイ
+BEST_RUN_REPLAY_FILE = os.path.join(REPLAY_DIR, "best_run.mxr")  # ベストタイムのプレイ
+REPLAY_BUFFER_SIZE = 4096  # このティック数ごとにまとめてファイルへ書き出す
+REPLAY_FAST_FORWARD = 8  # 早送り再生の倍率
+
+# ★★★ ステージファイル ★★★
+LEVEL_DIR = "levels"  # ステージのテキストファイルを置くフォルダ
+DEFAULT_LEVEL_FILE = os.path.join(LEVEL_DIR, "stage1.txt")  # なければ LEVEL_MAP を使う
+LEVEL_CACHE_DIR = os.path.join(LEVEL_DIR, "__cache__")  # コンパイル済みキャッシュの置き場所
+
+# ★★★ フレームプロファイラ (デバッグ用) ★★★
+PROFILER_HISTORY = 120  # 平均とグラフに使う直近のフレーム数
+PROFILE_CSV_FILE = "profile_trace.csv"  # F4 で記録するフレームごとの計測結果
+FRAME_BUDGET_MS = 1000.0 / 60  # 60 FPS で 1フレームに使える時間
+
+TEXT_CACHE_SIZE = 128  # 描いた文字列を覚えておく数 (古いものから捨てる)
+
 
 # --- ステージの設計図 (8色に増強、灰色Pは廃止) ---
 LEVEL_MAP = [
@@ -253,15 +338,16 @@ class Player(pygame.sprite.Sprite):
         self.wall_jump_cooldown = 0
         self.WALL_JUMP_COOLDOWN_FRAMES = 10  # 10フレーム (約0.16秒) 入力を無視
 
-        # 現在立っている足場 (ブースター判定用)
+        # 現在立っている足場の種類コード (ブースター判定用)
         self.standing_on = []
 
         # ジャンプ力と速度の倍率
         self.speed_multiplier = 1.0
         self.jump_multiplier = 1.0
 
-    def update(self, platforms, current_gravity):
-        keys = pygame.key.get_pressed()
+    def update(self, tile_map, current_gravity, controls):
+        # (controls はキーボードではなく InputState で受け取る)
+        # (tile_map.query は重なった足場のマスの Rect を返す)
 
         # --- 1. クールダウン処理 ---
         if self.wall_jump_cooldown > 0:
@@ -271,9 +357,9 @@ class Player(pygame.sprite.Sprite):
         target_vel_x = 0
 
         if self.wall_jump_cooldown == 0:
-            if keys[pygame.K_LEFT] or keys[pygame.K_a]:
+            if controls.left:
                 target_vel_x = -MOVE_SPEED * self.speed_multiplier
-            elif keys[pygame.K_RIGHT] or keys[pygame.K_d]:
+            elif controls.right:
                 target_vel_x = MOVE_SPEED * self.speed_multiplier
 
         if target_vel_x != 0:  # 加速
@@ -307,85 +393,42 @@ class Player(pygame.sprite.Sprite):
                     self.vel_y -= GRAVITY
                 self.vel_y = max(-1000, min(self.vel_y, 10))
 
-        # --- 4. X軸（横）の移動と衝突判定 ---
+        # --- 4. X軸（横）の移動と衝突判定 (スイープ: 最初に当たる壁の手前で止める) ---
         self.true_x += self.vel_x
-        self.rect.x = int(self.true_x)
-
-        hit_list_x = pygame.sprite.spritecollide(self, platforms, False)
+        contact_x = sweep(tile_map, self.rect, 0, int(self.true_x) - self.rect.x)
+        self.rect.x += contact_x.moved
 
         self.on_wall = 0
         self.on_wall_right = False
         self.on_wall_left = False
 
-        for platform in hit_list_x:
-            if self.vel_x > 0:  # 右に移動中
-                self.rect.right = platform.rect.left
+        if contact_x.blocked:
+            if contact_x.normal < 0:  # 右に移動中 (壁の面は左向き)
                 self.on_wall_right = True
                 self.on_wall = 1  # 右壁
-            elif self.vel_x < 0:  # 左に移動中
-                self.rect.left = platform.rect.right
+            else:  # 左に移動中
                 self.on_wall_left = True
                 self.on_wall = -1  # 左壁
 
             self.true_x = float(self.rect.x)
             self.vel_x = 0
 
-        # --- 5. Y軸（縦）の移動と衝突判定 (貫通対策ロジック) ---
-        remaining_y = self.vel_y
-        sign = 1 if remaining_y > 0 else -1
-        # プレイヤーの高さ (30) - 1 = 29
-        max_step_size = self.rect.height - 1
-        if max_step_size <= 0:
-            max_step_size = 1  # ゼロ除算回避
-
-        while abs(remaining_y) > 0.001:
-            step = min(abs(remaining_y), max_step_size) * sign
-            self.true_y += step
-            self.rect.y = int(self.true_y)
-
-            hit_list_y = pygame.sprite.spritecollide(self, platforms, False)
-
-            if hit_list_y:
-                if current_gravity == "DOWN":
-                    if self.vel_y > 0:  # 着地
-                        best_platform = min(hit_list_y, key=lambda p: p.rect.top)
-                        self.rect.bottom = best_platform.rect.top
-                    elif self.vel_y < 0:  # 頭をぶつけた
-                        best_platform = max(hit_list_y, key=lambda p: p.rect.bottom)
-                        self.rect.top = best_platform.rect.bottom
-                elif current_gravity == "UP":
-                    if self.vel_y < 0:  # 着地 (天井へ)
-                        best_platform = max(hit_list_y, key=lambda p: p.rect.bottom)
-                        self.rect.top = best_platform.rect.bottom
-                    elif self.vel_y > 0:  # 頭をぶつけた (床へ)
-                        best_platform = min(hit_list_y, key=lambda p: p.rect.top)
-                        self.rect.bottom = best_platform.rect.top
-
-                self.true_y = float(self.rect.y)
-                self.vel_y = 0
-                remaining_y = 0.0
-                break
-
-            remaining_y -= step
-
-        # --- 6. 接地判定 ---
-        self.on_ground = False
-        self.standing_on.clear()
-
-        check_rect = self.rect.copy()
-        if current_gravity == "DOWN":
-            check_rect.y += 1
-        elif current_gravity == "UP":
-            check_rect.y -= 1
+        # --- 5. Y軸（縦）の移動と衝突判定 (スイープなので貫通しない) ---
+        # (止まっているときは、重力の向きに足場が接しているかだけを調べる)
+        ground_side = 1 if current_gravity == "DOWN" else -1
+        self.true_y += self.vel_y
+        contact_y = sweep(
+            tile_map, self.rect, 1, int(self.true_y) - self.rect.y, ground_side
+        )
+        self.rect.y += contact_y.moved
 
-        ground_hit_list = []
-        for platform in platforms:
-            if check_rect.colliderect(platform.rect):
-                ground_hit_list.append(platform)
+        if contact_y.blocked:  # 着地 / 頭をぶつけた
+            self.true_y = float(self.rect.y)
+            self.vel_y = 0
 
-        if len(ground_hit_list) > 0:
-            self.on_ground = True
-            self.standing_on = ground_hit_list
+        # --- 6. 接地判定 (重力の向きの面に接しているか) ---
+        self.on_ground = contact_y.normal == -ground_side
+        self.standing_on = contact_y.codes if self.on_ground else []
 
         # ★ 7. 重力に応じて画像を変更
         if current_gravity == "DOWN":
@@ -393,8 +436,7 @@ class Player(pygame.sprite.Sprite):
         elif current_gravity == "UP":
             self.image = self.image_up
 
-    def jump(self, current_gravity):
-        keys = pygame.key.get_pressed()
+    def jump(self, current_gravity, controls):
 
         # 1. 地上ジャンプ
         if self.on_ground:
@@ -407,9 +449,9 @@ class Player(pygame.sprite.Sprite):
         # 2. 壁キック
         elif self.on_wall != 0:
             is_pushing_into_wall = False
-            if self.on_wall == -1 and (keys[pygame.K_LEFT] or keys[pygame.K_a]):
+            if self.on_wall == -1 and controls.left:
                 is_pushing_into_wall = True
-            elif self.on_wall == 1 and (keys[pygame.K_RIGHT] or keys[pygame.K_d]):
+            elif self.on_wall == 1 and controls.right:
                 is_pushing_into_wall = True
 
             if is_pushing_into_wall:
@@ -441,6 +483,9 @@ class Player(pygame.sprite.Sprite):
         self.jump_multiplier = 1.0
         self.standing_on.clear()
         self.wall_jump_cooldown = 0
+        self.on_wall = 0
+        self.on_wall_left = False
+        self.on_wall_right = False
         # ★ リセット時は必ず下向き重力から開始する想定
         self.image = self.image_down
 
@@ -448,6 +493,102 @@ class Player(pygame.sprite.Sprite):
 # --- その他のオブジェクトクラス ---
 
 
+# ▼▼▼ 足場テクスチャのキャッシュ ▼▼▼
+# 足場のまだら模様専用の乱数 (ワーカースレッドで模様を作っても、ほかの乱数の並びを乱さない)
+TEXTURE_RANDOM = random.Random()
+
+
+class PlatformTextureCache:
+    """足場のまだら模様テクスチャを、タイル間・リトライ間で共有するプール
+
+    キーは (足場の種類, 上面パレット, 上隣, 下隣, バリエーション番号)。
+    バリエーション数が決まっているので、タイル数が増えてもメモリは増えない。
+    """
+
+    def __init__(self, variants=PLATFORM_TEXTURE_VARIANTS):
+        self.variants = variants
+        self.sides = {}  # (種類, パレット, バリエーション) -> 側面画像
+        self.images = {}  # (種類, パレット, 上隣, 下隣, バリエーション) -> 3枚の画像
+        self.tile_images = {}  # (種類コード, 上隣, 下隣, バリエーション) -> 3枚の画像
+        # (ストリーミングのワーカースレッドからも呼ばれる。get_tile の見本の足場が
+        #  get を呼ぶので、同じスレッドから入り直せる RLock にする)
+        self.lock = threading.RLock()
+
+    def get(self, platform, top_color, top_palette, variant):
+        """(側面, 上面, 下面) の画像を返す。なければ生成して登録する"""
+        variant %= self.variants
+        kind = (type(platform), top_color, tuple(top_palette))
+        up = platform.has_neighbor_up
+        down = platform.has_neighbor_down
+        key = (kind, up, down, variant)
+
+        images = self.images.get(key)
+        if images is None:
+            with self.lock:
+                # (待っている間に他のスレッドが作ったかもしれないので、もう一度見る)
+                images = self.images.get(key)
+                if images is None:
+                    images = self.images[key] = self.create_images(
+                        platform, kind, variant, top_color, top_palette
+                    )
+        return images
+
+    def create_images(self, platform, kind, variant, top_color, top_palette):
+        side = self.sides.get((kind, variant))
+        if side is None:
+            side = self.sides[(kind, variant)] = platform.create_side_image()
+
+        if not platform.has_neighbor_up:
+            top = platform.create_top_image(side.copy(), top_color, top_palette)
+        else:
+            top = side
+        if not platform.has_neighbor_down:
+            bottom = platform.create_bottom_image(side.copy(), top_color, top_palette)
+        else:
+            bottom = side
+        return side, top, bottom
+
+    def get_tile(self, code, mask, tx, ty):
+        """タイルマップのマス (種類コードと隣接フラグ) の (側面, 上面, 下面) 画像を返す"""
+        x = tx * TILE_SIZE
+        y = ty * TILE_SIZE
+        up = bool(mask & NEIGHBOR_UP)
+        down = bool(mask & NEIGHBOR_DOWN)
+        key = (code, up, down, texture_variant(x, y))
+
+        images = self.tile_images.get(key)
+        if images is None:
+            with self.lock:
+                images = self.tile_images.get(key)
+                if images is None:
+                    # 見本の足場を1枚だけ作って画像を取り出す (キーごとに1回だけ)
+                    sample = PLATFORM_CLASSES[code](
+                        x, y, up, down, bool(mask & NEIGHBOR_LEFT), bool(mask & NEIGHBOR_RIGHT)
+                    )
+                    images = self.tile_images[key] = (
+                        sample.image_side,
+                        sample.image_top,
+                        sample.image_bottom,
+                    )
+        return images
+
+    def clear(self):
+        with self.lock:
+            self.sides.clear()
+            self.images.clear()
+            self.tile_images.clear()
+
+
+def texture_variant(x, y):
+    """タイルの座標から、まだら模様のバリエーション番号を決める (毎回同じ結果)"""
+    tx = x // TILE_SIZE
+    ty = y // TILE_SIZE
+    return (tx * 73856093 ^ ty * 19349663) % PLATFORM_TEXTURE_VARIANTS
+
+
+# ▲▲▲ 足場テクスチャのキャッシュ ここまで ▲▲▲
+
+
 # ▼▼▼ Platform クラス (ベースクラス) ▼▼▼
 class Platform(pygame.sprite.Sprite):
     """足場 (マインクラフト風の規則的なまだら模様) - ベースクラス"""
@@ -472,26 +613,11 @@ class Platform(pygame.sprite.Sprite):
         self.has_neighbor_left = left
         self.has_neighbor_right = right
 
-        # 2. 3種類の画像をあらかじめ生成する
-
-        # (A) 側面のみ (ベース)
-        self.image_side = self.create_side_image()
-
-        # (B) 上面画像 (image_top)
-        if not self.has_neighbor_up:
-            self.image_top = self.create_top_image(
-                self.image_side.copy(), top_color, top_palette
-            )
-        else:
-            self.image_top = self.image_side
-
-        # (C) 下面画像 (image_bottom)
-        if not self.has_neighbor_down:
-            self.image_bottom = self.create_bottom_image(
-                self.image_side.copy(), top_color, top_palette
-            )
-        else:
-            self.image_bottom = self.image_side
+        # 2. 3種類の画像 (側面 / 上面 / 下面) をテクスチャキャッシュから取得する
+        #    (同じ種類・同じ隣接・同じバリエーションのタイルは画像を共有する)
+        self.image_side, self.image_top, self.image_bottom = PLATFORM_TEXTURES.get(
+            self, top_color, top_palette, texture_variant(x, y)
+        )
 
         # 3. 初期イメージを設定 (重力は下向きスタート)
         self.image = self.image_top
@@ -504,7 +630,7 @@ class Platform(pygame.sprite.Sprite):
         PIXEL_GRID_SIZE_SIDE = 5
         for y_pos in range(0, TILE_SIZE, PIXEL_GRID_SIZE_SIDE):
             for x_pos in range(0, TILE_SIZE, PIXEL_GRID_SIZE_SIDE):
-                color = random.choice(SIDE_PATTERN_PALETTE)
+                color = TEXTURE_RANDOM.choice(SIDE_PATTERN_PALETTE)
                 pygame.draw.rect(
                     image,
                     color,
@@ -520,7 +646,7 @@ class Platform(pygame.sprite.Sprite):
         PIXEL_GRID_SIZE_TOP = 4
         for y_pos in range(0, PLATFORM_TOP_THICKNESS, PIXEL_GRID_SIZE_TOP):
             for x_pos in range(0, TILE_SIZE, PIXEL_GRID_SIZE_TOP):
-                color = random.choice(top_palette)
+                color = TEXTURE_RANDOM.choice(top_palette)
                 pygame.draw.rect(
                     base_image,
                     color,
@@ -537,7 +663,7 @@ class Platform(pygame.sprite.Sprite):
         PIXEL_GRID_SIZE_TOP = 4
         for y_pos_rel in range(0, PLATFORM_TOP_THICKNESS, PIXEL_GRID_SIZE_TOP):
             for x_pos in range(0, TILE_SIZE, PIXEL_GRID_SIZE_TOP):
-                color = random.choice(top_palette)
+                color = TEXTURE_RANDOM.choice(top_palette)
                 draw_y = bottom_y + y_pos_rel  # 描画Y座標
                 pygame.draw.rect(
                     base_image,
@@ -679,31 +805,10 @@ class GreenPlatform(Platform):
 # ▼▼▼ 修正後の BoosterPlatform クラス ▼▼▼
 class BoosterPlatform(Platform):
     def __init__(self, x, y, up, down, left, right):
-        # 1. 親(Platform)の __init__ を呼んで、灰色の側面・灰色の上下 を設定
+        # 親(Platform)の __init__ がテクスチャキャッシュ経由で
+        # 下の create_* (黄土色の側面・草付きの上下面) を使って画像を用意する
         super().__init__(x, y, up, down, left, right)
 
-        # 2. 側面の画像を黄土色で再生成
-        self.image_side = (
-            self.create_side_image()
-        )  # (BoosterPlatform に create_side_image を追加)
-
-        # 3. 上面画像を草付きで再生成
-        if not self.has_neighbor_up:
-            self.image_top = self.create_top_image_with_grass(self.image_side.copy())
-        else:
-            self.image_top = self.image_side
-
-        # 4. 下面画像を草付きで再生成
-        if not self.has_neighbor_down:
-            self.image_bottom = self.create_bottom_image_with_grass(
-                self.image_side.copy()
-            )
-        else:
-            self.image_bottom = self.image_side
-
-        # 5. 初期イメージを更新
-        self.image = self.image_top
-
     def create_side_image(self):
         """(Override) 側面の画像を黄土色で生成"""
         image = pygame.Surface((TILE_SIZE, TILE_SIZE))
@@ -711,13 +816,21 @@ class BoosterPlatform(Platform):
         # (黄土色用のまだら模様パレットがあってもよいが、今回は省略)
         return image
 
+    def create_top_image(self, base_image, top_color, top_palette):
+        """(Override) 上面は草付きで描画"""
+        return self.create_top_image_with_grass(base_image)
+
+    def create_bottom_image(self, base_image, top_color, top_palette):
+        """(Override) 下面は草付きで描画"""
+        return self.create_bottom_image_with_grass(base_image)
+
     def create_top_image_with_grass(self, base_image):
         """上面（黄土色＋草）を描画"""
         top_rect = pygame.Rect(0, 0, TILE_SIZE, PLATFORM_TOP_THICKNESS)
         pygame.draw.rect(base_image, BOOSTER_TOP_COLOR, top_rect)
 
         for i in range(2, TILE_SIZE - 2, 6):
-            grass_height = random.randint(3, 5)
+            grass_height = TEXTURE_RANDOM.randint(3, 5)
             grass_y = PLATFORM_TOP_THICKNESS - grass_height
             grass_rect = pygame.Rect(i, grass_y, 2, grass_height)
             pygame.draw.rect(base_image, BOOSTER_GRASS_COLOR, grass_rect)
@@ -730,7 +843,7 @@ class BoosterPlatform(Platform):
         pygame.draw.rect(base_image, BOOSTER_TOP_COLOR, bottom_rect)
 
         for i in range(2, TILE_SIZE - 2, 6):
-            grass_height = random.randint(3, 5)
+            grass_height = TEXTURE_RANDOM.randint(3, 5)
             grass_y = TILE_SIZE - grass_height  # 下端から生える
             grass_rect = pygame.Rect(i, grass_y, 2, grass_height)
             pygame.draw.rect(base_image, BOOSTER_GRASS_COLOR, grass_rect)
@@ -740,39 +853,102 @@ class BoosterPlatform(Platform):
 # ▲▲▲ 修正後の BoosterPlatform クラス ここまで ▲▲▲
 
 
+# 全ステージ・全リトライで共有するテクスチャキャッシュ
+PLATFORM_TEXTURES = PlatformTextureCache()
+
+
+# ▼▼▼ 障害物の画像とマスクの共有 ▼▼▼
+class SpriteArtCache:
+    """トゲ・カギ・トビラ・矢などの (画像, マスク) を、種類と向きごとに1組だけ持つ
+
+    同じ種類のスプライトは同じ Surface と Mask を参照するので、数が増えても
+    画像とマスクは増えず、リトライで元に戻すときも参照を付け替えるだけで済む。
+    (共有しているので、スプライト側で画像に描き込んではいけない)
+    """
+
+    def __init__(self):
+        self.entries = {}  # (種類, 向き) -> (画像, マスク)
+
+    def get(self, key, create_image):
+        """key の (画像, マスク) を返す。なければ create_image() で作って登録する"""
+        art = self.entries.get(key)
+        if art is None:
+            image = create_image()
+            art = self.entries[key] = (image, pygame.mask.from_surface(image))
+        return art
+
+    def clear(self):
+        self.entries.clear()
+
+
+SPRITE_ART = SpriteArtCache()
+
+# ▲▲▲ 障害物の画像とマスクの共有 ここまで ▲▲▲
+
+
 class GravitySwitcher(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
-        self.image = pygame.Surface((25, 25))
-        self.image.fill(GRAVITY_SWITCHER_COLOR)
+        self.image, self.mask = SPRITE_ART.get("GravitySwitcher", self.create_image)
         self.rect = self.image.get_rect(center=(x + TILE_SIZE // 2, y + TILE_SIZE // 2))
 
+    @staticmethod
+    def create_image():
+        image = pygame.Surface((25, 25))
+        image.fill(GRAVITY_SWITCHER_COLOR)
+        return image
+
 
 class Spike(pygame.sprite.Sprite):
     """トゲ（障害物）- 三角形 (4方向対応)"""
 
+    # ★★★ 向きごとの当たり判定 (40x40 のマスのうち三角形が描かれている半分) ★★★
+    HITBOXES = {
+        "DOWN": (0, 0, TILE_SIZE, TILE_SIZE // 2),  # 天井トゲ: 40x20 (上半分)
+        "UP": (0, TILE_SIZE // 2, TILE_SIZE, TILE_SIZE // 2),  # 床トゲ: 40x20 (下半分)
+        "LEFT": (0, 0, TILE_SIZE // 2, TILE_SIZE),  # 右壁トゲ: 20x40 (左半分)
+        "RIGHT": (TILE_SIZE // 2, 0, TILE_SIZE // 2, TILE_SIZE),  # 左壁トゲ: 20x40 (右半分)
+    }
+
     def __init__(self, x, y, orientation="UP"):
         super().__init__()
+        self.orientation = orientation
+        if orientation not in self.HITBOXES:
+            orientation = "UP"  # (知らない向きは床トゲとして扱う)
+
+        # 1. rect を向きに合わせた大きさ (40x20 / 20x40) にする
+        left, top, width, height = self.HITBOXES[orientation]
+        self.rect = pygame.Rect(x + left, y + top, width, height)
+
+        # 2. 画像とマスクは向きごとに共有したものを使う
+        #    (original_* はリトライで戻すときの参照。コピーはしない)
+        self.image, self.mask = SPRITE_ART.get(
+            ("Spike", orientation), lambda: Spike.create_image(orientation)
+        )
+        self.original_image = self.image
+        self.original_mask = self.mask
 
+    @classmethod
+    def create_image(cls, orientation):
+        """三角形を描いた 40x40 の画像から、当たり判定の範囲だけを切り出して返す"""
         # 1. 40x40 の透明なベースイメージを作成
         base_image = pygame.Surface((TILE_SIZE, TILE_SIZE), pygame.SRCALPHA)
         base_image.fill((0, 0, 0, 0))
-        self.orientation = orientation
 
         # 2. 40x40 のベースに三角形を描画
-        if self.orientation == "DOWN":  # 天井トゲ (タイルの上半分に描画)
+        if orientation == "DOWN":  # 天井トゲ (タイルの上半分に描画)
             points = [
                 (0, 0),  # Top-Left
                 (TILE_SIZE, 0),  # Top-Right
                 (TILE_SIZE // 2, TILE_SIZE // 2),  # Center-Tip (下向きの先端)
             ]
-        elif self.orientation == "LEFT":  # 右壁トゲ (タイルの左半分に描画)
+        elif orientation == "LEFT":  # 右壁トゲ (タイルの左半分に描画)
             points = [
                 (0, 0),  # Top-Left
                 (0, TILE_SIZE),  # Bottom-Left
                 (TILE_SIZE // 2, TILE_SIZE // 2),  # Center-Tip (左向きの先端)
             ]
-        elif self.orientation == "RIGHT":  # 左壁トゲ (タイルの右半分に描画)
+        elif orientation == "RIGHT":  # 左壁トゲ (タイルの右半分に描画)
             points = [
                 (TILE_SIZE, 0),  # Top-Right
                 (TILE_SIZE, TILE_SIZE),  # Bottom-Right
@@ -787,67 +963,37 @@ class Spike(pygame.sprite.Sprite):
 
         pygame.draw.polygon(base_image, SPIKE_COLOR, points)
 
-        # 3. 40x40 の original_image を保存
-        self.original_image = base_image.copy()
-
-        # 4. self.rect を 40x40 で初期化
-        self.rect = self.original_image.get_rect(topleft=(x, y))
-
-        # 5. ★★★ 全てのSpikeで共通の当たり判定縮小処理 (4方向) ★★★
-        sub_rect = (0, 0, TILE_SIZE, TILE_SIZE)  # デフォルト (念のため)
-
-        if self.orientation == "DOWN":
-            # rect を 40x20 (上半分) に縮小
-            self.rect.height = TILE_SIZE // 2
-            sub_rect = (0, 0, TILE_SIZE, TILE_SIZE // 2)
-
-        elif self.orientation == "UP":
-            # rect を 40x20 (下半分) に縮小し、Y座標を下にずらす
-            self.rect.height = TILE_SIZE // 2
-            self.rect.y += TILE_SIZE // 2
-            sub_rect = (0, TILE_SIZE // 2, TILE_SIZE, TILE_SIZE // 2)
-
-        elif self.orientation == "LEFT":
-            # rect を 20x40 (左半分) に縮小
-            self.rect.width = TILE_SIZE // 2
-            sub_rect = (0, 0, TILE_SIZE // 2, TILE_SIZE)
-
-        elif self.orientation == "RIGHT":
-            # rect を 20x40 (右半分) に縮小し、X座標を右にずらす
-            self.rect.width = TILE_SIZE // 2
-            self.rect.x += TILE_SIZE // 2
-            sub_rect = (TILE_SIZE // 2, 0, TILE_SIZE // 2, TILE_SIZE)
-
-        # 6. image と mask を、補正後の rect に合わせて更新
-        self.image = self.original_image.subsurface(sub_rect)
-        self.original_image = self.image.copy()  # original_image も 補正後に更新
-        self.mask = pygame.mask.from_surface(self.image)
+        # 3. 当たり判定の範囲だけを切り出す (元の画像から独立させるためにコピー)
+        return base_image.subsurface(cls.HITBOXES[orientation]).copy()
 
 
 # ▼▼▼ 修正後の Key クラス ▼▼▼
 class Key(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
+        # 画像とピクセルパーフェクト判定用のマスクは全てのカギで共有
+        self.image, self.mask = SPRITE_ART.get("Key", self.create_image)
+
+        # rect は変更なし (中央配置)
+        self.rect = self.image.get_rect(center=(x + TILE_SIZE // 2, y + TILE_SIZE // 2))
+
+    @staticmethod
+    def create_image():
         # 1. 20x20の透過サーフェスを作成
-        self.image = pygame.Surface((20, 20), pygame.SRCALPHA)
-        self.image.fill((0, 0, 0, 0))  # 透過で塗りつぶし
+        image = pygame.Surface((20, 20), pygame.SRCALPHA)
+        image.fill((0, 0, 0, 0))  # 透過で塗りつぶし
 
         # 2. 鍵の「輪」を描画 (塗りつぶし)
-        pygame.draw.circle(self.image, KEY_COLOR, (10, 6), 5)  # (center, radius)
+        pygame.draw.circle(image, KEY_COLOR, (10, 6), 5)  # (center, radius)
         # 3. 輪の中を透明で抜く (小さな円)
-        pygame.draw.circle(self.image, (0, 0, 0, 0), (10, 6), 2)
+        pygame.draw.circle(image, (0, 0, 0, 0), (10, 6), 2)
 
         # 4. 鍵の「軸」を描画
-        pygame.draw.rect(self.image, KEY_COLOR, (8, 10, 4, 10))  # (x, y, w, h)
+        pygame.draw.rect(image, KEY_COLOR, (8, 10, 4, 10))  # (x, y, w, h)
 
         # 5. 鍵の「歯」を描画
-        pygame.draw.rect(self.image, KEY_COLOR, (8, 17, 7, 2))
-
-        # 6. rect は変更なし (中央配置)
-        self.rect = self.image.get_rect(center=(x + TILE_SIZE // 2, y + TILE_SIZE // 2))
-
-        # 7. ピクセルパーフェクト判定用のマスクを作成
-        self.mask = pygame.mask.from_surface(self.image)
+        pygame.draw.rect(image, KEY_COLOR, (8, 17, 7, 2))
+        return image
 
 
 # ▲▲▲ 修正後の Key クラス ここまで ▲▲▲
@@ -857,480 +1003,1609 @@ class Key(pygame.sprite.Sprite):
 class Door(pygame.sprite.Sprite):
     def __init__(self, x, y):
         super().__init__()
+        # 画像とピクセルパーフェクト判定用のマスクは全てのトビラで共有
+        self.image, self.mask = SPRITE_ART.get("Door", self.create_image)
+
+        # rect は変更なし
+        self.rect = self.image.get_rect(bottomleft=(x, y + TILE_SIZE))
+
+    @staticmethod
+    def create_image():
         # 1. 40x60の透過サーフェスを作成
-        self.image = pygame.Surface((40, 60), pygame.SRCALPHA)
-        self.image.fill((0, 0, 0, 0))  # 透過
+        image = pygame.Surface((40, 60), pygame.SRCALPHA)
+        image.fill((0, 0, 0, 0))  # 透過
 
         # 2. ドア本体 (緑)
-        pygame.draw.rect(self.image, DOOR_COLOR, (0, 0, 40, 60), border_radius=4)
+        pygame.draw.rect(image, DOOR_COLOR, (0, 0, 40, 60), border_radius=4)
 
         # 3. ドアの枠 (少し暗い緑)
         DOOR_FRAME_COLOR = (0, 120, 0)
         pygame.draw.rect(
-            self.image, DOOR_FRAME_COLOR, (0, 0, 40, 60), 3, border_radius=4
+            image, DOOR_FRAME_COLOR, (0, 0, 40, 60), 3, border_radius=4
         )  # width=3
 
         # 4. 鍵穴 (カギの色 = 黄色)
         KEYHOLE_COLOR = KEY_COLOR
         # 鍵穴の丸い部分
-        pygame.draw.circle(self.image, KEYHOLE_COLOR, (30, 30), 4)
+        pygame.draw.circle(image, KEYHOLE_COLOR, (30, 30), 4)
         # 鍵穴の縦棒部分
-        pygame.draw.rect(self.image, KEYHOLE_COLOR, (28, 33, 4, 6))
-
-        # 5. rect は変更なし
-        self.rect = self.image.get_rect(bottomleft=(x, y + TILE_SIZE))
-
-        # 6. ピクセルパーフェクト判定用のマスクを作成
-        self.mask = pygame.mask.from_surface(self.image)
+        pygame.draw.rect(image, KEYHOLE_COLOR, (28, 33, 4, 6))
+        return image
 
 
 # ▲▲▲ 修正後の Door クラス ここまで ▲▲▲
 
 
-# --- ステージを構築する関数 ---
-def setup_level(level_map):
-    all_sprites = pygame.sprite.Group()
-    platforms = pygame.sprite.Group()
-    spikes = pygame.sprite.Group()
-    keys = pygame.sprite.Group()
-    doors = pygame.sprite.Group()
-    booster_platforms = pygame.sprite.Group()
-    gravity_switchers = pygame.sprite.Group()
+# -----------------------------------------------------------------
+# ▼▼▼ 空間インデックス (一様グリッド) ▼▼▼
+# -----------------------------------------------------------------
+class SpatialGridGroup(pygame.sprite.Group):
+    """矩形と重なるスプライトを、下にあるセルだけを見て返す Group
+
+    spritecollide のように全スプライトを走査しないので、
+    マップが広くなっても1回の検索コストはほぼ一定になる。
+    """
+
+    def __init__(self, *sprites, cell_size=TILE_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}  # (セルX, セルY) -> [sprite, ...]
+        self.sprite_cells = {}  # sprite -> 登録したセルのリスト
+        super().__init__(*sprites)
+
+    def cell_range(self, rect):
+        """rect が覆うセルの範囲 (左, 右, 上, 下) を返す (両端を含む)"""
+        size = self.cell_size
+        return (
+            rect.left // size,
+            (rect.right - 1) // size,
+            rect.top // size,
+            (rect.bottom - 1) // size,
+        )
 
-    falling_spikes = pygame.sprite.Group()
-    patrolling_spikes = pygame.sprite.Group()
-    arrow_launchers = pygame.sprite.Group()
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.index_sprite(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        for cell in self.sprite_cells.pop(sprite, ()):
+            bucket = self.cells[cell]
+            bucket.remove(sprite)
+            if not bucket:
+                del self.cells[cell]
+
+    def index_sprite(self, sprite):
+        left, right, top, bottom = self.cell_range(sprite.rect)
+        registered = []
+        for cy in range(top, bottom + 1):
+            for cx in range(left, right + 1):
+                self.cells.setdefault((cx, cy), []).append(sprite)
+                registered.append((cx, cy))
+        self.sprite_cells[sprite] = registered
+
+    def relocate(self, sprite):
+        """sprite が動いたあとにセル登録を更新する"""
+        if sprite in self.sprite_cells:
+            self.remove_internal(sprite)
+            self.add_internal(sprite)
+
+    @staticmethod
+    def relocate_all(sprite):
+        """sprite が属している全ての SpatialGridGroup でセル登録を更新する"""
+        for group in sprite.groups():
+            if isinstance(group, SpatialGridGroup):
+                group.relocate(sprite)
+
+    def query(self, rect):
+        """rect と重なるスプライトのリストを返す (spritecollide の代わり)"""
+        left, right, top, bottom = self.cell_range(rect)
+        cells = self.cells
+        hits = []
+        seen = set()  # (複数のセルにまたがるスプライトを2回返さない)
+        for cy in range(top, bottom + 1):
+            for cx in range(left, right + 1):
+                bucket = cells.get((cx, cy))
+                if not bucket:
+                    continue
+                for sprite in bucket:
+                    if sprite not in seen and sprite.rect.colliderect(rect):
+                        seen.add(sprite)
+                        hits.append(sprite)
+        return hits
+
+    def query_mask(self, sprite):
+        """sprite とマスクが重なるスプライトのリストを返す
+
+        spritecollide(..., collide_mask) と同じ判定を、近くのセルの候補だけに行う
+        """
+        return [
+            other
+            for other in self.query(sprite.rect)
+            if pygame.sprite.collide_mask(sprite, other)
+        ]
 
-    player = None
-    start_pos = (0, 0)
 
-    map_height = len(level_map)
+# -----------------------------------------------------------------
+# ▲▲▲ 空間インデックス ここまで ▲▲▲
+# -----------------------------------------------------------------
 
-    for y, row in enumerate(level_map):
-        current_row_len = len(row)
-        for x, char in enumerate(row):
-            world_x = x * TILE_SIZE
-            world_y = y * TILE_SIZE
-
-            # --- Platform/Booster の隣接判定 (P以外の全ての足場キャラを追加) ---
-            platform_chars = (
-                "P",
-                "B",
-                "V",
-                "Y",
-                "C",
-                "O",
-                "R",
-                "L",
-                "E",
-            )  # 'P' も念のため残す
-            has_neighbor_up = (
-                y > 0
-                and x < len(level_map[y - 1])
-                and level_map[y - 1][x] in platform_chars
-            )
-            has_neighbor_down = (
-                y < map_height - 1
-                and x < len(level_map[y + 1])
-                and level_map[y + 1][x] in platform_chars
-            )
-            has_neighbor_left = x > 0 and row[x - 1] in platform_chars
-            has_neighbor_right = (
-                x < current_row_len - 1 and row[x + 1] in platform_chars
+
+# -----------------------------------------------------------------
+# ▼▼▼ ブロードフェーズ (動くスプライトの矩形を配列でまとめて判定) ▼▼▼
+# -----------------------------------------------------------------
+class BroadphaseGroup(pygame.sprite.Group):
+    """メンバーの矩形 (x, y, 幅, 高さ) を連続した int32 の配列に並べて持つ Group
+
+    update() で動いたスプライトの位置はその場で配列に書き戻すので、query() は
+    配列との比較1回で重なる候補を絞り、マスク判定は候補にだけ行えばよい。
+    NumPy がないときや、メンバーが BROADPHASE_NUMPY_THRESHOLD より少ないときは
+    配列を持たず (書き戻しもしない)、メンバーの Rect をそのまま並べたリストに
+    Rect.collidelistall (C のループ) を使って同じ候補を探す。
+    (ゲーム中の矢は MAX_LIVE_ARROWS までなので、普段は collidelistall のほう)
+
+    メンバーの rect は作り直さずにその場で動かすこと (リストが同じ Rect を参照する)。
+    """
+
+    def __init__(self, *sprites, use_numpy=USE_NUMPY_BROADPHASE):
+        self.use_numpy = use_numpy and numpy is not None
+        self.members = []  # 配列の行の順に並べたスプライト
+        self.rects = []  # members の rect (同じ Rect オブジェクト)
+        self.slots = {}  # sprite -> 行番号
+        self.storage = bytearray()
+        self.packed = False  # 配列がメンバーの矩形を写しているか
+        super().__init__(*sprites)
+
+    def pack(self):
+        """メンバーが多くなったので、矩形を配列に並べ始める"""
+        self.allocate(max(64, len(self.members) * 2))
+        for slot, rect in enumerate(self.rects):
+            self.write(slot, rect)
+        self.packed = True
+
+    def unpack(self):
+        """メンバーが減ったので、配列を手放す"""
+        self.storage = bytearray()
+        self.boxes = self.array = None
+        self.packed = False
+
+    def allocate(self, capacity):
+        """配列を capacity 行ぶん確保し直す (今の内容は引き継ぐ)"""
+        storage = bytearray(capacity * 16)
+        storage[: len(self.storage)] = self.storage
+        self.storage = storage
+        self.boxes = memoryview(storage).cast("i")  # 1つずつ書き込むとき用
+        self.array = numpy.frombuffer(storage, dtype=numpy.int32).reshape(capacity, 4)
+
+    def write(self, slot, rect):
+        base = slot * 4
+        boxes = self.boxes
+        boxes[base] = rect.x
+        boxes[base + 1] = rect.y
+        boxes[base + 2] = rect.width
+        boxes[base + 3] = rect.height
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        slot = len(self.members)
+        self.slots[sprite] = slot
+        self.members.append(sprite)
+        self.rects.append(sprite.rect)
+        if self.packed:
+            if slot == len(self.array):
+                self.allocate(slot * 2)
+            self.write(slot, sprite.rect)
+        elif self.use_numpy and slot + 1 >= BROADPHASE_NUMPY_THRESHOLD:
+            self.pack()
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        # 最後の行を空いた行に移して、配列を詰めたままにする
+        slot = self.slots.pop(sprite)
+        last = len(self.members) - 1
+        if slot != last:
+            moved = self.members[last]
+            self.members[slot] = moved
+            self.rects[slot] = self.rects[last]
+            self.slots[moved] = slot
+            if self.packed:
+                self.boxes[slot * 4 : slot * 4 + 4] = self.boxes[last * 4 : last * 4 + 4]
+        self.members.pop()
+        self.rects.pop()
+        # (しきい値の前後で配列を作ったり捨てたりを繰り返さないよう、半分まで減ったら捨てる)
+        if self.packed and last < BROADPHASE_NUMPY_THRESHOLD // 2:
+            self.unpack()
+
+    def update(self, *args, **kwargs):
+        """メンバーを動かし、動いた位置を配列に書き戻す (update 中にメンバーを外さないこと)"""
+        if not self.packed:
+            super().update(*args, **kwargs)
+            return
+        boxes = self.boxes
+        for slot, sprite in enumerate(self.members):
+            sprite.update(*args, **kwargs)
+            rect = sprite.rect
+            boxes[slot * 4] = rect.x
+            boxes[slot * 4 + 1] = rect.y
+
+    def query(self, rect):
+        """rect と矩形が重なるメンバーのリストを返す (配列の行の順)"""
+        members = self.members
+        count = len(members)
+        if self.packed:
+            boxes = self.array[:count]
+            x = boxes[:, 0]
+            y = boxes[:, 1]
+            hits = numpy.flatnonzero(
+                (x < rect.right)
+                & (x + boxes[:, 2] > rect.left)
+                & (y < rect.bottom)
+                & (y + boxes[:, 3] > rect.top)
             )
+            return [members[i] for i in hits.tolist()]
+        return [members[i] for i in rect.collidelistall(self.rects)]
 
-            # ★★★ プラットフォームの種類判定ロジックを更新 ★★★
-            current_platform = None
-            if (
-                char == "P"
-            ):  # 'P' がマップにあってもエラーにならないよう、Platformクラスを生成
-                current_platform = Platform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-            elif char == "V":  # 紫色上面のプラットフォーム
-                current_platform = PurplePlatform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-            elif char == "Y":  # 黄色上面のプラットフォーム
-                current_platform = YellowPlatform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-            elif char == "C":  # 水色上面のプラットフォーム
-                current_platform = CyanPlatform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-            elif char == "O":  # オレンジ色上面のプラットフォーム
-                current_platform = OrangePlatform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-            elif char == "R":  # 赤色上面のプラットフォーム (追加)
-                current_platform = RedPlatform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-            elif char == "L":  # 青色上面のプラットフォーム (追加)
-                current_platform = BluePlatform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-            elif char == "E":  # 緑色上面のプラットフォーム (追加)
-                current_platform = GreenPlatform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-            elif char == "B":  # Booster
-                current_platform = BoosterPlatform(
-                    world_x,
-                    world_y,
-                    has_neighbor_up,
-                    has_neighbor_down,
-                    has_neighbor_left,
-                    has_neighbor_right,
-                )
-                booster_platforms.add(current_platform)  # Boosterグループにも追加
-
-            if current_platform:
-                platforms.add(current_platform)
-                all_sprites.add(current_platform)
-            # ★★★ ここまで ★★★
-
-            elif char == "G":  # GravitySwitcher
-                g = GravitySwitcher(world_x, world_y)
-                gravity_switchers.add(g)
-                all_sprites.add(g)
-
-            # ▼▼▼ 'S', 'F', 'M' の orientation 決定ロジック (ここから) ▼▼▼
-            elif char in ("S", "F", "M"):
-
-                # --- 周囲の足場をチェック (P以外の全ての足場キャラを追加) ---
-                has_platform_below = (
-                    y < map_height - 1
-                    and x < len(level_map[y + 1])
-                    and level_map[y + 1][x] in platform_chars
-                )
-                has_platform_above = (
-                    y > 0
-                    and x < len(level_map[y - 1])
-                    and level_map[y - 1][x] in platform_chars
-                )
-                has_platform_right = (
-                    x < current_row_len - 1 and row[x + 1] in platform_chars
-                )
-                has_platform_left = x > 0 and row[x - 1] in platform_chars
-
-                # --- 向きを決定 (優先順位: ★下 -> 上 -> 右 -> 左★) ---
-                orientation = "UP"  # デフォルト
-
-                if has_platform_below:
-                    orientation = "UP"
-                elif has_platform_above:
-                    orientation = "DOWN"
-                elif has_platform_right:
-                    orientation = "LEFT"  # 右に壁があるので、トゲは左を向く
-                elif has_platform_left:
-                    orientation = "RIGHT"  # 左に壁があるので、トゲは右を向く
-
-                # --- オブジェクトの生成 ---
-                if char == "S":  # Spike
-                    s = Spike(world_x, world_y, orientation)
-                    spikes.add(s)
-                    all_sprites.add(s)
-
-                elif char == "F":  # FallingSpike
-                    fs = FallingSpike(world_x, world_y, orientation)
-                    spikes.add(fs)
-                    falling_spikes.add(fs)
-                    all_sprites.add(fs)
-
-                elif char == "M":  # PatrollingSpike
-                    ps = PatrollingSpike(world_x, world_y, 80, 2, orientation)
-                    spikes.add(ps)
-                    patrolling_spikes.add(ps)
-                    all_sprites.add(ps)
-            # ▲▲▲ 'S', 'F', 'M' のロジックここまで ▲▲▲
-
-            # ▼▼▼ ★★★ 'A' の修正ブロック ★★★ ▼▼▼
-            elif char == "A":
-                # --- 'A' (ArrowLauncher) の向きを自動判定 ---
-                # (プラットフォーム文字は 'S' ブロックの定義と合わせる)
-                platform_chars_for_A = ("P", "B", "V", "Y", "C", "O", "R", "L", "E")
-                has_platform_right = (
-                    x < current_row_len - 1 and row[x + 1] in platform_chars_for_A
-                )
-                has_platform_left = x > 0 and row[x - 1] in platform_chars_for_A
-
-                direction = 1  # デフォルトは右向き
-
-                if has_platform_right:
-                    direction = -1  # 右に壁があれば左向き
-                elif has_platform_left:
-                    direction = 1  # 左に壁があれば右向き
-                # (左右に壁がない場合、x=0 (左端) なら direction = 1 (デフォルト) のままで正しい)
-
-                al = ArrowLauncher(world_x, world_y, direction)
-                arrow_launchers.add(al)
-                all_sprites.add(al)
-            # ▲▲▲ ★★★ 'A' の修正ブロックここまで ★▲▲▲
-
-            elif char == "K":  # Key
-                k = Key(world_x, world_y)
-                keys.add(k)
-                all_sprites.add(k)
-            elif char == "D":  # Door
-                d = Door(world_x, world_y)
-                doors.add(d)
-                all_sprites.add(d)
-            elif char == "@":  # Player
-                player_x = world_x + (TILE_SIZE - 30) // 2
-                player_y = world_y + (TILE_SIZE - 30)
-                start_pos = (player_x, player_y)
-                player = Player(player_x, player_y)
+    def query_mask(self, sprite):
+        """sprite とマスクが重なるメンバーのリストを返す (マスク判定は候補にだけ行う)"""
+        return [
+            other
+            for other in self.query(sprite.rect)
+            if pygame.sprite.collide_mask(sprite, other)
+        ]
 
-    if player is None:
-        # タイトル画面から開始するため、ここではエラーを出さず None のまま返す
-        pass 
-        # print("エラー: プレイヤー(@)がマップにいません！")
-        # sys.exit()
 
-    # setup_level() はタイトル画面からは呼ばれないため、playerがNoneである可能性を考慮
+# -----------------------------------------------------------------
+# ▲▲▲ ブロードフェーズ ここまで ▲▲▲
+# -----------------------------------------------------------------
 
-    return (
-        player,
-        start_pos,
-        all_sprites,
-        platforms,
-        spikes,
-        keys,
-        doors,
-        gravity_switchers,
-        booster_platforms,
-        falling_spikes,
-        patrolling_spikes,
-        arrow_launchers,
-    )
 
+# -----------------------------------------------------------------
+# ▼▼▼ トリガーゾーン (プレイヤーが入ると一度だけ発動する領域) ▼▼▼
+# -----------------------------------------------------------------
+class TriggerZone(pygame.sprite.Sprite):
+    """プレイヤーの基準点 (anchor) が rect の中に入ると発動する領域
 
-class Arrow(pygame.sprite.Sprite):
-    """★ 弓矢（飛んでくる障害物）"""
+    anchor は pygame.Rect の点の属性名 ("midtop" など)。target には発動したときに
+    動かす仕掛け (落下トゲなど) を入れ、実際の処理は GameSim.on_trigger が行う。
+    """
 
-    def __init__(self, x, y, direction):
+    def __init__(self, rect, anchor, target):
         super().__init__()
-        self.image = pygame.Surface((30, 8))
-        self.image.fill(ARROW_COLOR)
-        self.rect = self.image.get_rect(topleft=(x, y))
-        self.direction = direction
-        self.speed = 5
-
-        # ★ 弓矢にもマスクを追加（トゲと同様の理由）
-        self.mask = pygame.mask.from_surface(self.image)
-
-    # ▼▼▼ ★★★ 修正後の update メソッド ★★★ ▼▼▼
-    def update(self, *args):  # ★ 引数を *args に変更 (カメラ座標を渡さない)
-        self.rect.x += self.speed * self.direction
+        self.rect = pygame.Rect(rect)
+        self.anchor = anchor
+        self.target = target
 
-        # 画面外での自動消滅ロジックを「削除」
-        # これにより、プレイヤーが遠くにいても矢は壁に当たるまで飛び続けます。
-        # (壁に当たった時の消滅は main ループの groupcollide で処理されます)
+    def contains(self, player_rect):
+        return self.rect.collidepoint(getattr(player_rect, self.anchor))
 
-    # ▲▲▲ ★★★ 修正ここまで ★▲▲▲
 
+class TriggerZoneGroup(SpatialGridGroup):
+    """トリガーゾーンの索引。毎ティック、プレイヤーの下のセルだけを調べる"""
 
-class ArrowLauncher(pygame.sprite.Sprite):
-    """★ 弓矢の発射台 (自動発射機能付き)"""
+    def fire(self, player_rect):
+        """プレイヤーが入ったゾーンを取り除いて返す (1つのゾーンは一度だけ発動する)"""
+        # right / bottom 側の基準点も拾えるよう、1px 広げて検索する
+        search_rect = player_rect.inflate(1, 1)
+        search_rect.topleft = player_rect.topleft
+        fired = [zone for zone in self.query(search_rect) if zone.contains(player_rect)]
+        for zone in fired:
+            zone.kill()
+        return fired
 
-    def __init__(self, x, y, direction):
-        super().__init__()
-        self.image = pygame.Surface((20, 20))
-        self.image.fill(LAUNCHER_COLOR)
 
-        if direction == -1:
-            self.rect = self.image.get_rect(
-                topright=(x + TILE_SIZE, y + (TILE_SIZE // 2) - 10)
-            )
-        else:
-            self.rect = self.image.get_rect(topleft=(x, y + (TILE_SIZE // 2) - 10))
+# -----------------------------------------------------------------
+# ▲▲▲ トリガーゾーン ここまで ▲▲▲
+# -----------------------------------------------------------------
 
-        self.direction = direction
-        self.last_spawn_time = pygame.time.get_ticks() + random.randint(0, 500)
-        self.spawn_interval = random.randint(MIN_ARROW_INTERVAL, MAX_ARROW_INTERVAL)
 
-    def update(self):
-        # この関数はプレイヤーの位置に関係なく、時間だけで発射を決定します。
-        now = pygame.time.get_ticks()
-        if now - self.last_spawn_time > self.spawn_interval:
-            self.last_spawn_time = now
-            self.spawn_interval = random.randint(MIN_ARROW_INTERVAL, MAX_ARROW_INTERVAL)
+# -----------------------------------------------------------------
+# ▼▼▼ 静的レイヤー (動かないタイルの事前合成) ▼▼▼
+# -----------------------------------------------------------------
+class StaticLayer:
+    """動かないタイルを、重力の向きごとにチャンク画像へ一度だけ焼き込む
+
+    毎フレームはカメラに重なるチャンクだけを blit するので、
+    描画コストは画面に見えている範囲だけで決まる。
+    """
+
+    def __init__(self, sprites, level_width, level_height, tile_map=None,
+                 chunk_size=STATIC_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.level_width = level_width
+        self.level_height = level_height
+        # 重力の向き -> {(チャンクX, チャンクY): Surface}
+        self.chunks = {"DOWN": {}, "UP": {}}
+
+        # 足場はタイルマップの配列から (上面 / 下面の画像を重力の向きで使い分ける)
+        if tile_map is not None:
+            level_rect = pygame.Rect(0, 0, level_width, level_height)
+            for x, y, (side, top, bottom) in tile_map.images_in(level_rect):
+                rect = pygame.Rect(x, y, TILE_SIZE, TILE_SIZE)
+                self.bake(self.chunks["DOWN"], rect, top)
+                self.bake(self.chunks["UP"], rect, bottom)
+
+        for sprite in sprites:
+            for layer in self.chunks.values():
+                self.bake(layer, sprite.rect, sprite.image)
+
+        # 表示用のピクセル形式に変換しておく (ディスプレイがある場合のみ)
+        if pygame.display.get_surface() is not None:
+            for layer in self.chunks.values():
+                for cell, chunk in layer.items():
+                    layer[cell] = chunk.convert()
+
+    @staticmethod
+    def is_static(sprite):
+        """静的レイヤーに焼き込める (動かない・消えない) スプライトか"""
+        return isinstance(sprite, (ArrowLauncher, Door)) or type(sprite) is Spike
+
+    def new_chunk(self, cx, cy):
+        size = self.chunk_size
+        width = max(1, min(size, self.level_width - cx * size))
+        height = max(1, min(size, self.level_height - cy * size))
+        chunk = pygame.Surface((width, height))
+        chunk.fill(STATIC_LAYER_COLORKEY)
+        chunk.set_colorkey(STATIC_LAYER_COLORKEY, pygame.RLEACCEL)
+        return chunk
+
+    def bake(self, layer, rect, image):
+        size = self.chunk_size
+        for cy in range(rect.top // size, (rect.bottom - 1) // size + 1):
+            for cx in range(rect.left // size, (rect.right - 1) // size + 1):
+                chunk = layer.get((cx, cy))
+                if chunk is None:
+                    chunk = layer[(cx, cy)] = self.new_chunk(cx, cy)
+                chunk.blit(image, (rect.x - cx * size, rect.y - cy * size))
+
+    def draw(self, surface, camera_x, camera_y, gravity):
+        """カメラに重なるチャンクだけを surface に描画する"""
+        size = self.chunk_size
+        layer = self.chunks[gravity]
+        view_w, view_h = surface.get_size()
+        for cy in range(camera_y // size, (camera_y + view_h - 1) // size + 1):
+            for cx in range(camera_x // size, (camera_x + view_w - 1) // size + 1):
+                chunk = layer.get((cx, cy))
+                if chunk is not None:
+                    surface.blit(chunk, (cx * size - camera_x, cy * size - camera_y))
+
+    def close(self):
+        """(LevelStreamer と同じように終了時に呼べるように。何もしない)"""
 
-            if self.direction == 1:  # 右向き
-                spawn_x = self.rect.right + 1
-                spawn_y = self.rect.centery - 4
-            else:  # 左向き
-                spawn_x = self.rect.left - 31
-                spawn_y = self.rect.centery - 4
 
-            return Arrow(spawn_x, spawn_y, self.direction)
-        return None
+# -----------------------------------------------------------------
+# ▲▲▲ 静的レイヤー ここまで ▲▲▲
+# -----------------------------------------------------------------
 
 
 # -----------------------------------------------------------------
-# ▼▼▼ FallingSpike クラス全体 (4方向 / 重力反転対応) ▼▼▼
+# ▼▼▼ 静的レイヤーのストリーミング (大きなマップのチャンク読み込み) ▼▼▼
 # -----------------------------------------------------------------
-class FallingSpike(Spike):
-    """プレイヤーが近づくと落ちてくるトゲ"""
-
-    def __init__(self, x, y, orientation="DOWN"):
-        # 1. 親クラス(Spike) の init を呼び出し、rect と image を 40x20, 20x40 などに設定
-        super().__init__(x, y, orientation)
+class LevelStreamer:
+    """静的レイヤーのチャンク画像を、カメラの近くの分だけ作って持つ
+
+    StaticLayer と同じ draw() で使える。画面に重なるチャンクはその場で作り、
+    1チャンク外側はワーカースレッドで先読みし、2チャンクより遠いものは捨てる。
+    マップ全体を焼き込まないので、起動が速くメモリも画面の広さで決まる。
+    (当たり判定は TileMap が受け持つので、ここで作るのは画像だけ)
+    """
+
+    def __init__(self, tile_map, sprites, chunk_tiles=STREAM_CHUNK_TILES):
+        self.tile_map = tile_map
+        self.chunk_size = chunk_tiles * TILE_SIZE
+        self.chunks_x = -(-tile_map.width // chunk_tiles)
+        self.chunks_y = -(-tile_map.height // chunk_tiles)
+        self.level_rect = pygame.Rect(
+            0, 0, tile_map.width * TILE_SIZE, tile_map.height * TILE_SIZE
+        )
+        # 足場以外の動かない物 (トゲ・発射台・トビラ) を探すための索引
+        self.sprites = SpatialGridGroup(sprites, cell_size=self.chunk_size)
 
-        # 2. float 座標と start_x/y を、補正後の rect に合わせる
-        self.true_x = float(self.rect.x)
-        self.true_y = float(self.rect.y)
-        self.start_x = self.rect.x
-        self.start_y = self.rect.y
+        self.loaded = {}  # (チャンクX, チャンクY) -> {重力: Surface}
+        self.pending = {}  # (チャンクX, チャンクY) -> 先読み中の Future
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="level-stream"
+        )
 
-        # 3. 物理プロパティを初期化
-        self.vel_x = 0
-        self.vel_y = 0
-        self.is_active = False
+    def chunk_range(self, rect):
+        """rect に重なるチャンクの範囲 (マップの外は含めない)"""
+        size = self.chunk_size
+        x0 = max(0, rect.left // size)
+        y0 = max(0, rect.top // size)
+        x1 = min(self.chunks_x - 1, (rect.right - 1) // size)
+        y1 = min(self.chunks_y - 1, (rect.bottom - 1) // size)
+        return x0, y0, x1, y1
+
+    def cells_in(self, rect):
+        x0, y0, x1, y1 = self.chunk_range(rect)
+        return [(cx, cy) for cy in range(y0, y1 + 1) for cx in range(x0, x1 + 1)]
+
+    def build_chunk(self, cx, cy):
+        """チャンクの画像を重力の向きごとに作る (ワーカースレッドからも呼ぶ)"""
+        size = self.chunk_size
+        area = pygame.Rect(cx * size, cy * size, size, size).clip(self.level_rect)
+        images = {}
+        for gravity, image_index in (("DOWN", 1), ("UP", 2)):  # 上面 / 下面
+            image = pygame.Surface(area.size)
+            image.fill(STATIC_LAYER_COLORKEY)
+            for x, y, tile_images in self.tile_map.images_in(area):
+                image.blit(tile_images[image_index], (x - area.x, y - area.y))
+            for sprite in self.sprites.query(area):
+                image.blit(sprite.image, (sprite.rect.x - area.x, sprite.rect.y - area.y))
+            images[gravity] = image
+        return images
+
+    def attach(self, cell, images):
+        """作り終わったチャンクを表示用に変換して登録する (メインスレッドで呼ぶ)"""
+        for gravity, image in images.items():
+            if pygame.display.get_surface() is not None:
+                image = image.convert()
+            image.set_colorkey(STATIC_LAYER_COLORKEY, pygame.RLEACCEL)
+            images[gravity] = image
+        self.loaded[cell] = images
+
+    def update(self, view):
+        """view に重なるチャンクを用意し、その周りを先読みし、遠いチャンクを捨てる"""
+        # 1. 先読みが終わったチャンクを取り込む
+        for cell, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[cell]
+                self.attach(cell, future.result())
+
+        # 2. 画面に写るチャンク: まだなければ待つか、ここで作る
+        for cell in self.cells_in(view):
+            if cell in self.loaded:
+                continue
+            future = self.pending.pop(cell, None)
+            if future is not None and not future.cancel():
+                images = future.result()  # (ワーカーが作っている途中なので待つ)
+            else:
+                images = self.build_chunk(*cell)
+            self.attach(cell, images)
+
+        # 3. 1チャンク外側を先読みする
+        size = self.chunk_size
+        for cell in self.cells_in(view.inflate(size * 2, size * 2)):
+            if cell not in self.loaded and cell not in self.pending:
+                self.pending[cell] = self.executor.submit(self.build_chunk, *cell)
+
+        # 4. 2チャンクより遠いものを捨てる
+        x0, y0, x1, y1 = self.chunk_range(view.inflate(size * 4, size * 4))
+        for cells in (self.loaded, self.pending):
+            for cell in list(cells):
+                cx, cy = cell
+                if not (x0 <= cx <= x1 and y0 <= cy <= y1):
+                    chunk = cells.pop(cell)
+                    if cells is self.pending:
+                        chunk.cancel()
+
+    def draw(self, surface, camera_x, camera_y, gravity):
+        """カメラに重なるチャンクを描画する (StaticLayer.draw と同じ使い方)"""
+        view = pygame.Rect(camera_x, camera_y, *surface.get_size())
+        self.update(view)
+        size = self.chunk_size
+        for cx, cy in self.cells_in(view):
+            image = self.loaded[(cx, cy)][gravity]
+            surface.blit(image, (cx * size - camera_x, cy * size - camera_y))
+
+    def close(self):
+        """先読みを止めてワーカースレッドを終わらせる"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.pending.clear()
 
-    def update(self, platforms, current_gravity):
 
-        if self.is_active:
+# -----------------------------------------------------------------
+# ▲▲▲ 静的レイヤーのストリーミング ここまで ▲▲▲
+# -----------------------------------------------------------------
 
-            # --- 1. 速度更新 (向きと重力に応じる) ---
-            self.vel_x = 0  # 基本は X 速度ゼロ
 
-            is_gravity_down = current_gravity == "DOWN"
+# --- リトライ用のスナップショット ---
+class LevelSnapshot:
+    """ステージ構築直後に、各スプライトがどのグループに属していたかを記録する
 
-            # (A) 天井トゲ (orientation == "DOWN")
-            if self.orientation == "DOWN":
-                if is_gravity_down:
-                    # 通常時: 天井トゲは「落ちる」
-                    self.vel_y += GRAVITY
-                    if self.vel_y > 10:
-                        self.vel_y = 10
-                else:
-                    # 反転時: 天井トゲは「飛ぶ」 (上へ)
-                    self.vel_y -= GRAVITY * 1.5
-                    if self.vel_y < -10:
-                        self.vel_y = -10
+    restore() で kill() されたスプライトを元のグループに戻すので、
+    マップの解析や画像の生成をやり直さずにステージを初期状態へ戻せる。
+    """
 
-            # (B) 床トゲ (orientation == "UP")
-            elif self.orientation == "UP":
-                if is_gravity_down:
-                    # 通常時: 床トゲは「下」に飛ぶ
-                    self.vel_y += GRAVITY
-                    if self.vel_y > 10:
-                        self.vel_y = 10
-                else:
-                    # 反転時: 床トゲは「上」に落ちる
-                    self.vel_y -= GRAVITY * 1.5
-                    if self.vel_y < -10:
-                        self.vel_y = -10
+    def __init__(self, sprites):
+        self.memberships = [(sprite, tuple(sprite.groups())) for sprite in sprites]
 
-            # (C) 横向きのトゲ (重力の影響も受ける)
-            elif self.orientation == "RIGHT":
-                # 「左壁トゲ」は右に飛ぶ
-                self.vel_x = 5  # 速度 5 (固定)
-                if current_gravity == "DOWN":
-                    self.vel_y += GRAVITY
-                elif current_gravity == "UP":
-                    self.vel_y -= GRAVITY
+    def restore(self):
+        for sprite, groups in self.memberships:
+            sprite.add(*groups)  # (既に属しているグループは何もしない)
 
-            elif self.orientation == "LEFT":
-                # 「右壁トゲ」は左に飛ぶ
-                self.vel_x = -5  # 速度 -5 (固定)
-                if current_gravity == "DOWN":
-                    self.vel_y += GRAVITY
-                elif current_gravity == "UP":
-                    self.vel_y -= GRAVITY
 
-            # --- 2. X軸（横）の移動と衝突判定 ---
+# -----------------------------------------------------------------
+# ▼▼▼ ステージファイル (テキスト → コンパイル済みキャッシュ) ▼▼▼
+# -----------------------------------------------------------------
+PLATFORM_CHARS = "PBVYCORLE"  # 足場の文字 (トゲや発射台の向きの判定にも使う)
+PLATFORM_CODES = frozenset(PLATFORM_CHARS.encode("ascii"))
+OBJECT_CHARS = "GSFMAKD@"  # 足場以外の物の文字
+
+# 上下左右に足場があるかのビット (CompiledLevel.masks)
+NEIGHBOR_UP = 1
+NEIGHBOR_DOWN = 2
+NEIGHBOR_LEFT = 4
+NEIGHBOR_RIGHT = 8
+
+SPIKE_ORIENTATIONS = ("UP", "DOWN", "LEFT", "RIGHT")  # キャッシュにはこの番号で入れる
+
+LEVEL_CACHE_MAGIC = b"MXLV"
+LEVEL_CACHE_VERSION = 2
+# マジック, バージョン, 横のマス数, 縦のマス数, 物の数, 元テキストの SHA-256
+LEVEL_CACHE_HEADER = struct.Struct("<4sHIII32s")
+LEVEL_CACHE_OBJECT = struct.Struct("<BBII")  # 文字コード, パラメータ, マスX, マスY
+# 到達判定の結果 (物のあとに置く): 判定したか, カギ, トビラ, 探索した状態の数, 届かない場所の数
+LEVEL_CACHE_ANALYSIS = struct.Struct("<BBBII")
+LEVEL_CACHE_UNREACHABLE = struct.Struct("<IIIII")  # マスX, マスY, 横, 縦, マスの数
+
+
+class CompiledLevel:
+    """setup_level がそのまま使える形に変換したステージ
+
+    tiles   : 各マスの文字コード (横 width x 縦 height を行ごとに並べたバイト列)
+    masks   : 各マスの上下左右に足場があるか (NEIGHBOR_* のビット)
+    objects : 足場以外の物 [(文字, パラメータ, マスX, マスY), ...]
+              パラメータはトゲの向き (SPIKE_ORIENTATIONS の番号)、
+              発射台の向き (0: 左向き, 1: 右向き)
+    analysis: analyze_level() の結果 (まだ調べていなければ None。キャッシュにも入る)
+    """
+
+    def __init__(
+        self, width, height, tiles, masks, objects, source_hash=bytes(32), analysis=None
+    ):
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+        self.masks = masks
+        self.objects = objects
+        self.source_hash = source_hash
+        self.analysis = analysis
+
+    @property
+    def rows(self):
+        """LEVEL_MAP と同じ文字列のリストに戻す (リプレイのチェックサム用)"""
+        width = self.width
+        return [
+            bytes(self.tiles[y * width : (y + 1) * width]).decode("ascii")
+            for y in range(self.height)
+        ]
+
+
+def compile_level(level_map, source_hash=bytes(32)):
+    """文字列のリストのマップを CompiledLevel に変換する (隣接判定もここで1回だけ行う)"""
+    height = len(level_map)
+    width = max((len(row) for row in level_map), default=0)
+    size = width * height
+
+    # 1. 各マスの文字 (短い行は空白で埋める)
+    tiles = bytearray(b" " * size)
+    for y, row in enumerate(level_map):
+        tiles[y * width : y * width + len(row)] = row.encode("ascii")
+
+    # 2. 足場のマスから見て、上下左右のマスに「隣に足場がある」ビットを立てる
+    masks = bytearray(size)
+    for index, code in enumerate(tiles):
+        if code not in PLATFORM_CODES:
+            continue
+        x = index % width
+        if index >= width:
+            masks[index - width] |= NEIGHBOR_DOWN  # 上のマスから見ると下に足場
+        if index + width < size:
+            masks[index + width] |= NEIGHBOR_UP
+        if x > 0:
+            masks[index - 1] |= NEIGHBOR_RIGHT
+        if x < width - 1:
+            masks[index + 1] |= NEIGHBOR_LEFT
+
+    # 3. 足場以外の物と、その向き
+    objects = []
+    for index, code in enumerate(tiles):
+        char = chr(code)
+        if char not in OBJECT_CHARS:
+            continue
+        mask = masks[index]
+        param = 0
+        if char in "SFM":
+            # トゲの向き (優先順位: ★下 -> 上 -> 右 -> 左★、足場がなければ上向き)
+            if mask & NEIGHBOR_DOWN:
+                orientation = "UP"
+            elif mask & NEIGHBOR_UP:
+                orientation = "DOWN"
+            elif mask & NEIGHBOR_RIGHT:
+                orientation = "LEFT"  # 右に壁があるので、トゲは左を向く
+            elif mask & NEIGHBOR_LEFT:
+                orientation = "RIGHT"  # 左に壁があるので、トゲは右を向く
+            else:
+                orientation = "UP"
+            param = SPIKE_ORIENTATIONS.index(orientation)
+        elif char == "A":
+            # 右に壁があれば左向き、それ以外は右向き
+            param = 0 if mask & NEIGHBOR_RIGHT else 1
+        y, x = divmod(index, width)
+        objects.append((char, param, x, y))
+
+    return CompiledLevel(width, height, tiles, masks, objects, source_hash)
+
+
+def parse_level_text(text):
+    """ステージのテキストを行のリストにする ('#' で始まる行はコメント)"""
+    rows = [line for line in text.splitlines() if not line.startswith("#")]
+    while rows and not rows[-1].strip():
+        rows.pop()  # 末尾の空行は無視する
+    return rows
+
+
+def level_cache_path(path, cache_dir=LEVEL_CACHE_DIR):
+    """ステージファイルのキャッシュの場所
+
+    別のフォルダにある同じ名前のステージがぶつからないよう、絶対パスのハッシュを
+    ファイル名に含める (名前も残して、どのステージのキャッシュかわかるようにする)
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    key = hashlib.sha256(os.path.abspath(path).encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(cache_dir, f"{name}-{key[:16]}.mxl")
+
+
+def write_level_cache(level, path):
+    """CompiledLevel をバイナリのキャッシュファイルに書き出す (到達判定の結果も入れる)"""
+    analysis = analyze_level(level)
+    header = LEVEL_CACHE_HEADER.pack(
+        LEVEL_CACHE_MAGIC,
+        LEVEL_CACHE_VERSION,
+        level.width,
+        level.height,
+        len(level.objects),
+        level.source_hash,
+    )
+    # ★ 一時ファイルはプロセスごとに別の名前にする
+    # (batch_runner のワーカーが同じステージを同時に書いても、互いの書きかけを壊さない)
+    with tempfile.NamedTemporaryFile(
+        "wb",
+        dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp",
+        delete=False,
+    ) as f:
+        temp_path = f.name
+        try:
+            f.write(header)
+            f.write(level.tiles)
+            f.write(level.masks)
+            for char, param, x, y in level.objects:
+                f.write(LEVEL_CACHE_OBJECT.pack(ord(char), param, x, y))
+            f.write(
+                LEVEL_CACHE_ANALYSIS.pack(
+                    analysis.checked,
+                    analysis.key_reachable,
+                    analysis.door_reachable,
+                    analysis.states,
+                    len(analysis.unreachable),
+                )
+            )
+            for area in analysis.unreachable:
+                f.write(LEVEL_CACHE_UNREACHABLE.pack(*area))
+        except BaseException:
+            f.close()
+            os.remove(temp_path)
+            raise
+    try:
+        os.replace(temp_path, path)  # 書きかけのキャッシュが読まれないように、最後に置き換える
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+
+def read_level_cache(path, source_hash):
+    """キャッシュを mmap で読み込む。古い・壊れている場合は None"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < LEVEL_CACHE_HEADER.size:
+            return None
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, width, height, count, cached_hash = LEVEL_CACHE_HEADER.unpack_from(data)
+    size = width * height
+    objects_start = LEVEL_CACHE_HEADER.size + size * 2
+    analysis_start = objects_start + count * LEVEL_CACHE_OBJECT.size
+    if (
+        magic != LEVEL_CACHE_MAGIC
+        or version != LEVEL_CACHE_VERSION
+        or cached_hash != source_hash
+        or len(data) < analysis_start + LEVEL_CACHE_ANALYSIS.size
+    ):
+        data.close()
+        return None
+    checked, key_reachable, door_reachable, states, unreachable_count = (
+        LEVEL_CACHE_ANALYSIS.unpack_from(data, analysis_start)
+    )
+    unreachable_start = analysis_start + LEVEL_CACHE_ANALYSIS.size
+    if len(data) != unreachable_start + unreachable_count * LEVEL_CACHE_UNREACHABLE.size:
+        data.close()
+        return None
+
+    # tiles と masks はコピーせず、mmap の一部をそのまま使う
+    view = memoryview(data)
+    tiles = view[LEVEL_CACHE_HEADER.size : LEVEL_CACHE_HEADER.size + size]
+    masks = view[LEVEL_CACHE_HEADER.size + size : objects_start]
+    objects = [
+        (chr(code), param, x, y)
+        for code, param, x, y in LEVEL_CACHE_OBJECT.iter_unpack(
+            view[objects_start:analysis_start]
+        )
+    ]
+    analysis = LevelAnalysis(
+        bool(key_reachable),
+        bool(door_reachable),
+        list(LEVEL_CACHE_UNREACHABLE.iter_unpack(view[unreachable_start:])),
+        states,
+        bool(checked),
+    )
+    return CompiledLevel(width, height, tiles, masks, objects, cached_hash, analysis)
+
+
+def load_level(path, cache_dir=LEVEL_CACHE_DIR):
+    """ステージのテキストファイルを読み込む
+
+    初回はテキストを解析してキャッシュに書き出し、2回目からは内容のハッシュが
+    一致するキャッシュを mmap で読むだけにする (テキストを書き換えると作り直す)。
+    到達判定 (analyze_level) の結果もキャッシュに入れるので、探索も初回だけで済む。
+    """
+    with open(path, "rb") as f:
+        source = f.read()
+    source_hash = hashlib.sha256(source).digest()
+    cache_path = level_cache_path(path, cache_dir)
+
+    try:
+        level = read_level_cache(cache_path, source_hash)
+    except OSError:
+        level = None  # キャッシュがまだない
+    if level is not None:
+        return level
+
+    level = compile_level(parse_level_text(source.decode("utf-8")), source_hash)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_level_cache(level, cache_path)
+    except OSError as e:
+        print(f"警告: ステージのキャッシュを保存できませんでした ({e})")
+    return level
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ ステージファイル ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
+# -----------------------------------------------------------------
+# ▼▼▼ タイルマップ (足場を配列で持つ当たり判定) ▼▼▼
+# -----------------------------------------------------------------
+# 足場の文字コード -> クラス
+PLATFORM_CLASSES = {
+    ord("P"): Platform,  # 'P' がマップにあってもエラーにならないよう、Platformクラスを生成
+    ord("V"): PurplePlatform,  # 紫色上面のプラットフォーム
+    ord("Y"): YellowPlatform,  # 黄色上面のプラットフォーム
+    ord("C"): CyanPlatform,  # 水色上面のプラットフォーム
+    ord("O"): OrangePlatform,  # オレンジ色上面のプラットフォーム
+    ord("R"): RedPlatform,  # 赤色上面のプラットフォーム (追加)
+    ord("L"): BluePlatform,  # 青色上面のプラットフォーム (追加)
+    ord("E"): GreenPlatform,  # 緑色上面のプラットフォーム (追加)
+    ord("B"): BoosterPlatform,  # Booster
+}
+
+
+BOOSTER_CODE = ord("B")
+
+# 足場以外の文字を 0 にする変換表 (bytes.translate 用)
+TILE_CODE_TABLE = bytes(code if code in PLATFORM_CODES else 0 for code in range(256))
+
+
+class TileMap:
+    """足場を、マスごとの種類コード (1バイト) と隣接フラグ (1バイト) の配列で持つ
+
+    当たり判定は rect が触れるマスを座標の計算で求めて調べるだけなので、
+    足場の数に関係なく O(触れたマスの数) で済む。足場ごとのスプライトは作らず、
+    描画 (draw / 静的レイヤー) も同じ配列からテクスチャキャッシュの画像を引く。
+    """
+
+    def __init__(self, level):
+        self.width = level.width
+        self.height = level.height
+        self.tiles = bytearray(bytes(level.tiles).translate(TILE_CODE_TABLE))
+        self.masks = bytes(level.masks)
+        self.solid_count = len(self.tiles) - self.tiles.count(0)
+
+    def __len__(self):
+        """足場のマスの数"""
+        return self.solid_count
+
+    def tile_range(self, rect):
+        """rect が触れるマスの範囲 (左, 右, 上, 下) をマップ内に切り詰めて返す (両端を含む)
+
+        (query と collides は毎ティック何度も呼ぶので、同じ計算を中に直接書いている)
+        """
+        x, y, w, h = rect
+        left = x // TILE_SIZE
+        right = (x + w - 1) // TILE_SIZE
+        top = y // TILE_SIZE
+        bottom = (y + h - 1) // TILE_SIZE
+        if left < 0:
+            left = 0
+        if top < 0:
+            top = 0
+        if right >= self.width:
+            right = self.width - 1
+        if bottom >= self.height:
+            bottom = self.height - 1
+        return left, right, top, bottom
+
+    def query(self, rect):
+        """rect と重なる足場のマスの Rect のリストを返す (上の行・左のマスから順に)"""
+        x, y, w, h = rect
+        left = x // TILE_SIZE
+        right = (x + w - 1) // TILE_SIZE
+        top = y // TILE_SIZE
+        bottom = (y + h - 1) // TILE_SIZE
+        if left < 0:
+            left = 0
+        if top < 0:
+            top = 0
+        width = self.width
+        if right >= width:
+            right = width - 1
+        if bottom >= self.height:
+            bottom = self.height - 1
+
+        tiles = self.tiles
+        Rect = pygame.Rect
+        hits = []
+        for ty in range(top, bottom + 1):
+            row = ty * width
+            for tx in range(left, right + 1):
+                if tiles[row + tx]:
+                    hits.append(Rect(tx * TILE_SIZE, ty * TILE_SIZE, TILE_SIZE, TILE_SIZE))
+        return hits
+
+    def collides(self, rect):
+        """rect が足場に重なっているか (Rect を作らないぶん query より速い)"""
+        x, y, w, h = rect
+        left = x // TILE_SIZE
+        right = (x + w - 1) // TILE_SIZE
+        top = y // TILE_SIZE
+        bottom = (y + h - 1) // TILE_SIZE
+        if left < 0:
+            left = 0
+        if top < 0:
+            top = 0
+        width = self.width
+        if right >= width:
+            right = width - 1
+        if bottom >= self.height:
+            bottom = self.height - 1
+
+        tiles = self.tiles
+        for ty in range(top, bottom + 1):
+            row = ty * width
+            for index in range(row + left, row + right + 1):
+                if tiles[index]:
+                    return True
+        return False
+
+    def codes(self, rect):
+        """rect と重なる足場のマスの種類コードのリストを返す"""
+        left, right, top, bottom = self.tile_range(rect)
+        tiles = self.tiles
+        width = self.width
+        found = []
+        for ty in range(top, bottom + 1):
+            start = ty * width
+            found.extend(code for code in tiles[start + left : start + right + 1] if code)
+        return found
+
+    def images_in(self, rect):
+        """rect に重なる足場のマスの (x, y, (側面, 上面, 下面)) を順に返す"""
+        left, right, top, bottom = self.tile_range(rect)
+        tiles = self.tiles
+        masks = self.masks
+        width = self.width
+        for ty in range(top, bottom + 1):
+            row = ty * width
+            for tx in range(left, right + 1):
+                code = tiles[row + tx]
+                if code:
+                    yield (
+                        tx * TILE_SIZE,
+                        ty * TILE_SIZE,
+                        PLATFORM_TEXTURES.get_tile(code, masks[row + tx], tx, ty),
+                    )
+
+    def draw(self, surface, camera_x, camera_y, gravity):
+        """カメラに写るマスだけを surface に描画する (静的レイヤーを使わないとき用)"""
+        view = pygame.Rect(camera_x, camera_y, *surface.get_size())
+        image_index = 1 if gravity == "DOWN" else 2  # 上面 / 下面
+        for x, y, images in self.images_in(view):
+            surface.blit(images[image_index], (x - camera_x, y - camera_y))
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ タイルマップ ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
+# -----------------------------------------------------------------
+# ▼▼▼ スイープ判定 (動く範囲をまとめて調べる当たり判定) ▼▼▼
+# -----------------------------------------------------------------
+class Contact:
+    """sweep() の結果 (1軸ぶん)
+
+    moved   : 実際に動けた量 (符号付き、ピクセル)
+    normal  : 接している足場の面の向き (-1 / 0 / 1)。動いた向きと逆になる
+              (右へ動いて壁に接したら -1、下へ落ちて床に接したら -1)
+    blocked : 足場に当たって、動こうとした量より手前で止まったか
+    codes   : 接している足場のマスの種類コード (normal が 0 なら空)
+    """
+
+    __slots__ = ("moved", "normal", "blocked", "codes")
+
+    def __init__(self, moved, normal=0, blocked=False, codes=()):
+        self.moved = moved
+        self.normal = normal
+        self.blocked = blocked
+        self.codes = codes
+
+
+def sweep(tile_map, rect, axis, distance, probe=1):
+    """rect を axis 方向 (0: X, 1: Y) に distance ピクセル動かしたときの Contact を返す
+
+    動く途中にある足場の列 (行) を手前から1回だけ調べ、最初に当たる面の手前で止める
+    ので、速くても薄い壁をすり抜けない。移動後に面に接しているか (接地・壁) も同時に
+    わかる。distance が 0 なら probe の向き (+1 / -1) に接しているかだけを調べる。
+    """
+    sign = 1 if distance > 0 else -1 if distance < 0 else probe
+    steps = abs(distance)
+    width = tile_map.width
+    if axis == 0:
+        start, end, cross_start, cross_end = rect.left, rect.right, rect.top, rect.bottom
+        lines, cross_lines = width, tile_map.height
+        line_stride, cross_stride = 1, width
+    else:
+        start, end, cross_start, cross_end = rect.top, rect.bottom, rect.left, rect.right
+        lines, cross_lines = tile_map.height, width
+        line_stride, cross_stride = width, 1
+
+    # 進む向きと直交する方向に、rect が触れている行 (列) の範囲
+    cross_first = max(0, cross_start // TILE_SIZE)
+    cross_last = min(cross_lines - 1, (cross_end - 1) // TILE_SIZE)
+
+    # 進む向きに、先頭の面から distance 先のピクセルまでの列 (行) を手前から順に見る
+    if sign > 0:
+        lead = end
+        line_range = range(
+            max(0, lead // TILE_SIZE), min(lines - 1, (lead + steps) // TILE_SIZE) + 1
+        )
+    else:
+        lead = start
+        line_range = range(
+            min(lines - 1, (lead - 1) // TILE_SIZE),
+            max(0, (lead - steps - 1) // TILE_SIZE) - 1,
+            -1,
+        )
+
+    tiles = tile_map.tiles
+    for line in line_range:
+        base = line * line_stride
+        codes = [
+            code
+            for code in (
+                tiles[base + cross * cross_stride]
+                for cross in range(cross_first, cross_last + 1)
+            )
+            if code
+        ]
+        if codes:
+            face = line * TILE_SIZE if sign > 0 else (line + 1) * TILE_SIZE
+            gap = max(0, (face - lead) * sign)  # (最初から重なっていれば 0)
+            return Contact(gap * sign, -sign, gap < steps, codes)
+    return Contact(steps * sign)
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ スイープ判定 ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
+# -----------------------------------------------------------------
+# ▼▼▼ 到達可能性の解析 (@ -> カギ -> トビラ と進めるか) ▼▼▼
+# -----------------------------------------------------------------
+def rise_tiles(speed):
+    """初速 speed で重力と逆向きに跳んだとき、何マス先の足場まで届くか
+
+    頂点までの距離 v^2 / 2g を切り上げるので、実際より少しだけ甘い。
+    """
+    return math.ceil(speed * speed / (2 * GRAVITY) / TILE_SIZE)
+
+
+GROUND_JUMP_TILES = rise_tiles(-JUMP_STRENGTH)  # 地面からのジャンプ
+BOOSTER_JUMP_TILES = rise_tiles(-JUMP_STRENGTH * BOOSTER_JUMP_MULTIPLIER)  # ブースターから
+WALL_JUMP_TILES = rise_tiles(-WALL_JUMP_STRENGTH_Y)  # 壁キック
+RISE_BUDGETS = max(GROUND_JUMP_TILES, BOOSTER_JUMP_TILES, WALL_JUMP_TILES) + 1
+# これより多くのマスがあるステージは到達判定を省く (探索の時間とメモリを抑える)
+LEVEL_ANALYSIS_MAX_TILES = 1 << 20
+
+# プレイヤーが入れないマス (足場と、動かないトゲ) を 0 にする変換表
+OPEN_CELL_TABLE = bytes(
+    0 if code in PLATFORM_CODES or code == ord("S") else 1 for code in range(256)
+)
+
+
+class LevelAnalysis:
+    """analyze_level() の結果
+
+    探索は実際の操作より甘いので、わかるのは「確実に届かない」ことだけ。
+    届くと判定されても、本当にクリアできるとは限らない。
+    (同じ理由で、探索で見つかる経路は実際に通れるとは限らないので記録しない)
+
+    checked        : 判定したか (大きすぎるステージは調べずに通す)
+    key_reachable  : スタートからカギに届かないとは言い切れないか
+    door_reachable : カギを取ったあとトビラに届かないとは言い切れないか
+    unreachable    : どの状態でも入れなかった (確実に届かない) 空きマスのかたまり
+                     [(マスX, マスY, 横のマス数, 縦のマス数, マスの数), ...]
+    states         : 探索した状態の数
+    """
+
+    def __init__(self, key_reachable, door_reachable, unreachable, states, checked=True):
+        self.key_reachable = key_reachable
+        self.door_reachable = door_reachable
+        self.unreachable = unreachable
+        self.states = states
+        self.checked = checked
+
+    @property
+    def unclearable(self):
+        """確実にクリアできないか"""
+        return self.checked and not self.door_reachable
+
+    def report(self):
+        """結果を表示用の行のリストにする"""
+        if not self.checked:
+            lines = [
+                f"ステージが大きすぎるので到達判定を省きました "
+                f"(上限 {LEVEL_ANALYSIS_MAX_TILES} マス)"
+            ]
+        elif not self.unclearable:
+            lines = [
+                f"クリア不可とは判定されませんでした ({self.states} 状態を探索。"
+                "実際にクリアできるかは遊んで確かめてください)"
+            ]
+        elif not self.states:
+            lines = ["クリア不可: スタート地点 (@) がありません"]
+        elif self.key_reachable:
+            lines = ["クリア不可: カギを取ったあとトビラに届きません"]
+        else:
+            lines = ["クリア不可: スタートからカギに届きません"]
+        for x, y, w, h, count in self.unreachable:
+            lines.append(f"届かない場所: マス ({x},{y}) から {w}x{h} の範囲 ({count} マス)")
+        return lines
+
+
+def analyze_level(level_map):
+    """ステージの到達判定の結果 (LevelAnalysis) を返す
+
+    結果は CompiledLevel.analysis に覚えておき、load_level のキャッシュにも入るので、
+    同じステージを読み直したときは探索しない。マスが LEVEL_ANALYSIS_MAX_TILES より
+    多いステージは調べずに通す。
+    """
+    if isinstance(level_map, CompiledLevel):
+        level = level_map
+    else:
+        level = compile_level(level_map)
+    if level.analysis is None:
+        if level.width * level.height > LEVEL_ANALYSIS_MAX_TILES:
+            level.analysis = LevelAnalysis(True, True, [], 0, checked=False)
+        else:
+            level.analysis = search_reachability(level)
+    return level.analysis
+
+
+def search_reachability(level):
+    """ステージを移動グラフにして幅優先探索し、@ -> K -> D と確実に進めないかを調べる
+
+    状態は (マス, 重力の向き, カギを持っているか, あと何マス重力と逆へ進めるか)。
+    足場に立つ / 壁に触れると、物理定数から求めたジャンプの高さ (地面・ブースター・
+    壁キック) まで逆向きに進めるようになり、重力の向きと横へはいつでも進める
+    (空中で横に進める距離は数えない)。G のマスに入ると重力が反転する。
+    壁ずり落ちは落ちる速さが変わるだけなので、届く範囲には影響しない。
+    足場と動かないトゲ S のマスには入れず、落ちるトゲ・動くトゲ・矢はタイミングで
+    避けられるものとして無視する。
+
+    実際の操作より甘く判定する (空中で自由に横へ動ける、1枚の壁でも壁キックで
+    登れる、G を何度でも使える) ので、ここで届かない場所には本当に届かないが、
+    届くと判定された場所に本当に届くとは限らない。結果はステージをはじくことに
+    だけ使い、クリアできることの証明や攻略手順としては扱わない。
+    """
+    width = level.width
+    size = width * level.height
+    tiles = bytes(level.tiles)
+    masks = level.masks
+
+    # 1. マスごとの情報は探索の前に1回だけ計算しておく
+    open_cells = tiles.translate(OPEN_CELL_TABLE)
+    # (マス, 重力) ごとに、そこで回復する「逆向きに進めるマス数」 (0: 足場も壁もない)
+    refill = bytearray(size * 2)
+    for index in range(size):
+        if not open_cells[index]:
+            continue
+        mask = masks[index]
+        wall = WALL_JUMP_TILES if mask & (NEIGHBOR_LEFT | NEIGHBOR_RIGHT) else 0
+        for gravity, floor_bit, floor_index in (
+            (0, NEIGHBOR_DOWN, index + width),  # 下向き重力の床は下のマス
+            (1, NEIGHBOR_UP, index - width),  # 上向き重力の床は上のマス
+        ):
+            jump = wall
+            if mask & floor_bit:
+                if tiles[floor_index] == BOOSTER_CODE:
+                    jump = max(jump, BOOSTER_JUMP_TILES)
+                else:
+                    jump = max(jump, GROUND_JUMP_TILES)
+            refill[index * 2 + gravity] = jump
+
+    start = tiles.find(b"@")
+    keys = {i for i, code in enumerate(tiles) if code == ord("K")}
+    doors = {i for i, code in enumerate(tiles) if code == ord("D")}
+    switchers = {i for i, code in enumerate(tiles) if code == ord("G")}
+    if start < 0:
+        return LevelAnalysis(False, False, [], 0)
+
+    # 2. 幅優先探索 (訪問済みの状態はビット列で持つ)
+    # 状態番号 = ((マス * 2 + 重力) * 2 + カギ) * RISE_BUDGETS + 残り
+    visited = bytearray((size * 4 * RISE_BUDGETS + 7) // 8)
+    reached = bytearray(size)  # どれかの状態で入れたマス
+    queue = collections.deque()
+
+    def push(state):
+        if visited[state >> 3] & (1 << (state & 7)):
+            return
+        visited[state >> 3] |= 1 << (state & 7)
+        queue.append(state)
+
+    start_key = 1 if start in keys else 0
+    push(((start * 2) * 2 + start_key) * RISE_BUDGETS)
+    states = 0
+    door_reachable = False
+    key_reachable = bool(start_key)
+    while queue:
+        state = queue.popleft()
+        states += 1
+        rest, rise = divmod(state, RISE_BUDGETS)
+        rest, has_key = divmod(rest, 2)
+        index, gravity = divmod(rest, 2)
+        reached[index] = 1
+        if has_key and index in doors:
+            door_reachable = True
+
+        rise = max(rise, refill[index * 2 + gravity])
+        fall = width if gravity == 0 else -width
+        x = index % width
+        moves = [(index + fall, 0)]
+        if rise:
+            moves.append((index - fall, rise - 1))
+        if x > 0:
+            moves.append((index - 1, rise))
+        if x < width - 1:
+            moves.append((index + 1, rise))
+
+        for target, target_rise in moves:
+            if not 0 <= target < size or not open_cells[target]:
+                continue  # (ステージの外に出るのは落下ミス)
+            target_gravity = gravity
+            if target in switchers:
+                target_gravity = gravity ^ 1  # 重力が反転して、逆向きの勢いはなくなる
+                target_rise = 0
+            target_key = has_key
+            if target in keys:
+                target_key = 1
+                key_reachable = True
+            push(
+                ((target * 2 + target_gravity) * 2 + target_key) * RISE_BUDGETS
+                + target_rise
+            )
+
+    # 3. 届かない空きマスのかたまり
+    unreachable = []
+    seen = bytearray(reached)
+    for index in range(size):
+        if seen[index] or not open_cells[index]:
+            continue
+        stack = [index]
+        seen[index] = 1
+        cells = []
+        while stack:
+            cell = stack.pop()
+            cells.append(cell)
+            x = cell % width
+            for target in (
+                cell - width,
+                cell + width,
+                cell - 1 if x > 0 else -1,
+                cell + 1 if x < width - 1 else -1,
+            ):
+                if 0 <= target < size and not seen[target] and open_cells[target]:
+                    seen[target] = 1
+                    stack.append(target)
+        xs = [cell % width for cell in cells]
+        ys = [cell // width for cell in cells]
+        left, top = min(xs), min(ys)
+        unreachable.append(
+            (left, top, max(xs) - left + 1, max(ys) - top + 1, len(cells))
+        )
+
+    return LevelAnalysis(key_reachable, door_reachable, unreachable, states)
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ 到達可能性の解析 ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
+# --- ステージを構築する関数 ---
+def setup_level(level_map):
+    """ステージを構築する (level_map は文字列のリストか CompiledLevel)
+
+    足場はスプライトを作らず TileMap にまとめる。
+    """
+    if isinstance(level_map, CompiledLevel):
+        level = level_map
+    else:
+        level = compile_level(level_map)
+
+    all_sprites = pygame.sprite.Group()
+    tile_map = TileMap(level)  # 足場 (隣接の有無はコンパイル時に計算済み)
+    spikes = SpatialGridGroup()  # (動くトゲは動いたあとに relocate する)
+    keys = SpatialGridGroup()
+    doors = SpatialGridGroup()
+    gravity_switchers = SpatialGridGroup()
+
+    falling_spikes = pygame.sprite.Group()
+    patrolling_spikes = pygame.sprite.Group()
+    arrow_launchers = pygame.sprite.Group()
+    trigger_zones = TriggerZoneGroup()
+
+    player = None
+    start_pos = (0, 0)
+
+    # 足場以外の物 (トゲの向き・発射台の向きもコンパイル時に決定済み)
+    for char, param, x, y in level.objects:
+        world_x = x * TILE_SIZE
+        world_y = y * TILE_SIZE
+
+        if char == "G":  # GravitySwitcher
+            g = GravitySwitcher(world_x, world_y)
+            gravity_switchers.add(g)
+            all_sprites.add(g)
+
+        elif char == "S":  # Spike
+            s = Spike(world_x, world_y, SPIKE_ORIENTATIONS[param])
+            spikes.add(s)
+            all_sprites.add(s)
+
+        elif char == "F":  # FallingSpike
+            fs = FallingSpike(world_x, world_y, SPIKE_ORIENTATIONS[param])
+            spikes.add(fs)
+            falling_spikes.add(fs)
+            all_sprites.add(fs)
+            trigger_zones.add(fs.create_trigger_zone())
+
+        elif char == "M":  # PatrollingSpike
+            ps = PatrollingSpike(world_x, world_y, 80, 2, SPIKE_ORIENTATIONS[param])
+            spikes.add(ps)
+            patrolling_spikes.add(ps)
+            all_sprites.add(ps)
+
+        elif char == "A":  # ArrowLauncher (param 1: 右向き, 0: 左向き)
+            al = ArrowLauncher(world_x, world_y, 1 if param else -1)
+            arrow_launchers.add(al)
+            all_sprites.add(al)
+
+        elif char == "K":  # Key
+            k = Key(world_x, world_y)
+            keys.add(k)
+            all_sprites.add(k)
+        elif char == "D":  # Door
+            d = Door(world_x, world_y)
+            doors.add(d)
+            all_sprites.add(d)
+        elif char == "@":  # Player
+            player_x = world_x + (TILE_SIZE - 30) // 2
+            player_y = world_y + (TILE_SIZE - 30)
+            start_pos = (player_x, player_y)
+            player = Player(player_x, player_y)
+
+    if player is None:
+        # タイトル画面から開始するため、ここではエラーを出さず None のまま返す
+        pass 
+        # print("エラー: プレイヤー(@)がマップにいません！")
+        # sys.exit()
+
+    # setup_level() はタイトル画面からは呼ばれないため、playerがNoneである可能性を考慮
+
+    return (
+        player,
+        start_pos,
+        all_sprites,
+        tile_map,
+        spikes,
+        keys,
+        doors,
+        gravity_switchers,
+        falling_spikes,
+        patrolling_spikes,
+        arrow_launchers,
+        trigger_zones,
+    )
+
+
+class Arrow(pygame.sprite.Sprite):
+    """★ 弓矢（飛んでくる障害物）"""
+
+    SIZE = (30, 8)
+
+    def __init__(self, x, y, direction):
+        super().__init__()
+        # ★ 弓矢にもマスクを追加（トゲと同様の理由）。画像とマスクは全ての矢で共有
+        self.image, self.mask = SPRITE_ART.get("Arrow", self.create_image)
+        self.rect = self.image.get_rect()
+        self.speed = 5
+        self.launch(x, y, direction)
+
+    @classmethod
+    def create_image(cls):
+        image = pygame.Surface(cls.SIZE)
+        image.fill(ARROW_COLOR)
+        return image
+
+    def launch(self, x, y, direction):
+        """位置と向きを設定し直す (プールから再利用するとき)"""
+        self.rect.topleft = (x, y)
+        self.direction = direction
+        self.hit_wall = False
+
+    # ▼▼▼ ★★★ 修正後の update メソッド ★★★ ▼▼▼
+    def update(self, tile_map):  # ★ カメラ座標は渡さない
+        contact = sweep(tile_map, self.rect, 0, self.speed * self.direction)
+        self.rect.x += contact.moved
+        self.hit_wall = contact.blocked
+
+        # 画面外での自動消滅ロジックを「削除」
+        # これにより、プレイヤーが遠くにいても矢は壁に当たるまで飛び続けます。
+        # (hit_wall になった矢は GameSim がプールに戻します)
+
+    # ▲▲▲ ★★★ 修正ここまで ★▲▲▲
+
+
+class ArrowPool:
+    """★ 矢を使い回すためのプール
+
+    壁に当たった矢やマップの外に出た矢は release() でここに戻し、次の発射で
+    再利用する。同時に飛んでいる矢は max_live 本までに制限するので、長時間
+    遊んでも矢の数 (とメモリ) は増え続けない。
+    """
+
+    def __init__(self, live, *groups, max_live=MAX_LIVE_ARROWS):
+        self.live = live  # 飛んでいる矢のグループ
+        self.groups = (live,) + groups  # 発射した矢を入れるグループ (描画用など)
+        self.max_live = max_live
+        self.free = []  # 使い終わった矢
+
+    def acquire(self, x, y, direction):
+        """矢を1本発射する。上限に達しているときは None"""
+        if len(self.live) >= self.max_live:
+            return None
+        if self.free:
+            arrow = self.free.pop()
+            arrow.launch(x, y, direction)
+        else:
+            arrow = Arrow(x, y, direction)
+        arrow.add(*self.groups)
+        return arrow
+
+    def release(self, arrow):
+        """矢を全グループから外してプールに戻す"""
+        if arrow.alive():
+            arrow.kill()
+            self.free.append(arrow)
+
+    def release_all(self):
+        for arrow in self.live.sprites():
+            self.release(arrow)
+
+
+class ArrowLauncher(pygame.sprite.Sprite):
+    """★ 弓矢の発射台 (自動発射機能付き)"""
+
+    def __init__(self, x, y, direction):
+        super().__init__()
+        self.image, self.mask = SPRITE_ART.get("ArrowLauncher", self.create_image)
+
+        if direction == -1:
+            self.rect = self.image.get_rect(
+                topright=(x + TILE_SIZE, y + (TILE_SIZE // 2) - 10)
+            )
+        else:
+            self.rect = self.image.get_rect(topleft=(x, y + (TILE_SIZE // 2) - 10))
+
+        self.direction = direction
+        self.reset_timer(random)
+
+    @staticmethod
+    def create_image():
+        image = pygame.Surface((20, 20))
+        image.fill(LAUNCHER_COLOR)
+        return image
+
+    def reset_timer(self, rng, tick=0):
+        """発射タイマーを初期状態に戻す (リトライ用)
+
+        rng には GameSim のシード付き乱数を渡す (リプレイで同じ間隔になるように)
+        """
+        self.last_spawn_tick = tick + ms_to_ticks(rng.randint(0, 500))
+        self.spawn_interval = ms_to_ticks(
+            rng.randint(MIN_ARROW_INTERVAL, MAX_ARROW_INTERVAL)
+        )
+
+    def wake(self, tick):
+        """活動範囲に戻ったとき、眠っていた間の発射をまとめて撃たないよう周期を進める
+
+        乱数は使わないので、同じ入力なら同じティックに撃つ (リプレイが再現できる)
+        """
+        elapsed = tick - self.last_spawn_tick
+        if elapsed > self.spawn_interval:
+            self.last_spawn_tick += elapsed // self.spawn_interval * self.spawn_interval
+
+    def update(self, tick, rng, pool):
+        """発射のタイミングなら pool から矢を取り出して返す"""
+        # この関数はプレイヤーの位置に関係なく、ティック数だけで発射を決定します。
+        if tick - self.last_spawn_tick > self.spawn_interval:
+            self.last_spawn_tick = tick
+            self.spawn_interval = ms_to_ticks(
+                rng.randint(MIN_ARROW_INTERVAL, MAX_ARROW_INTERVAL)
+            )
+
+            if self.direction == 1:  # 右向き
+                spawn_x = self.rect.right + 1
+                spawn_y = self.rect.centery - 4
+            else:  # 左向き
+                spawn_x = self.rect.left - 31
+                spawn_y = self.rect.centery - 4
+
+            # 同時に飛んでいる矢が上限のときは発射しない (None が返る)
+            return pool.acquire(spawn_x, spawn_y, self.direction)
+        return None
+
+
+# -----------------------------------------------------------------
+# ▼▼▼ FallingSpike クラス全体 (4方向 / 重力反転対応) ▼▼▼
+# -----------------------------------------------------------------
+class FallingSpike(Spike):
+    """プレイヤーが近づくと落ちてくるトゲ"""
+
+    def __init__(self, x, y, orientation="DOWN"):
+        # 1. 親クラス(Spike) の init を呼び出し、rect と image を 40x20, 20x40 などに設定
+        super().__init__(x, y, orientation)
+
+        # 2. float 座標と start_x/y を、補正後の rect に合わせる
+        self.true_x = float(self.rect.x)
+        self.true_y = float(self.rect.y)
+        self.start_x = self.rect.x
+        self.start_y = self.rect.y
+
+        # 3. 物理プロパティを初期化
+        self.vel_x = 0
+        self.vel_y = 0
+        self.is_active = False
+
+    # プレイヤーがトゲの正面 (横ずれ 50px 未満、距離 200px 未満) に来たら落とす
+    TRIGGER_HALF_WIDTH = 50
+    TRIGGER_DISTANCE = 200
+
+    def create_trigger_zone(self):
+        """落下を始める範囲を TriggerZone にする (ステージ構築時に一度だけ)
+
+        判定はすべて「<」「>」なので、範囲の両端は含まない
+        (pygame.Rect.collidepoint は右端・下端を含まないので、左端・上端を 1px ずらす)
+        """
+        half = self.TRIGGER_HALF_WIDTH
+        distance = self.TRIGGER_DISTANCE
+        rect = self.rect
+        if self.orientation == "DOWN":
+            # プレイヤーが「下」にいる (プレイヤーの上辺の中央で判定)
+            zone = (rect.centerx - half + 1, rect.bottom + 1, 2 * half - 1, distance - 1)
+            anchor = "midtop"
+        elif self.orientation == "UP":
+            # プレイヤーが「上」にいる (下辺の中央)
+            zone = (
+                rect.centerx - half + 1, rect.top - distance + 1, 2 * half - 1, distance - 1
+            )
+            anchor = "midbottom"
+        elif self.orientation == "LEFT":
+            # プレイヤーが「左」にいる (右辺の中央)
+            zone = (
+                rect.left - distance + 1, rect.centery - half + 1, distance - 1, 2 * half - 1
+            )
+            anchor = "midright"
+        else:
+            # プレイヤーが「右」にいる (左辺の中央)
+            zone = (rect.right + 1, rect.centery - half + 1, distance - 1, 2 * half - 1)
+            anchor = "midleft"
+        return TriggerZone(zone, anchor, self)
+
+    def update(self, tile_map, current_gravity):
+
+        if self.is_active:
+
+            # --- 1. 速度更新 (向きと重力に応じる) ---
+            self.vel_x = 0  # 基本は X 速度ゼロ
+
+            is_gravity_down = current_gravity == "DOWN"
+
+            # (A) 天井トゲ (orientation == "DOWN")
+            if self.orientation == "DOWN":
+                if is_gravity_down:
+                    # 通常時: 天井トゲは「落ちる」
+                    self.vel_y += GRAVITY
+                    if self.vel_y > 10:
+                        self.vel_y = 10
+                else:
+                    # 反転時: 天井トゲは「飛ぶ」 (上へ)
+                    self.vel_y -= GRAVITY * 1.5
+                    if self.vel_y < -10:
+                        self.vel_y = -10
+
+            # (B) 床トゲ (orientation == "UP")
+            elif self.orientation == "UP":
+                if is_gravity_down:
+                    # 通常時: 床トゲは「下」に飛ぶ
+                    self.vel_y += GRAVITY
+                    if self.vel_y > 10:
+                        self.vel_y = 10
+                else:
+                    # 反転時: 床トゲは「上」に落ちる
+                    self.vel_y -= GRAVITY * 1.5
+                    if self.vel_y < -10:
+                        self.vel_y = -10
+
+            # (C) 横向きのトゲ (重力の影響も受ける)
+            elif self.orientation == "RIGHT":
+                # 「左壁トゲ」は右に飛ぶ
+                self.vel_x = 5  # 速度 5 (固定)
+                if current_gravity == "DOWN":
+                    self.vel_y += GRAVITY
+                elif current_gravity == "UP":
+                    self.vel_y -= GRAVITY
+
+            elif self.orientation == "LEFT":
+                # 「右壁トゲ」は左に飛ぶ
+                self.vel_x = -5  # 速度 -5 (固定)
+                if current_gravity == "DOWN":
+                    self.vel_y += GRAVITY
+                elif current_gravity == "UP":
+                    self.vel_y -= GRAVITY
+
+            # --- 2. X軸（横）の移動と衝突判定 (スイープ) ---
             if self.vel_x != 0:
                 self.true_x += self.vel_x
-                self.rect.x = int(self.true_x)
+                contact_x = sweep(tile_map, self.rect, 0, int(self.true_x) - self.rect.x)
+                self.rect.x += contact_x.moved
 
-                hit_list_x = pygame.sprite.spritecollide(self, platforms, False)
-                if hit_list_x:
+                if contact_x.blocked:
                     self.kill()  # 壁に当たったら消える
                     return  # update を終了
 
-            # --- 3. Y軸（縦）の移動と衝突判定 ---
-            remaining_y = self.vel_y
-            sign = 1 if remaining_y > 0 else -1
-            # (Y軸貫通対策)
-            max_step_size = self.rect.height - 1
-            if max_step_size <= 0:
-                max_step_size = 1  # ゼロ除算回避
-
-            while abs(remaining_y) > 0.001:
-                step = min(abs(remaining_y), max_step_size) * sign
-                self.true_y += step
-                self.rect.y = int(self.true_y)
-
-                hit_list_y = pygame.sprite.spritecollide(self, platforms, False)
-
-                if hit_list_y:
-                    if current_gravity == "DOWN":
-                        if self.vel_y > 0:  # 着地
-                            best_platform = min(hit_list_y, key=lambda p: p.rect.top)
-                            self.rect.bottom = best_platform.rect.top
-                        elif self.vel_y < 0:  # 頭をぶつけた
-                            best_platform = max(hit_list_y, key=lambda p: p.rect.bottom)
-                            self.rect.top = best_platform.rect.bottom
-                    elif current_gravity == "UP":
-                        if self.vel_y < 0:  # 着地 (天井へ)
-                            best_platform = max(hit_list_y, key=lambda p: p.rect.bottom)
-                            self.rect.top = best_platform.rect.bottom
-                        elif self.vel_y > 0:  # 頭をぶつけた (床へ)
-                            best_platform = min(hit_list_y, key=lambda p: p.rect.top)
-                            self.rect.bottom = best_platform.rect.top
-
-                    self.true_y = float(self.rect.y)
-                    self.vel_y = 0
-                    remaining_y = 0.0
-
-                    self.kill()  # 床/天井に当たっても消える
-                    break
+            # --- 3. Y軸（縦）の移動と衝突判定 (スイープなので貫通しない) ---
+            self.true_y += self.vel_y
+            contact_y = sweep(tile_map, self.rect, 1, int(self.true_y) - self.rect.y)
+            self.rect.y += contact_y.moved
 
-                remaining_y -= step
+            if contact_y.blocked:
+                self.true_y = float(self.rect.y)
+                self.vel_y = 0
+                self.kill()  # 床/天井に当たっても消える
 
     def activate(self):
         if not self.is_active:  # (vel_y == 0 の条件を削除)
@@ -1344,8 +2619,8 @@ class FallingSpike(Spike):
         self.vel_x = 0
         self.vel_y = 0
         self.is_active = False
-        self.image = self.original_image.copy()
-        self.mask = pygame.mask.from_surface(self.image)
+        self.image = self.original_image  # (共有の画像とマスクに戻すだけ)
+        self.mask = self.original_mask
 
 
 # -----------------------------------------------------------------
@@ -1376,22 +2651,67 @@ class PatrollingSpike(Spike):
         self.original_speed = speed
         self.vel_y = 0  # (Y速度は常に0)
 
-    # ★★★ update メソッド ★★★
-    def update(self, platforms, current_gravity):
+        # 往復する範囲全体 (活動範囲の検索はこの矩形で行う。眠っている間も動かない)
+        left = min(self.start_x, self.rect.left)
+        right = max(self.end_x, self.rect.right)
+        self.patrol_rect = pygame.Rect(left, self.rect.y, right - left, self.rect.height)
+        self.ticks = 0  # リセットしてから進めた update の回数
+        self.path = None  # リセットからの (X座標, 速度) の並び (初めて必要になったときに作る)
+        self.loop_start = 0  # path の中で、繰り返しが始まる位置
 
+    def next_state(self, x, vel_x):
+        """1ティック後の (X座標, 速度) を返す (位置と速度だけで決まる)"""
         # 1. X軸（左右）の移動
-        self.true_x += self.vel_x
-        self.rect.x = int(self.true_x)
+        x = int(float(x) + vel_x)
 
         # ★ X軸の移動範囲を補正 (rect.right と rect.left で比較)
-        if self.vel_x > 0 and self.rect.right > self.end_x:
-            self.rect.right = self.end_x
-            self.vel_x = -self.vel_x
-        elif self.vel_x < 0 and self.rect.left < self.start_x:
-            self.rect.left = self.start_x
-            self.vel_x = -self.vel_x
+        if vel_x > 0 and x + self.rect.width > self.end_x:
+            x = self.end_x - self.rect.width
+            vel_x = -vel_x
+        elif vel_x < 0 and x < self.start_x:
+            x = self.start_x
+            vel_x = -vel_x
+        return x, vel_x
+
+    # ★★★ update メソッド ★★★
+    def update(self, tile_map, current_gravity):
+        self.rect.x, self.vel_x = self.next_state(self.rect.x, self.vel_x)
         # X座標を補正した後、true_x も同期する
         self.true_x = float(self.rect.x)
+        self.ticks += 1
+
+    def advance_to(self, tick, tile_map, current_gravity):
+        """リセットから tick 回 update したときの位置まで進める
+
+        活動範囲の外で眠っていた間の分もまとめて進めるので、起きたときの位置と
+        向きは、ずっと動かしていた場合と同じになる (往復の位相がずれない)。
+        """
+        steps = tick - self.ticks
+        if steps == 1:
+            self.update(tile_map, current_gravity)
+        elif steps > 1:
+            self.rect.x, self.vel_x = self.state_at(tick)
+            self.true_x = float(self.rect.x)
+            self.ticks = tick
+
+    def state_at(self, tick):
+        """リセットから tick 回 update したあとの (X座標, 速度) を返す"""
+        path = self.path
+        if path is None:
+            # 位置と速度の組は有限なので、いつか同じ組に戻ってそこから先は繰り返す
+            state = (self.original_x, self.original_speed)
+            seen = {}
+            path = []
+            while state not in seen:
+                seen[state] = len(path)
+                path.append(state)
+                state = self.next_state(*state)
+            self.path = path
+            self.loop_start = seen[state]
+        if tick < len(path):
+            return path[tick]
+        loop_start = self.loop_start
+        return path[loop_start + (tick - loop_start) % (len(path) - loop_start)]
 
     def reset_position(self):
         self.rect.topleft = (self.original_x, self.original_y)
@@ -1399,8 +2719,22 @@ class PatrollingSpike(Spike):
         self.true_y = float(self.original_y)  # true_y もリセット
         self.vel_x = self.original_speed
         self.vel_y = 0  # Y軸速度もリセット
-        self.image = self.original_image.copy()
-        self.mask = pygame.mask.from_surface(self.image)
+        self.ticks = 0
+        self.image = self.original_image  # (共有の画像とマスクに戻すだけ)
+        self.mask = self.original_mask
+
+
+class PatrolArea(pygame.sprite.Sprite):
+    """パトロールするトゲが往復する範囲 (活動範囲の索引に登録する)
+
+    トゲそのものを登録すると、眠っている間の古い位置で検索されてしまうので、
+    動かない往復範囲の矩形で登録し、見つかったら spike を起こす。
+    """
+
+    def __init__(self, spike):
+        super().__init__()
+        self.spike = spike
+        self.rect = spike.patrol_rect
 
 
 # -----------------------------------------------------------------
@@ -1408,6 +2742,477 @@ class PatrollingSpike(Spike):
 # -----------------------------------------------------------------
 
 
+# -----------------------------------------------------------------
+# ▼▼▼ 入力レコードとヘッドレスのゲーム本体 (GameSim) ▼▼▼
+# -----------------------------------------------------------------
+class InputState:
+    """1ティック分のプレイヤー入力 (キーボードから切り離した入力レコード)"""
+
+    __slots__ = ("left", "right", "jump_pressed", "jump_released")
+
+    def __init__(self, left=False, right=False, jump_pressed=False, jump_released=False):
+        self.left = left  # 左キーを押している
+        self.right = right  # 右キーを押している
+        self.jump_pressed = jump_pressed  # このティックでジャンプキーが押された
+        self.jump_released = jump_released  # このティックでジャンプキーが離された
+
+    @staticmethod
+    def from_keyboard(pressed, jump_pressed=False, jump_released=False):
+        """pygame.key.get_pressed() の結果に当たる入力レコードを返す
+
+        全ての組み合わせは REPLAY_INPUTS に作ってあるので、毎ティック新しく作らず、
+        リプレイの再生と同じオブジェクトを返す (書き換えないこと)
+        """
+        code = (
+            bool(pressed[pygame.K_LEFT] or pressed[pygame.K_a])
+            | bool(pressed[pygame.K_RIGHT] or pressed[pygame.K_d]) << 1
+            | bool(jump_pressed) << 2
+            | bool(jump_released) << 3
+        )
+        return REPLAY_INPUTS[code]
+
+
+NO_INPUT = InputState()  # 何も押していない入力
+
+
+class GameSim:
+    """ディスプレイ・フォント・イベントなしで1ティックずつ進められるゲーム本体
+
+    setup_level でステージを構築し、step() に InputState を渡して進める。
+    描画は持たないので、main() の他にテストやベンチマーク、ボットからも動かせる。
+    state は "PLAYING" / "ANIMATING" / "GAME_OVER" / "GAME_CLEAR" のいずれか。
+    """
+
+    ANIMATION_DURATION_SECONDS = 0.5  # 重力反転アニメーションの所要時間 (秒)
+    ANIMATION_TICKS = max(1, round(ANIMATION_DURATION_SECONDS * SIM_HZ))
+
+    def __init__(self, level_map=LEVEL_MAP, seed=None):
+        # 文字列のリストでも、load_level で読んだ CompiledLevel でもよい
+        if isinstance(level_map, CompiledLevel):
+            level = level_map
+        else:
+            level = compile_level(level_map)
+        self.level_map = level.rows  # (リプレイのチェックサム用)
+        self.rng = random.Random()  # 矢の発射間隔など、ゲーム内の乱数はすべてこれを使う
+
+        (
+            self.player,
+            self.start_pos,
+            self.all_sprites,
+            self.tile_map,
+            self.spikes,
+            self.keys,
+            self.doors,
+            self.gravity_switchers,
+            self.falling_spikes,
+            self.patrolling_spikes,
+            self.arrow_launchers,
+            self.trigger_zones,
+        ) = setup_level(level)
+
+        # プレイヤーが正常に作成されたか確認
+        if self.player is None:
+            raise ValueError("プレイヤー(@)がマップにいません！")
+
+        self.all_sprites.add(self.player)
+        self.arrows = BroadphaseGroup()  # (矢とプレイヤーの候補探し。トゲなどは SpatialGridGroup)
+        self.arrow_pool = ArrowPool(self.arrows, self.all_sprites)
+
+        # ★ 活動範囲の索引: カメラ付近の敵・仕掛けだけを検索して動かす
+        self.launcher_index = SpatialGridGroup(
+            self.arrow_launchers, cell_size=ACTIVITY_CELL_SIZE
+        )
+        self.patrol_index = SpatialGridGroup(
+            [PatrolArea(ps) for ps in self.patrolling_spikes], cell_size=ACTIVITY_CELL_SIZE
+        )
+        self.falling_active = pygame.sprite.Group()  # 落下中のトゲ (範囲外でも動かす)
+        self.awake_launchers = set()
+        self.activity_rect = pygame.Rect(
+            0, 0, GAME_WIDTH + ACTIVITY_RADIUS * 2, GAME_HEIGHT + ACTIVITY_RADIUS * 2
+        )
+
+        # マップサイズを計算
+        if level.height > 0:
+            self.level_width = level.width * TILE_SIZE
+        else:
+            self.level_width = GAME_WIDTH
+        self.level_height = level.height * TILE_SIZE
+        self.level_rect = pygame.Rect(0, 0, self.level_width, self.level_height)
+
+        # ★ 描画キュー: レイヤーごとに、カメラに映るものを探す索引を登録する
+        self.render_queue = RenderQueue()
+        self.render_queue.add("hazards", self.launcher_index, self.spikes, self.arrows)
+        self.render_queue.add("pickups", self.doors, self.keys, self.gravity_switchers)
+        self.render_queue.add("player", pygame.sprite.GroupSingle(self.player))
+
+        # リトライ用に、途中で消える/動くスプライトの初期状態を記録
+        self.snapshot = LevelSnapshot(
+            list(self.keys)
+            + list(self.gravity_switchers)
+            + list(self.falling_spikes)
+            + list(self.patrolling_spikes)
+            + list(self.trigger_zones)
+        )
+
+        self.reset(seed)
+
+    # --- ステージを作り直さずに初期状態へ戻す (リトライ用) ---
+    def reset(self, seed=None):
+        """seed を指定すると、同じ入力で同じ展開を再現できる (None なら毎回ランダム)"""
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.rng.seed(seed)
+
+        self.arrow_pool.release_all()  # 飛んでいる矢は全てプールに戻す
+
+        self.snapshot.restore()  # 消えたカギ・重力スイッチ・落下トゲ・トリガーを戻す
+        self.falling_active.empty()
+        for fs in self.falling_spikes:
+            fs.reset_position()
+            SpatialGridGroup.relocate_all(fs)
+        for ps in self.patrolling_spikes:
+            ps.reset_position()
+            SpatialGridGroup.relocate_all(ps)
+        for launcher in self.arrow_launchers:
+            launcher.reset_timer(self.rng)
+        self.awake_launchers = set()
+
+        self.reset_run_state()
+
+    def reset_run_state(self):
+        """プレイヤー・重力・タイマーなど 1回のプレイごとの状態を初期化"""
+        self.player.reset_position(*self.start_pos)
+        self.state = "PLAYING"
+        self.gravity_direction = "DOWN"
+        self.target_gravity = "DOWN"
+        self.current_angle = 0.0
+        self.target_angle = 0.0
+        self.animation_timer = 0.0  # アニメーションの進捗 (0.0 -> 1.0)
+        self.animation_ticks = 0
+        self.play_ticks = 0  # PLAYING 中に進んだティック数
+        self.sim_tick = 0  # このプレイで進んだティック数 (ANIMATING 中も数える)
+        self.clear_time = None  # クリア時に確定したタイム
+        self.death_cause = None  # ミスの原因 ("fall" / "Arrow" / トゲのクラス名)
+        self.update_camera()
+
+    @property
+    def play_time_seconds(self):
+        return self.play_ticks * SIM_DT
+
+    @property
+    def is_running(self):
+        return self.state == "PLAYING" or self.state == "ANIMATING"
+
+    def step(self, controls=NO_INPUT):
+        """1ティック進める"""
+        if self.state == "PLAYING":
+            self.sim_tick += 1
+            self.step_playing(controls)
+        elif self.state == "ANIMATING":
+            self.sim_tick += 1
+            self.step_animating()
+
+    def step_playing(self, controls):
+        player = self.player
+        tile_map = self.tile_map
+        gravity_direction = self.gravity_direction
+
+        # ★★★ プレイ時間を加算 (ティック数から計算) ★★★
+        self.play_ticks += 1
+
+        # ★ このティックで押された/離されたジャンプを適用
+        if controls.jump_pressed:
+            player.jump(gravity_direction, controls)
+        if controls.jump_released:
+            player.cut_jump(gravity_direction)
+
+        # ★ 活動範囲 (カメラの周り) に入っている発射台だけを動かす
+        activity_rect = self.activity_rect
+        awake_launchers = self.launcher_index.query(activity_rect)
+        previously_awake = self.awake_launchers
+        for launcher in awake_launchers:
+            if launcher not in previously_awake:
+                launcher.wake(self.sim_tick)
+        self.awake_launchers = set(awake_launchers)
+
+        # 弓矢の発射 (発射された矢は arrow_pool が各グループに追加する)
+        arrow_pool = self.arrow_pool
+        for launcher in awake_launchers:
+            launcher.update(self.sim_tick, self.rng, arrow_pool)
+
+        # 矢の移動と壁との衝突 (スイープ判定) / マップ外に出た矢の回収
+        # (飛んでいる矢は活動範囲の外でも消さずに動かす)
+        self.arrows.update(tile_map)
+        level_rect = self.level_rect
+        for arrow in self.arrows.sprites():
+            if arrow.hit_wall or not level_rect.colliderect(arrow.rect):
+                arrow_pool.release(arrow)
+        PROFILER.mark("arrows")
+
+        # ★★★ トリガーゾーン (落下トゲなど): プレイヤーが入ったゾーンだけ発動 ★★★
+        for zone in self.trigger_zones.fire(player.rect):
+            self.on_trigger(zone.target)
+
+        PROFILER.mark("triggers")
+
+        # 各グループの更新 (パトロールするトゲは往復範囲が活動範囲にかかるものだけ。
+        # 眠っていたトゲは、眠っていた間の分も進めてから動かす)
+        for fs in self.falling_active.sprites():
+            fs.update(tile_map, gravity_direction)
+            SpatialGridGroup.relocate_all(fs)  # (壁に当たって消えたトゲは何もしない)
+        play_ticks = self.play_ticks
+        for area in self.patrol_index.query(activity_rect):
+            ps = area.spike
+            ps.advance_to(play_ticks, tile_map, gravity_direction)
+            SpatialGridGroup.relocate_all(ps)
+        PROFILER.mark("spike_update")
+
+        player.update(tile_map, gravity_direction, controls)
+        PROFILER.mark("player")
+
+        # 落下ミス判定
+        level_width = self.level_width
+        if (
+            player.rect.top > self.level_height
+            or player.rect.bottom < 0
+            or (
+                level_width > 0
+                and (player.rect.left > level_width or player.rect.right < 0)
+            )
+        ):
+            self.state = "GAME_OVER"
+            self.death_cause = "fall"
+
+        # ブースター判定
+        is_on_booster = BOOSTER_CODE in player.standing_on if player.on_ground else False
+        player.speed_multiplier = BOOSTER_SPEED_MULTIPLIER if is_on_booster else 1.0
+        player.jump_multiplier = BOOSTER_JUMP_MULTIPLIER if is_on_booster else 1.0  # ブーストジャンプ調整
+
+        # ★★★ 重力スイッチ判定 (アニメーションへ移行) ★★★
+        touching_switchers = self.gravity_switchers.query(player.rect)
+        if touching_switchers:
+            collided_switcher = touching_switchers[0]
+            # 現在の重力に基づいて、目標の重力と角度を設定
+            if gravity_direction == "DOWN":
+                self.target_gravity = "UP"
+                self.target_angle = 180.0
+            else:
+                self.target_gravity = "DOWN"
+                self.target_angle = 0.0
+
+            self.state = "ANIMATING"  # ステートをアニメーションに変更
+            self.animation_timer = 0.0  # アニメーションタイマーをリセット
+            self.animation_ticks = 0
+            collided_switcher.kill()
+
+        self.update_camera()
+
+        # 弓矢との衝突 (矩形が重なる矢にだけ Mask判定)
+        hit_arrows = self.arrows.query_mask(player)
+        if hit_arrows:
+            for arrow in hit_arrows:
+                self.arrow_pool.release(arrow)
+            self.state = "GAME_OVER"
+            self.death_cause = self.death_cause or "Arrow"
+        else:
+            # トゲとの衝突 (Mask判定、プレイヤーの近くのトゲだけ)
+            hit_spikes = self.spikes.query_mask(player)
+            if hit_spikes:
+                self.state = "GAME_OVER"
+                # 落下と同じティックならそちらを優先する
+                self.death_cause = self.death_cause or type(hit_spikes[0]).__name__
+
+        # カギ・トビラ判定
+        collected_keys = self.keys.query_mask(player)
+        if collected_keys:
+            for key in collected_keys:
+                key.kill()
+            player.has_key = True
+
+        # GAME_CLEAR ステートへ
+        if self.doors.query_mask(player) and player.has_key:
+            self.clear_time = self.play_time_seconds  # タイムを確定
+            self.state = "GAME_CLEAR"
+
+        PROFILER.mark("collisions")
+
+    def step_animating(self):
+        # 1. 時間を経過させる (1ティック分)
+        self.animation_ticks += 1
+        self.animation_timer = min(1.0, self.animation_ticks / self.ANIMATION_TICKS)
+
+        # 2. 現在の角度を計算 (線形補間)
+        current_angle_start = 180.0 if self.gravity_direction == "UP" else 0.0
+        self.current_angle = (
+            current_angle_start
+            + (self.target_angle - current_angle_start) * self.animation_timer
+        )
+
+        # 3. アニメーションが終了したか？
+        if self.animation_timer >= 1.0:
+            self.current_angle = self.target_angle  # 角度をターゲットに固定
+            self.gravity_direction = self.target_gravity  # 重力を本適用
+            self.state = "PLAYING"  # ステートを戻す
+
+        # ★ アニメーション中もカメラはプレイヤーを追従する
+        self.update_camera()
+
+    def on_trigger(self, target):
+        """トリガーゾーンが発動したときの処理 (範囲で動く仕掛けはここに追加する)"""
+        if isinstance(target, FallingSpike):
+            target.activate()
+            self.falling_active.add(target)
+
+    def update_camera(self):
+        """カメラをプレイヤー中央に合わせ、レベルの範囲に制限する (活動範囲も追従)"""
+        target_camera_x = self.player.rect.centerx - GAME_WIDTH // 2
+        target_camera_y = self.player.rect.centery - GAME_HEIGHT // 2
+
+        if self.level_width > GAME_WIDTH:
+            self.camera_x = max(0, min(target_camera_x, self.level_width - GAME_WIDTH))
+        else:
+            self.camera_x = (self.level_width - GAME_WIDTH) // 2
+
+        if self.level_height > GAME_HEIGHT:
+            self.camera_y = max(0, min(target_camera_y, self.level_height - GAME_HEIGHT))
+        else:
+            self.camera_y = (self.level_height - GAME_HEIGHT) // 2
+
+        self.activity_rect.topleft = (
+            self.camera_x - ACTIVITY_RADIUS,
+            self.camera_y - ACTIVITY_RADIUS,
+        )
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ GameSim ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
+# -----------------------------------------------------------------
+# ▼▼▼ リプレイ (入力の記録と再生) ▼▼▼
+# -----------------------------------------------------------------
+# ファイル形式 (リトルエンディアン):
+#   ヘッダー: マジック "MXRP" / バージョン (u16) / シード (u32) / ステージのCRC32 (u32)
+#   本体    : 1ティック 1バイトの入力 (bit0: 左, bit1: 右, bit2: ジャンプ押下, bit3: ジャンプ離す)
+REPLAY_MAGIC = b"MXRP"
+REPLAY_VERSION = 1
+REPLAY_HEADER = struct.Struct("<4sHII")
+
+# 入力バイト -> InputState の対応表
+# (再生時も InputState.from_keyboard も、毎ティック生成しないようこれを共有する)
+REPLAY_INPUTS = [
+    InputState(bool(code & 1), bool(code & 2), bool(code & 4), bool(code & 8))
+    for code in range(16)
+]
+
+
+def encode_input(controls):
+    """InputState を 1バイトの入力コードにする"""
+    return (
+        controls.left
+        | controls.right << 1
+        | controls.jump_pressed << 2
+        | controls.jump_released << 3
+    )
+
+
+def level_checksum(level_map):
+    """リプレイと再生するステージが一致するかを確かめるためのCRC32"""
+    if isinstance(level_map, CompiledLevel):
+        level_map = level_map.rows
+    return zlib.crc32("\n".join(level_map).encode("utf-8"))
+
+
+class ReplayRecorder:
+    """プレイ中の入力を、1ティック 1バイトでファイルに書き出す
+
+    入力は事前に確保したバッファに詰め、いっぱいになったときだけ書き出すので、
+    記録中にフレームごとのメモリ確保は発生しない。
+    """
+
+    def __init__(self, path, seed, level_map):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(
+            REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, seed, level_checksum(level_map))
+        )
+        self.buffer = bytearray(REPLAY_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.ticks = 0
+
+    def record(self, controls):
+        self.buffer[self.length] = encode_input(controls)
+        self.length += 1
+        self.ticks += 1
+        if self.length == REPLAY_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.length:
+            self.file.write(self.view[: self.length])
+            self.length = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class Replay:
+    """リプレイファイルの中身 (シードと、ティックごとの入力)"""
+
+    def __init__(self, seed, checksum, inputs):
+        self.seed = seed
+        self.checksum = checksum
+        self.inputs = inputs  # bytes (1ティック 1バイト)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < REPLAY_HEADER.size:
+            raise ValueError(f"リプレイファイルが壊れています: {path}")
+        magic, version, seed, checksum = REPLAY_HEADER.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError(f"リプレイファイルの形式が違います: {path}")
+        return cls(seed, checksum, data[REPLAY_HEADER.size :])
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def controls(self):
+        """ティックごとの InputState を順に返す"""
+        for code in self.inputs:
+            yield REPLAY_INPUTS[code & 0x0F]
+
+    def create_sim(self, level_map=LEVEL_MAP):
+        """記録時と同じシードで GameSim を作る"""
+        if level_checksum(level_map) != self.checksum:
+            raise ValueError("リプレイを記録したステージと現在のステージが違います")
+        return GameSim(level_map, seed=self.seed)
+
+
+def run_replay_headless(replay, level_map=LEVEL_MAP):
+    """表示なし・最高速でリプレイを最後まで再生し、終了時の GameSim を返す"""
+    sim = replay.create_sim(level_map)
+    for controls in replay.controls():
+        if not sim.is_running:
+            break
+        sim.step(controls)
+    return sim
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ リプレイ ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
 # ★★★ タイム保存・ロード関数 (新規追加) ★★★
 
 def save_best_time(new_time):
@@ -1439,11 +3244,574 @@ def load_best_time():
 # ★★★ ここまで ★★★
 
 
+# -----------------------------------------------------------------
+# ▼▼▼ 文字の描画 (描いた文字列のキャッシュ) ▼▼▼
+# -----------------------------------------------------------------
+class TextCache:
+    """font.render の結果を (フォント, 文字列, 色) ごとに覚えておく LRU キャッシュ
+
+    メニューの文字は毎フレーム同じなので、2フレーム目からは描き直さない。
+    (毎フレーム変わるタイマーのような文字は入れない。古いものから押し出されてしまう)
+    """
+
+    def __init__(self, max_entries=TEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.surfaces = collections.OrderedDict()  # (font, text, color, antialias) -> 画像
+
+    def render(self, font, text, color, antialias=True):
+        """font.render と同じ画像を返す (同じ文字列は2回目から描き直さない)"""
+        key = (font, text, color, antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)  # 最近使ったものを後ろへ
+            return surface
+        surface = font.render(text, antialias, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_entries:
+            self.surfaces.popitem(last=False)  # 一番長く使われていないものを捨てる
+        return surface
+
+
+TEXT_CACHE = TextCache()  # HUD・メニュー・プロファイラで共有する文字のキャッシュ
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ 文字の描画 ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
+# -----------------------------------------------------------------
+# ▼▼▼ フレームプロファイラ (F3: 表示切り替え / F4: CSV 記録) ▼▼▼
+# -----------------------------------------------------------------
+class FrameProfiler:
+    """main ループの各フェーズに何ミリ秒かかったかをフレームごとに計測する
+
+    各処理の後で mark(フェーズ名) を呼ぶと、直前の mark からの経過時間が
+    そのフェーズに加算される。表示も CSV 記録もしていないときは mark() は
+    すぐに戻るので、普段のプレイにはほとんど影響しない。
+    """
+
+    # 表示順。"idle" は clock.tick() で待っている時間 (作業時間には含めない)
+    PHASES = (
+        "events",
+        "arrows",
+        "triggers",
+        "spike_update",
+        "player",
+        "collisions",
+        "sim_other",
+        "clear",
+        "stars",
+        "platforms",
+        "sprites",
+        "present",
+        "hud",
+        "overlay",
+        "flip",
+        "idle",
+    )
+
+    def __init__(self, history=PROFILER_HISTORY):
+        self.overlay_visible = False
+        self.csv_file = None
+        self.csv_writer = None
+        self.enabled = False  # このフレームで計測しているか (フレーム開始時に決まる)
+        self.history = collections.deque(maxlen=history)  # (作業時間, {フェーズ: 秒})
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+        self.last = 0.0
+        self.frame_index = 0
+
+    def toggle_overlay(self):
+        self.overlay_visible = not self.overlay_visible
+
+    def toggle_csv(self, path=PROFILE_CSV_FILE):
+        """CSV への記録を開始/停止する。開始したら True を返す"""
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = self.csv_writer = None
+            return False
+        self.csv_file = open(path, "w", newline="")
+        self.csv_writer = csv.writer(self.csv_file)
+        self.csv_writer.writerow(
+            ["frame", "work_ms"] + [f"{phase}_ms" for phase in self.PHASES]
+        )
+        return True
+
+    def close(self):
+        if self.csv_file is not None:
+            self.toggle_csv()
+
+    def begin_frame(self):
+        self.enabled = self.overlay_visible or self.csv_file is not None
+        if not self.enabled:
+            return
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        """直前の mark からの経過時間を phase に加算する"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.current[phase] += now - self.last
+        self.last = now
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        phases = self.current
+        work = sum(phases.values()) - phases["idle"]
+        self.history.append((work, phases))
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(
+                [self.frame_index, f"{work * 1000:.3f}"]
+                + [f"{phases[phase] * 1000:.3f}" for phase in self.PHASES]
+            )
+        self.frame_index += 1
+
+    def draw(self, surface, font):
+        """フェーズごとの平均時間と、フレーム時間のグラフを左上に描く"""
+        if not self.overlay_visible or not self.history:
+            return
+        count = len(self.history)
+        line_height = font.get_linesize()
+        panel = pygame.Rect(5, 5, 230, line_height * (len(self.PHASES) + 2) + 70)
+        surface.fill((0, 0, 0), panel)
+
+        # 1. フェーズごとの平均 (直近 history フレーム)
+        y = panel.top + 4
+        work_avg = sum(frame[0] for frame in self.history) / count * 1000
+        rows = [("frame", f"{work_avg:.2f} / {FRAME_BUDGET_MS:.1f} ms")]
+        for phase in self.PHASES:
+            average = sum(frame[1][phase] for frame in self.history) / count * 1000
+            rows.append((phase, f"{average:.2f} ms"))
+        for name, value in rows:
+            surface.blit(TEXT_CACHE.render(font, name, WHITE, False), (panel.left + 6, y))
+            # (数値は毎フレーム変わるので、キャッシュに入れずに描く)
+            value_text = font.render(value, False, WHITE)
+            surface.blit(value_text, value_text.get_rect(topright=(panel.right - 6, y)))
+            y += line_height
+
+        # 2. フレーム時間 (作業時間) のグラフ。赤線が 1フレームの予算
+        graph = pygame.Rect(panel.left + 6, y + 4, panel.width - 12, 56)
+        scale = graph.height / (FRAME_BUDGET_MS * 2)
+        budget_y = graph.bottom - int(FRAME_BUDGET_MS * scale)
+        bar_width = max(1, graph.width // self.history.maxlen)
+        for i, (work, _) in enumerate(self.history):
+            height = min(graph.height, int(work * 1000 * scale))
+            color = (230, 80, 90) if work * 1000 > FRAME_BUDGET_MS else (90, 190, 90)
+            surface.fill(
+                color,
+                (graph.left + i * bar_width, graph.bottom - height, bar_width, height),
+            )
+        pygame.draw.line(
+            surface, (230, 80, 90), (graph.left, budget_y), (graph.right, budget_y)
+        )
+
+
+PROFILER = FrameProfiler()  # main ループと GameSim で共有するプロファイラ
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ フレームプロファイラ ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
+# -----------------------------------------------------------------
+# ▼▼▼ 描画処理 (main ループとベンチマークで共通) ▼▼▼
+# -----------------------------------------------------------------
+class StarField:
+    """星空の背景。星をあらかじめタイル画像に描いておき、毎フレームは blit するだけ
+
+    タイルは縦横にループするので、カメラがどこにいても 1層あたり 1回の blit で済む。
+    星の数を増やしても毎フレームの描画コストは変わらない。
+    """
+
+    def __init__(
+        self, level_width, level_height, count=NUM_STARS, layers=STAR_LAYERS, rng=random
+    ):
+        self.tile_width = GAME_WIDTH
+        self.rng = rng  # 星の配置に使う乱数 (ベンチマークではシード付きのものを渡す)
+        self.tile_height = GAME_HEIGHT
+        # 今までと同じ密度 (レベル全体 + 画面半分の余白に count 個) になるよう、
+        # 1枚のタイルに入れる星の数を決める
+        field_area = (level_width + GAME_WIDTH) * (level_height + GAME_HEIGHT)
+        tile_count = count * self.tile_width * self.tile_height / max(1, field_area)
+        # [(Parallax 係数, 画像), ...] (奥の層から順に)
+        self.layers = [
+            (factor, self.render_layer(max(1, round(tile_count * share))))
+            for factor, share in layers
+        ]
+
+    def render_layer(self, count):
+        """星を count 個描いたタイルを 2x2 に並べた画像を作る"""
+        width, height = self.tile_width, self.tile_height
+        tile = pygame.Surface((width, height))
+        tile.fill(STATIC_LAYER_COLORKEY)
+        rng = self.rng
+        for _ in range(count):
+            x = rng.randrange(width)
+            y = rng.randrange(height)
+            radius = rng.randint(1, 2)
+            color = rng.choice(STAR_COLORS)
+            # タイルの端にかかる星は反対側にも描いて、つなぎ目を消す
+            for dx in (-width, 0, width):
+                for dy in (-height, 0, height):
+                    pygame.draw.circle(tile, color, (x + dx, y + dy), radius)
+
+        # 2x2 に並べておけば、どのオフセットでも画面1枚分を1回で切り出せる
+        surface = pygame.Surface((width * 2, height * 2))
+        for ox in (0, width):
+            for oy in (0, height):
+                surface.blit(tile, (ox, oy))
+        surface.set_colorkey(STATIC_LAYER_COLORKEY, pygame.RLEACCEL)
+        if pygame.display.get_surface() is not None:
+            surface = surface.convert()
+        return surface
+
+    def draw(self, surface, camera_x, camera_y):
+        """星空を Parallax 付きで描画する"""
+        width, height = self.tile_width, self.tile_height
+        for factor, image in self.layers:
+            offset_x = int(camera_x * factor) % width
+            offset_y = int(camera_y * factor) % height
+            surface.blit(image, (0, 0), (offset_x, offset_y, width, height))
+
+
+class RenderQueue:
+    """スプライトを描画レイヤー (RENDER_LAYERS) ごとに分けて、カメラに映るものだけを描く
+
+    各レイヤーには空間インデックス (SpatialGridGroup / BroadphaseGroup) か普通の
+    Group を登録し、毎フレームはカメラの矩形と重なるスプライトだけを取り出して、
+    レイヤーごとに Surface.blits() でまとめて描く。描く順番は setup_level で
+    追加した順ではなく、レイヤーの順 (奥 -> 手前) で決まる。
+    """
+
+    def __init__(self):
+        self.layers = {name: [] for name in RENDER_LAYERS}
+
+    def add(self, layer, *groups):
+        self.layers[layer].extend(groups)
+
+    @staticmethod
+    def visible(group, view):
+        """group のうち view と重なるスプライトのリスト (順番は問わない)"""
+        if isinstance(group, BroadphaseGroup):
+            return group.query(view)
+        sprites = group.sprites()
+        if isinstance(group, SpatialGridGroup):
+            # 見るセルの数よりスプライトが多いときだけグリッドを引く
+            left, right, top, bottom = group.cell_range(view)
+            if (right - left + 1) * (bottom - top + 1) < len(sprites):
+                return group.query(view)
+        return [sprites[i] for i in view.collidelistall([s.rect for s in sprites])]
+
+    def view_rect(self, camera_x, camera_y, size):
+        view = pygame.Rect((camera_x, camera_y), size)
+        return view.inflate(RENDER_CULL_MARGIN * 2, RENDER_CULL_MARGIN * 2)
+
+    def positions(self, camera_x, camera_y, size=(GAME_WIDTH, GAME_HEIGHT)):
+        """カメラの近くのスプライトの位置 {sprite: (x, y)} (描画の補間用)"""
+        view = self.view_rect(camera_x, camera_y, size)
+        return {
+            sprite: sprite.rect.topleft
+            for groups in self.layers.values()
+            for group in groups
+            for sprite in self.visible(group, view)
+        }
+
+    def draw(self, surface, camera_x, camera_y, skip=None, prev_positions=None, alpha=0.0):
+        """カメラに映るスプライトをレイヤーの順に描く
+
+        skip(sprite) が True のものは描かない (静的レイヤーに焼き込んだものなど)。
+        prev_positions があれば、直前のティックの位置との間を alpha で補間する。
+        """
+        view = self.view_rect(camera_x, camera_y, surface.get_size())
+        if prev_positions is None:
+            prev_positions = {}
+        for name in RENDER_LAYERS:
+            batch = []
+            for group in self.layers[name]:
+                for sprite in self.visible(group, view):
+                    if skip is not None and skip(sprite):
+                        continue
+                    x, y = sprite.rect.topleft
+                    prev = prev_positions.get(sprite)
+                    if prev is not None:  # (このティックで出現したものは補間しない)
+                        x = round(prev[0] + (x - prev[0]) * alpha)
+                        y = round(prev[1] + (y - prev[1]) * alpha)
+                    batch.append((sprite.image, (x - camera_x, y - camera_y)))
+            if batch:
+                surface.blits(batch, False)
+
+
+def draw_world(surface, sim, static_layer, camera_x, camera_y, prev_positions=None, alpha=0.0):
+    """ゲームワールド (静的レイヤー + スプライト) を surface に描画する
+
+    prev_positions があれば、直前のティックの位置との間を alpha で補間する。
+    """
+    if static_layer is not None:
+        # 静的レイヤー (カメラに重なるチャンクのみ)。焼き込んだスプライトは描かない
+        static_layer.draw(surface, camera_x, camera_y, sim.gravity_direction)
+        skip = StaticLayer.is_static
+    else:
+        # 足場をタイルマップから描いてから、全スプライトを描く
+        sim.tile_map.draw(surface, camera_x, camera_y, sim.gravity_direction)
+        skip = None
+    PROFILER.mark("platforms")
+
+    # スプライトの描画 (カメラに映るものだけを、レイヤーの順に)
+    sim.render_queue.draw(surface, camera_x, camera_y, skip, prev_positions, alpha)
+    PROFILER.mark("sprites")
+
+
+class PresentStage:
+    """game_surface を拡大 (と回転) して画面に出す処理
+
+    拡大は pygame.transform.scale の出力先に画面そのものを渡すので、通常時は
+    毎フレーム新しいサーフェスを作らない。180° の状態は回転ではなく上下左右の
+    反転で描き、回転アニメーション中は縮小した画像だけを回転させる。
+    pygame の flip / rotate は出力先を指定できないので、NumPy があるときは
+    反転・回転もピクセル配列の上で行い、用意しておいたサーフェスに書き込む
+    (NumPy がないときだけ、その2つの場合に小さい画像が1枚作られる)。
+    """
+
+    def __init__(
+        self, screen, game_size=(GAME_WIDTH, GAME_HEIGHT), rotate_scale=ROTATE_RENDER_SCALE
+    ):
+        self.screen_size = screen.get_size()
+        self.game_size = game_size
+        small_size = (
+            max(1, int(game_size[0] * rotate_scale)),
+            max(1, int(game_size[1] * rotate_scale)),
+        )
+        # 回転アニメーション用の縮小画像と、回転結果を貼り付ける下地
+        self.small = pygame.Surface(small_size).convert()
+        # 回転で広がった部分は colorkey で透明になり、背景色が見える
+        self.small.set_colorkey(STATIC_LAYER_COLORKEY)
+        self.rotated_frame = pygame.Surface(small_size).convert()
+        self.flipped = None  # 180° 用の反転先 (game_surface と同じ形式で初回に作る)
+
+        # ★ ピクセル配列で回転するときの作業用配列 (毎フレーム作り直さない)
+        # (surfarray の配列は [x][y] の順なので、ここでも (幅, 高さ) で持つ)
+        self.use_numpy = numpy is not None and self.small.get_bytesize() == 4
+        if self.use_numpy:
+            width, height = small_size
+            xs, ys = numpy.meshgrid(
+                numpy.arange(width, dtype=numpy.float32) - (width - 1) / 2,
+                numpy.arange(height, dtype=numpy.float32) - (height - 1) / 2,
+                indexing="ij",
+            )
+            self.offset_x = xs  # 各ピクセルの中心からの位置
+            self.offset_y = ys
+            self.source_x = numpy.empty_like(xs)
+            self.source_y = numpy.empty_like(xs)
+            self.work = numpy.empty_like(xs)
+            self.outside = numpy.empty(small_size, dtype=bool)
+            self.outside_work = numpy.empty(small_size, dtype=bool)
+            self.index = numpy.empty(small_size, dtype=numpy.intp)
+            # 縮小画像のピクセル + 末尾に背景色 (画像の外を指すピクセルはここを引く)
+            self.source = numpy.empty(width * height + 1, dtype=numpy.uint32)
+            self.source_pixels = self.source[:-1].reshape(small_size)
+            self.source[-1] = self.rotated_frame.map_rgb(GAME_BACKGROUND_COLOR)
+            self.rotated = numpy.empty(small_size, dtype=numpy.uint32)
+
+    def flip(self, game_surface):
+        """game_surface を上下左右に反転した画像 (用意しておいたサーフェス) を返す"""
+        if not self.use_numpy or game_surface.get_bytesize() != 4:
+            return pygame.transform.flip(game_surface, True, True)
+        flipped = self.flipped
+        if flipped is None or flipped.get_size() != game_surface.get_size():
+            flipped = self.flipped = game_surface.copy()
+        # (配列は surface をロックするので、この文が終われば解放される)
+        numpy.copyto(
+            pygame.surfarray.pixels2d(flipped),
+            pygame.surfarray.pixels2d(game_surface)[::-1, ::-1],
+        )
+        return flipped
+
+    def rotate_small(self, angle):
+        """縮小画像を angle 度 (反時計回り) 回した絵を rotated_frame に描く"""
+        frame = self.rotated_frame
+        if not self.use_numpy:
+            rotated = pygame.transform.rotate(self.small, angle)
+            frame.fill(GAME_BACKGROUND_COLOR)
+            frame.blit(rotated, rotated.get_rect(center=frame.get_rect().center))
+            return
+
+        # 出力の各ピクセルが、縮小画像のどのピクセルから来るか (最近傍) を逆回転で求める
+        # (一時的な配列を作らないよう、計算はすべて用意した配列に書き込む)
+        width, height = self.small.get_size()
+        radians = math.radians(angle)
+        cos_a, sin_a = math.cos(radians), math.sin(radians)
+        source_x, source_y, work = self.source_x, self.source_y, self.work
+        numpy.multiply(self.offset_x, cos_a, out=source_x)
+        numpy.multiply(self.offset_y, sin_a, out=work)
+        numpy.subtract(source_x, work, out=source_x)
+        numpy.add(source_x, (width - 1) / 2, out=source_x)
+        numpy.multiply(self.offset_x, sin_a, out=source_y)
+        numpy.multiply(self.offset_y, cos_a, out=work)
+        numpy.add(source_y, work, out=source_y)
+        numpy.add(source_y, (height - 1) / 2, out=source_y)
+        numpy.rint(source_x, out=source_x)
+        numpy.rint(source_y, out=source_y)
+
+        # 画像の外を指すピクセル
+        outside, outside_work = self.outside, self.outside_work
+        numpy.less(source_x, 0, out=outside)
+        numpy.greater(source_x, width - 1, out=outside_work)
+        numpy.logical_or(outside, outside_work, out=outside)
+        numpy.less(source_y, 0, out=outside_work)
+        numpy.logical_or(outside, outside_work, out=outside)
+        numpy.greater(source_y, height - 1, out=outside_work)
+        numpy.logical_or(outside, outside_work, out=outside)
+
+        # source の番号 (x * 高さ + y)。外を指すものは末尾の背景色にする
+        numpy.multiply(source_x, height, out=work)
+        numpy.add(work, source_y, out=work)
+        numpy.copyto(self.index, work, casting="unsafe")
+        numpy.putmask(self.index, outside, width * height)
+
+        small = self.small
+        numpy.copyto(self.source_pixels, pygame.surfarray.pixels2d(small))
+        # colorkey の色 (静的レイヤーの透過色) は、回転しても背景色として見える
+        transparent = self.outside_work
+        numpy.equal(self.source_pixels, small.map_rgb(STATIC_LAYER_COLORKEY), out=transparent)
+        numpy.putmask(self.source_pixels, transparent, self.source[-1])
+        numpy.take(self.source, self.index, out=self.rotated)
+        numpy.copyto(pygame.surfarray.pixels2d(frame), self.rotated)
+
+    def present(self, screen, game_surface, angle):
+        """game_surface を SCREEN サイズに拡大し、angle だけ回転させて screen に描く"""
+        angle %= 360
+        if angle == 0:
+            # 1. 通常: 画面に直接拡大する
+            pygame.transform.scale(game_surface, self.screen_size, screen)
+        elif angle == 180:
+            # 2. 重力反転中: 180° 回転は上下左右の反転と同じ
+            pygame.transform.scale(self.flip(game_surface), self.screen_size, screen)
+        else:
+            # 3. 回転アニメーション中 (0.5秒だけ): 縮小した画像を回転させてから拡大する
+            small = self.small
+            pygame.transform.scale(game_surface, small.get_size(), small)
+            self.rotate_small(angle)
+            pygame.transform.scale(self.rotated_frame, self.screen_size, screen)
+
+
+class MenuScreen:
+    """メニュー画面 (タイトル・ベストタイム・ゲームオーバー・クリア) の部分更新
+
+    画面を「背景色 + 暗転レイヤー + 文字の画像と位置のリスト」として受け取り、
+    前回描いた内容と比べて変わった文字の範囲だけを描き直す。draw() が返す範囲を
+    pygame.display.update() に渡せばよく、空なら画面は前回のまま。
+    (文字の画像は TEXT_CACHE から受け取るので、同じ文字なら同じ Surface になる)
+    """
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.background = None  # 前回の (背景色, 暗転レイヤー)。None なら全体を描き直す
+        self.items = set()  # 前回の {(surface, (x, y, 幅, 高さ)), ...}
+
+    def invalidate(self):
+        """次の draw() で画面全体を描き直す (ゲーム画面やプロファイラを描いたあと)"""
+        self.background = None
+
+    def draw(self, color, overlay, items):
+        """items は [(surface, rect), ...] (描く順)。描き直した範囲のリストを返す"""
+        screen = self.screen
+        items = [(surface, tuple(rect)) for surface, rect in items]
+        current = set(items)
+        if self.background != (color, overlay):
+            dirty = [screen.get_rect()]
+        else:
+            # 消えた文字と現れた文字の範囲 (選択中の項目の色が変わった、など)
+            dirty = [pygame.Rect(rect) for rect in {rect for _, rect in current ^ self.items}]
+
+        for area in dirty:
+            screen.set_clip(area)
+            screen.fill(color, area)
+            if overlay is not None:
+                screen.blit(overlay, area, area)  # (暗転レイヤーは画面と同じ大きさ)
+            for surface, rect in items:
+                if area.colliderect(rect):
+                    screen.blit(surface, rect)
+        screen.set_clip(None)
+
+        self.background = (color, overlay)
+        self.items = current
+        return dirty
+
+
+# -----------------------------------------------------------------
+# ▲▲▲ 描画処理 ここまで ▲▲▲
+# -----------------------------------------------------------------
+
+
 # -----------------------------------------------------------------
 # ▼▼▼ main 関数 (タイトル画面を追加) ▼▼▼
 # -----------------------------------------------------------------
-def main():
-    gravity_direction = "DOWN"
+def main(argv=None):
+    # ★★★ コマンドライン引数 (リプレイの再生) ★★★
+    parser = argparse.ArgumentParser(description="マトリックスキューブ")
+    parser.add_argument(
+        "--level",
+        metavar="FILE",
+        help=f"ステージのテキストファイル (省略時は {DEFAULT_LEVEL_FILE})",
+    )
+    parser.add_argument("--replay", metavar="FILE", help="リプレイファイルを再生する")
+    parser.add_argument(
+        "--replay-speed",
+        choices=("realtime", "fast", "headless"),
+        default="realtime",
+        help="再生速度 (headless は画面を出さずに最高速で再生して結果を表示)",
+    )
+    parser.add_argument(
+        "--analyze",
+        action="store_true",
+        help="ステージに確実に届かない場所 (カギ・トビラを含む) がないかを表示して終了する",
+    )
+    args = parser.parse_args(argv)
+
+    # ★★★ ステージの読み込み (ファイルがなければ組み込みの LEVEL_MAP) ★★★
+    level_file = args.level
+    if level_file is None and os.path.exists(DEFAULT_LEVEL_FILE):
+        level_file = DEFAULT_LEVEL_FILE
+    if level_file is not None:
+        try:
+            level_map = load_level(level_file)
+        except (OSError, UnicodeError, ValueError) as e:
+            print(f"エラー: ステージを読み込めませんでした ({e})")
+            sys.exit(1)
+    else:
+        level_map = compile_level(LEVEL_MAP)
+
+    # ★★★ カギとトビラに確実に届かないステージは、遊ぶ前にはじく ★★★
+    analysis = analyze_level(level_map)
+    if args.analyze:
+        print("\n".join(analysis.report()))
+        return
+    if analysis.unclearable:
+        print("エラー: このステージはクリアできません")
+        for line in analysis.report():
+            print(f"  {line}")
+        sys.exit(1)
+
+    replay = None
+    if args.replay:
+        try:
+            replay = Replay.load(args.replay)
+            if args.replay_speed == "headless":
+                result = run_replay_headless(replay, level_map)
+                print(
+                    f"{result.state}: {result.play_time_seconds:.2f} s "
+                    f"({result.sim_tick} / {len(replay)} ticks)"
+                )
+                return
+        except (OSError, ValueError) as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+    # 1フレームあたりに進める時間の倍率 (早送り再生用)
+    sim_speed = REPLAY_FAST_FORWARD if replay and args.replay_speed == "fast" else 1
 
     pygame.init()
 
@@ -1453,10 +3821,12 @@ def main():
         font = pygame.font.Font(None, 50)  # デフォルトフォント、サイズ50
         font_time = pygame.font.Font(None, 36)
         font_title = pygame.font.Font(None, 80) # ★タイトル用
+        font_debug = pygame.font.Font(None, 20) # ★プロファイラ表示用
     except:
         font = pygame.font.Font(pygame.font.get_default_font(), 50)
         font_time = pygame.font.Font(pygame.font.get_default_font(), 36)
         font_title = pygame.font.Font(pygame.font.get_default_font(), 80) # ★タイトル用
+        font_debug = pygame.font.Font(pygame.font.get_default_font(), 20) # ★プロファイラ表示用
 
     # --- GAME OVER用 テキスト ---
     text_game_over = font.render("GAME OVER", True, WHITE)
@@ -1497,32 +3867,26 @@ def main():
     dark_overlay.fill((0, 0, 0, 150))  # 黒色で、透明度150 (0-255)
     # ★★★ ここまで ★★★
 
+    # プレイ中のタイマーは直前の1つだけ覚えておく (TEXT_CACHE には入れない)
+    timer_text = None
+    timer_surface = None
+
     screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
     game_surface = pygame.Surface((GAME_WIDTH, GAME_HEIGHT))
+    presenter = PresentStage(screen)  # 拡大・回転して画面に出す処理
     pygame.display.set_caption("Minimalism Prototype (Expanded)")
     clock = pygame.time.Clock()
 
-    # ゲーム初期化に必要な変数を None で初期化
-    player = None
-    start_pos = (0, 0)
-    all_sprites = pygame.sprite.Group()
-    platforms = pygame.sprite.Group()
-    spikes = pygame.sprite.Group()
-    keys = pygame.sprite.Group()
-    doors = pygame.sprite.Group()
-    gravity_switchers = pygame.sprite.Group()
-    booster_platforms = pygame.sprite.Group()
-    falling_spikes = pygame.sprite.Group()
-    patrolling_spikes = pygame.sprite.Group()
-    arrow_launchers = pygame.sprite.Group()
-    arrows = pygame.sprite.Group()
-    
-    # マップサイズを計算（暫定）
-    if len(LEVEL_MAP) > 0:
-        level_width = max(len(row) for row in LEVEL_MAP) * TILE_SIZE
+    # ★★★ ゲーム本体 (START GAME で初めて構築し、リトライでは使い回す) ★★★
+    sim = None
+    static_layer = None  # 動かないタイルを焼き込んだ背景 (sim と一緒に作る)
+
+    # マップサイズを計算 (星空の配置に使う)
+    if level_map.height > 0:
+        level_width = level_map.width * TILE_SIZE
     else:
         level_width = GAME_WIDTH
-    level_height = len(LEVEL_MAP) * TILE_SIZE
+    level_height = level_map.height * TILE_SIZE
 
 
     camera_x = 0
@@ -1538,93 +3902,119 @@ def main():
     best_time_display = load_best_time()
     final_clear_time = None # クリア時に確定したタイム
 
-    # ★★★ タイム計測用の変数を追加 ★★★
-    play_time_seconds = 0.0
-
-    # ★★★ アニメーション関連の変数を復活 ★★★
-    animation_timer = 0.0  # アニメーションの進捗 (0.0 -> 1.0)
-    ANIMATION_DURATION_SECONDS = 0.5  # アニメーションの所要時間 (秒)
-    target_gravity = "DOWN"
-    current_angle = 0.0
-    target_angle = 0.0
-    # ★★★ ここまで ★★★
-
-    # --- ゲーム起動時のレベル初期化を関数化 ---
-    def initialize_game():
-        nonlocal player, start_pos, all_sprites, platforms, spikes, keys, doors, gravity_switchers, booster_platforms, falling_spikes, patrolling_spikes, arrow_launchers, arrows, gravity_direction, play_time_seconds, current_angle, target_angle, animation_timer, target_gravity
-        
-        # 既存のグループをクリア
-        all_sprites.empty()
-        platforms.empty()
-        spikes.empty()
-        keys.empty()
-        doors.empty()
-        gravity_switchers.empty()
-        booster_platforms.empty()
-        falling_spikes.empty()
-        patrolling_spikes.empty()
-        arrow_launchers.empty()
-        arrows.empty() # 矢のグループもクリア
-        
-        # setup_levelを呼び出す
-        (
-            player,
-            start_pos,
-            all_sprites,
-            platforms,
-            spikes,
-            keys,
-            doors,
-            gravity_switchers,
-            booster_platforms,
-            falling_spikes,
-            patrolling_spikes,
-            arrow_launchers,
-        ) = setup_level(LEVEL_MAP)
+    # ★★★ 固定タイムステップ用の変数 ★★★
+    accumulator = 0.0  # まだシミュレーションしていない実時間 (秒)
+    jump_requested = False  # 次のティックで適用するジャンプ入力
+    cut_requested = False
+    prev_camera = None  # 描画補間用: 直前のティック開始時のカメラ位置
+    prev_positions = {}  # 描画補間用: 直前のティック開始時のスプライト位置
+
+    # ★★★ リプレイ用の変数 ★★★
+    recorder = None  # プレイ中の入力を記録する ReplayRecorder
+    replay_controls = None  # 再生中のリプレイの入力 (ティックごとの InputState)
+
+    # --- ゲーム開始 / リトライ (初回のみステージを構築し、以降は状態だけ戻す) ---
+    def start_game():
+        nonlocal sim, static_layer, accumulator, jump_requested, cut_requested, prev_camera, prev_positions
+        nonlocal recorder, replay_controls
+
+        # 再生中のリプレイがあれば、記録時と同じシードで始める
+        seed = replay.seed if replay else None
+
+        if sim is None:
+            try:
+                if replay:
+                    sim = replay.create_sim(level_map)
+                else:
+                    sim = GameSim(level_map)
+            except ValueError as e:
+                print(f"エラー: {e}")
+                sys.exit()
 
-        # プレイヤーが正常に作成されたか確認
-        if player is None:
-            print("エラー: プレイヤー(@)がマップにいません！")
-            sys.exit()
-
-        player.reset_position(*start_pos)
-        gravity_direction = "DOWN"
-        play_time_seconds = 0.0
-        current_angle = 0.0
-        target_angle = 0.0
-        animation_timer = 0.0
-        target_gravity = "DOWN"
-        
-        # 初期化された全スプライトをall_spritesに追加
-        all_sprites.add(player)
-        all_sprites.add(platforms, spikes, keys, doors, gravity_switchers, booster_platforms, falling_spikes, patrolling_spikes, arrow_launchers)
-        
-        return arrows # arrowsグループを返す (今回は空のはずだが、互換性のため)
+            # ★★★ 動かないタイルを静的レイヤーに焼き込み、残りだけを毎フレーム描く ★★★
+            if USE_STATIC_LAYER:
+                static_sprites = [s for s in sim.all_sprites if StaticLayer.is_static(s)]
+                if USE_LEVEL_STREAMING:
+                    # カメラの近くのチャンクだけを作る (遠くのチャンクは捨てる)
+                    static_layer = LevelStreamer(sim.tile_map, static_sprites)
+                else:
+                    static_layer = StaticLayer(
+                        static_sprites, sim.level_width, sim.level_height, sim.tile_map
+                    )
+        else:
+            sim.reset(seed)
+
+        # リプレイ再生中は記録せず、記録された入力を流す
+        if recorder is not None:
+            recorder.close()
+            recorder = None
+        if replay:
+            replay_controls = replay.controls()
+        else:
+            replay_controls = None
+            recorder = ReplayRecorder(LAST_RUN_REPLAY_FILE, sim.seed, sim.level_map)
+
+        accumulator = 0.0
+        jump_requested = False
+        cut_requested = False
+        prev_camera = None
+        prev_positions = {}
+        return sim.state
     
-    # --- ★ 星空の背景を生成 ★ ---
-    stars = []
-    for _ in range(NUM_STARS):
-        # 星をレベル全体の範囲、あるいはそれより少し広めに配置する
-        # (Parallaxで端が見えないように、-GAME_WIDTH/2 から level_width + GAME_WIDTH/2 まで)
-        x = random.randint(-GAME_WIDTH // 2, level_width + GAME_WIDTH // 2)
-        y = random.randint(-GAME_HEIGHT // 2, level_height + GAME_HEIGHT // 2)
-        radius = random.randint(1, 2)
-        color = random.choice(STAR_COLORS)
-        stars.append((x, y, radius, color))
-    # --- ★ ここまで ★ ---
+    # --- ★ 星空の背景を生成 (タイル画像に一度だけ描いておく) ★ ---
+    star_field = StarField(level_width, level_height)
+
+    # ★★★ メニュー画面の部分更新 ★★★
+    menu_screen = MenuScreen(screen)
+    menu_idle = False  # 前のフレームでメニュー画面が何も変わらなかった (次はイベントを待つ)
 
+    # リプレイ再生時はタイトル画面を飛ばしてすぐに始める
+    if replay:
+        game_state = start_game()
 
     while True:
+        PROFILER.begin_frame()
+
         # --- 共通のタイマー処理 ---
-        delta_time_seconds = clock.get_time() / 1000.0 # 前のフレームからの経過時間 (秒)
+        # 前のフレームからの経過時間 (秒)。止まっていた場合に大量のティックを
+        # まとめて進めないよう、上限を設ける
+        frame_seconds = min(clock.get_time() / 1000.0, MAX_FRAME_SECONDS)
 
         # --- イベント処理 (共通) ---
-        events = pygame.event.get()
+        if menu_idle:
+            # ★ メニュー画面が前のフレームから変わっていないので、イベントが来るまで眠る
+            events = [pygame.event.wait()]
+            events.extend(pygame.event.get())
+            # 眠っていた時間はゲームの時間に数えない。時計も起きた時点から測り直すので、
+            # 次のフレームの clock.get_time() にも眠っていた時間は入らない
+            clock.tick()
+            frame_seconds = 0.0
+        else:
+            events = pygame.event.get()
         for event in events:
             if event.type == pygame.QUIT:
+                if recorder is not None:
+                    recorder.close()  # 記録途中の入力を書き出す
+                PROFILER.close()
+                if static_layer is not None:
+                    static_layer.close()  # (先読みのスレッドを止める)
                 pygame.quit()
                 sys.exit()
 
+            # ウィンドウが隠れていた部分は、部分更新では描き直されないので全体を描く
+            if event.type == pygame.WINDOWEXPOSED or event.type == pygame.VIDEOEXPOSE:
+                menu_screen.invalidate()
+
+            # ★★★ デバッグ用: F3 でプロファイラ表示、F4 で CSV 記録 (全ステート共通) ★★★
+            if event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_F3:
+                    PROFILER.toggle_overlay()
+                elif event.key == pygame.K_F4:
+                    if PROFILER.toggle_csv():
+                        print(f"プロファイルを {PROFILE_CSV_FILE} に記録します。")
+                    else:
+                        print("プロファイルの記録を終了しました。")
+
             # ★★★ TITLE_SCREEN ステートの入力処理 ★★★
             if game_state == "TITLE_SCREEN":
                 if event.type == pygame.KEYDOWN:
@@ -1635,8 +4025,7 @@ def main():
                     elif event.key == pygame.K_RETURN or event.key == pygame.K_KP_ENTER:
                         if title_menu_selection == 0:
                             # START GAME を選択
-                            arrows = initialize_game() # ゲームを初期化
-                            game_state = "PLAYING"
+                            game_state = start_game() # ゲームを初期化 (初回のみステージを構築)
                         else:
                             # BEST TIME を選択
                             best_time_display = load_best_time() # 最新のタイムをロード
@@ -1649,14 +4038,14 @@ def main():
                         game_state = "TITLE_SCREEN"
 
             # ▼▼▼ PLAYING 中のみ反応するキー入力 ▼▼▼
-            elif game_state == "PLAYING":
+            elif game_state == "PLAYING" and replay_controls is None:
                 if event.type == pygame.KEYDOWN:
                     if (
                         event.key == pygame.K_SPACE
                         or event.key == pygame.K_UP
                         or event.key == pygame.K_w
                     ):
-                        player.jump(gravity_direction)
+                        jump_requested = True  # 次のティックで適用
 
                 if event.type == pygame.KEYUP:
                     if (
@@ -1664,184 +4053,75 @@ def main():
                         or event.key == pygame.K_UP
                         or event.key == pygame.K_w
                     ):
-                        player.cut_jump(
-                            gravity_direction
-                        )
+                        cut_requested = True  # 次のティックで適用
             # ▲▲▲ PLAYING 中のキー入力ここまで ▲▲▲
 
-        # --- 更新処理 ---
-        if game_state == "PLAYING":
-
-            # ★★★ プレイ時間を加算 ★★★
-            play_time_seconds += delta_time_seconds
-
-            # 弓矢の発射
-            for launcher in arrow_launchers:
-                new_arrow = launcher.update()
-                if new_arrow:
-                    all_sprites.add(new_arrow)
-                    arrows.add(new_arrow)
+        PROFILER.mark("events")
 
-            arrows.update()
-
-            pygame.sprite.groupcollide(arrows, platforms, True, False)  # 矢と壁の衝突
-
-            # ★★★ FallingSpike の起動ロジック (4方向対応) ★★★
-            for fs in falling_spikes:
-
-                if fs.orientation == "DOWN":
-                    # プレイヤーが「下」にいる
-                    if (
-                        not fs.is_active
-                        and abs(player.rect.centerx - fs.rect.centerx) < 50  # X軸が近い
-                        and player.rect.top > fs.rect.bottom  # Y軸が下
-                        and (player.rect.top - fs.rect.bottom) < 200
-                    ):  # 200px以内
-                        fs.activate()
-
-                elif fs.orientation == "UP":
-                    # プレイヤーが「上」にいる
-                    if (
-                        not fs.is_active
-                        and abs(player.rect.centerx - fs.rect.centerx) < 50  # X軸が近い
-                        and player.rect.bottom < fs.rect.top  # Y軸が上
-                        and (fs.rect.top - player.rect.bottom) < 200
-                    ):  # 200px以内
-                        fs.activate()
-
-                elif fs.orientation == "LEFT":
-                    # プレイヤーが「左」にいる
-                    if (
-                        not fs.is_active
-                        and abs(player.rect.centery - fs.rect.centery) < 50  # Y軸が近い
-                        and player.rect.right < fs.rect.left  # X軸が左
-                        and (fs.rect.left - player.rect.right) < 200
-                    ):  # 200px以内
-                        fs.activate()
-
-                elif fs.orientation == "RIGHT":
-                    # プレイヤーが「右」にいる
-                    if (
-                        not fs.is_active
-                        and abs(player.rect.centery - fs.rect.centery) < 50  # Y軸が近い
-                        and player.rect.left > fs.rect.right  # X軸が右
-                        and (player.rect.left - fs.rect.right) < 200
-                    ):  # 200px以内
-                        fs.activate()
-
-            # ★★★ 足場 (platforms) の update を呼び出す ★★★
-            platforms.update(
-                gravity_direction
-            )  # (booster_platforms も platforms に含まれる)
-
-            # 各グループの更新
-            falling_spikes.update(platforms, gravity_direction)
-            patrolling_spikes.update(platforms, gravity_direction)
-
-            player.update(platforms, gravity_direction)
-
-            # 落下ミス判定 (★ GAME_OVER に変更)
-            if (
-                player.rect.top > level_height
-                or player.rect.bottom < 0
-                or (
-                    level_width > 0
-                    and (player.rect.left > level_width or player.rect.right < 0)
+        # --- 更新処理 (固定タイムステップ) ---
+        # 経過した実時間を貯めておき、SIM_DT ごとに1ティックずつ進める
+        # (描画のフレームレートが変わってもゲームの進み方は変わらない)
+        if game_state == "PLAYING" or game_state == "ANIMATING":
+            accumulator += frame_seconds * sim_speed
+        else:
+            accumulator = 0.0
+
+        while accumulator >= SIM_DT and sim is not None and sim.is_running:
+            accumulator -= SIM_DT
+
+            # 描画の補間用に、ティック開始時の位置を記録
+            prev_camera = (sim.camera_x, sim.camera_y)
+            prev_positions = sim.render_queue.positions(sim.camera_x, sim.camera_y)
+
+            if replay_controls is not None:
+                # リプレイの入力を流す (最後まで再生したらタイトルへ戻る)
+                controls = next(replay_controls, None)
+                if controls is None:
+                    print("リプレイの再生が終わりました。")
+                    replay = replay_controls = None
+                    game_state = "TITLE_SCREEN"
+                    break
+            else:
+                # キーボードの状態を 1ティック分の入力レコードにまとめて渡す
+                controls = InputState.from_keyboard(
+                    pygame.key.get_pressed(), jump_requested, cut_requested
                 )
-            ):
+                jump_requested = False
+                cut_requested = False
+                recorder.record(controls)
 
-                # print("落下ミス！")
-                game_state = "GAME_OVER"
+            sim.step(controls)
 
-            # ブースター判定
-            is_on_booster = (
-                any(isinstance(p, BoosterPlatform) for p in player.standing_on)
-                if player.on_ground
-                else False
-            )
-            player.speed_multiplier = 2.0 if is_on_booster else 1.0
-            player.jump_multiplier = (
-                2.0 if is_on_booster else 1.0
-            )  # ブーストジャンプ調整
-
-            # ★★★ 重力スイッチ判定 (アニメーションへ移行) ★★★
-            collided_switcher = pygame.sprite.spritecollideany(
-                player, gravity_switchers
-            )
-            if collided_switcher:
+            if not sim.is_running and recorder is not None:
+                recorder.close()
 
-                # 現在の重力に基づいて、目標の重力と角度を設定
-                if gravity_direction == "DOWN":
-                    target_gravity = "UP"
-                    target_angle = 180.0
+            if sim.state == "GAME_CLEAR":
+                final_clear_time = sim.clear_time  # タイムを確定
+                if replay_controls is not None:
+                    # リプレイの検証: 記録は更新しない
+                    print(f"リプレイのクリアタイム: {final_clear_time:.2f} s")
                 else:
-                    target_gravity = "DOWN"
-                    target_angle = 0.0
-
-                game_state = "ANIMATING"  # ステートをアニメーションに変更
-                animation_timer = 0.0  # アニメーションタイマーをリセット
-                # print(f"アニメーション開始！ ターゲット: {target_gravity}")
-                collided_switcher.kill()
-
-            # カメラの更新 (プレイヤー中央)
-            target_camera_x = player.rect.centerx - GAME_WIDTH // 2
-            target_camera_y = player.rect.centery - GAME_HEIGHT // 2
-
-            # カメラの範囲をレベルの範囲に制限
-            if level_width > GAME_WIDTH:
-                camera_x = max(0, min(target_camera_x, level_width - GAME_WIDTH))
-            else:
-                camera_x = (level_width - GAME_WIDTH) // 2
-
-            if level_height > GAME_HEIGHT:
-                camera_y = max(0, min(target_camera_y, level_height - GAME_HEIGHT))
-            else:
-                camera_y = (level_height - GAME_HEIGHT) // 2
-
-            # 弓矢との衝突 (Mask判定) (★ GAME_OVER に変更)
-            if pygame.sprite.spritecollide(
-                player, arrows, True, pygame.sprite.collide_mask
-            ):
-                # print("矢に当たった！")
-                game_state = "GAME_OVER"
-
-            # トゲとの衝突 (Mask判定) (★ GAME_OVER に変更)
-            elif pygame.sprite.spritecollide(
-                player, spikes, False, pygame.sprite.collide_mask
-            ):
-                # print("ミス！")
-                game_state = "GAME_OVER"
+                    best_time_display = save_best_time(final_clear_time)  # タイムを保存・更新
+                    if best_time_display == final_clear_time:
+                        # ベストタイムを更新したプレイのリプレイを残す
+                        try:
+                            shutil.copyfile(LAST_RUN_REPLAY_FILE, BEST_RUN_REPLAY_FILE)
+                        except OSError:
+                            pass  # リプレイが残せなくてもゲームは続ける
 
-            # カギ・トビラ判定
-            # ★ カギの衝突判定を collide_mask に変更 ★
-            if pygame.sprite.spritecollide(
-                player, keys, True, pygame.sprite.collide_mask
-            ):
-                player.has_key = True
-                # print("カギを手に入れた！")
-
-            # GAME_CLEAR ステートへ
-            # ★ トビラの衝突判定を collide_mask に変更 ★
-            if (
-                pygame.sprite.spritecollide(
-                    player, doors, False, pygame.sprite.collide_mask
-                )
-                and player.has_key
-            ):
-                # print("クリア！おめでとう！")
-                final_clear_time = play_time_seconds # タイムを確定
-                best_time_display = save_best_time(final_clear_time) # タイムを保存・更新
-                game_state = "GAME_CLEAR"
+        if game_state == "PLAYING" or game_state == "ANIMATING":
+            game_state = sim.state
+            camera_x, camera_y = sim.camera_x, sim.camera_y
+        PROFILER.mark("sim_other")
 
         # ★★★ GAME_OVER ステートの処理 ★★★
-        elif game_state == "GAME_OVER":
+        if game_state == "GAME_OVER":
             # Enterキーが押されるまで待機
             for event in events:  # 共通イベントキューをチェック
                 if event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_RETURN or event.key == pygame.K_KP_ENTER:
                         # print("リスタートします。")
-                        arrows = initialize_game() 
-                        game_state = "PLAYING"
+                        game_state = start_game() # ステージは作り直さずに状態だけ戻す
                         break
         # ★★★ GAME_OVER 処理ここまで ★★★
 
@@ -1853,163 +4133,135 @@ def main():
                     if event.key == pygame.K_RETURN or event.key == pygame.K_KP_ENTER:
                         # print("タイトル画面に戻ります。")
                         game_state = "TITLE_SCREEN"
+                        replay = None  # リプレイ再生は終わり、通常のプレイに戻る
                         break
         # ★★★ GAME_CLEAR 処理ここまで ★★★
 
-        # ★★★ ANIMATING ステートの処理 (復活) ★★★
-        elif game_state == "ANIMATING":
-            # 1. 時間を経過させる (clock.tick() から秒数を計算)
-            # (delta_time_seconds はループ冒頭で計算済み)
 
-            # アニメーション時間が 0 の場合でもゼロ除算にならないように
-            if ANIMATION_DURATION_SECONDS > 0:
-                animation_timer += delta_time_seconds / ANIMATION_DURATION_SECONDS
+        # --- 描画処理 ---
+        menu_idle = False
+        if game_state == "PLAYING" or game_state == "ANIMATING":
+            # ★ 直前のティックと現在のティックの間を、余った時間の割合で補間して描く
+            alpha = accumulator / SIM_DT
+            if prev_camera is not None:
+                view_x = round(prev_camera[0] + (camera_x - prev_camera[0]) * alpha)
+                view_y = round(prev_camera[1] + (camera_y - prev_camera[1]) * alpha)
             else:
-                animation_timer = 1.0  # 即座に終了
+                view_x, view_y = camera_x, camera_y
+
+            screen.fill(GAME_BACKGROUND_COLOR)
+            game_surface.fill(GAME_BACKGROUND_COLOR) # ゲームサーフェスも塗りつぶす
+            PROFILER.mark("clear")
 
-            # 2. 現在の角度を計算 (線形補間)
-            current_angle_start = 180.0 if gravity_direction == "UP" else 0.0
-            current_angle = (
-                current_angle_start
-                + (target_angle - current_angle_start) * animation_timer
+            # --- ★ 星空の描画 (Parallax効果) ★ ---
+            star_field.draw(game_surface, view_x, view_y)
+            PROFILER.mark("stars")
+
+            # ゲームワールドの描画 (静的レイヤー + 動くスプライト)
+            draw_world(game_surface, sim, static_layer, view_x, view_y, prev_positions, alpha)
+
+            # 拡大・回転して画面に表示
+            presenter.present(screen, game_surface, sim.current_angle)
+            PROFILER.mark("present")
+            
+            # ★★★ プレイ中のタイム表示 (右上) ★★★
+            time_text = f"Time: {sim.play_time_seconds:.2f} s"
+            if time_text != timer_text:  # 表示が変わったときだけ描き直す
+                timer_text = time_text
+                timer_surface = font_time.render(time_text, True, WHITE)
+            text_time = timer_surface
+            text_time_rect = text_time.get_rect(
+                topright=(SCREEN_WIDTH - 10, 10) # 右端から10px、上端から10px
             )
+            screen.blit(text_time, text_time_rect)
+            menu_screen.invalidate()  # (メニューに戻ったら画面全体を描き直す)
+            partial_update = False
 
-            # 3. アニメーションが終了したか？
-            if animation_timer >= 1.0:
-                current_angle = target_angle  # 角度をターゲットに固定
-                gravity_direction = target_gravity  # 重力を本適用
-                game_state = "PLAYING"  # ステートを戻す
-                # print(f"アニメーション終了。 重力: {gravity_direction}")
+        else:
+            # ★★★ メニュー画面: 文字の画像と位置を並べ、変わった部分だけを描き直す ★★★
+            # (星空やゲーム画面は映らないので描かない)
+            overlay = dark_overlay  # 暗転レイヤー (タイトル画面以外)
+            menu_items = []
 
-            # ★ アニメーション中もカメラはプレイヤーを追従する
-            if player: # playerが存在する場合のみ
-                target_camera_x = player.rect.centerx - GAME_WIDTH // 2
-                target_camera_y = player.rect.centery - GAME_HEIGHT // 2
+            # ★★★ TITLE_SCREEN の描画 (新規追加) ★★★
+            if game_state == "TITLE_SCREEN":
+                overlay = None
+                menu_items.append((text_title_name, text_title_name_rect))
 
-                if level_width > GAME_WIDTH:
-                    camera_x = max(0, min(target_camera_x, level_width - GAME_WIDTH))
-                else:
-                    camera_x = (level_width - GAME_WIDTH) // 2
+                # START GAME
+                color_start = WHITE if title_menu_selection == 0 else (100, 100, 100)
+                text_start_game_render = TEXT_CACHE.render(font, "START GAME", color_start)
+                menu_items.append((text_start_game_render, text_start_game_rect))
+
+                # BEST TIME
+                color_best = WHITE if title_menu_selection == 1 else (100, 100, 100)
+                text_best_time_menu_render = TEXT_CACHE.render(font, "BEST TIME", color_best)
+                menu_items.append((text_best_time_menu_render, text_best_time_menu_rect))
 
-                if level_height > GAME_HEIGHT:
-                    camera_y = max(0, min(target_camera_y, level_height - GAME_HEIGHT))
+            # ★★★ BEST_TIME_SCREEN の描画 (新規追加) ★★★
+            elif game_state == "BEST_TIME_SCREEN":
+                # タイトル
+                text_bt_title = TEXT_CACHE.render(font_title, "BEST TIME", WHITE)
+                text_bt_title_rect = text_bt_title.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 150))
+                menu_items.append((text_bt_title, text_bt_title_rect))
+
+                # 記録の表示
+                if best_time_display is not None:
+                    bt_text = f"{best_time_display:.2f} s"
                 else:
-                    camera_y = (level_height - GAME_HEIGHT) // 2
-        # ★★★ ANIMATING 処理ここまで ★★★
+                    bt_text = "--- NO RECORD ---"
 
-        # --- 描画処理 ---
-        screen.fill(GAME_BACKGROUND_COLOR) # 全てのステートで背景色で塗りつぶし
-        game_surface.fill(GAME_BACKGROUND_COLOR) # ゲームサーフェスも塗りつぶす
-
-        # --- ★ 星空の描画 (Parallax効果) ★ ---
-        for x, y, radius, color in stars:
-            # 星のワールド座標 (x, y) からカメラ座標を引く
-            # Parallaxをかけるため、カメラ座標に係数をかける
-            screen_x = x - (camera_x * PARALLAX_FACTOR)
-            screen_y = y - (camera_y * PARALLAX_FACTOR)
-
-            # 画面外の星は描画しない (簡易的なカリング)
-            if -radius <= screen_x <= GAME_WIDTH + radius and -radius <= screen_y <= GAME_HEIGHT + radius:
-                pygame.draw.circle(
-                    game_surface, color, (int(screen_x), int(screen_y)), radius
-                )
-        # --- ★ ここまで ★ ---
+                text_bt_record = TEXT_CACHE.render(font, bt_text, KEY_COLOR)
+                text_bt_record_rect = text_bt_record.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
+                menu_items.append((text_bt_record, text_bt_record_rect))
 
+                menu_items.append((text_return_to_title, text_return_to_title_rect))
 
-        if game_state == "PLAYING" or game_state == "ANIMATING":
-            
-            # スプライトの描画 (ゲームワールドの描画)
-            for sprite in all_sprites:
-                screen_x = sprite.rect.x - camera_x
-                screen_y = sprite.rect.y - camera_y
-                game_surface.blit(sprite.image, (screen_x, screen_y))
-
-            # 1. game_surface を SCREEN サイズに拡大
-            base_display_surface = pygame.transform.scale(
-                game_surface, (SCREEN_WIDTH, SCREEN_HEIGHT)
-            )
+            # ★★★ GAME_OVER の描画 ★★★
+            elif game_state == "GAME_OVER":
+                menu_items.append((text_game_over, text_game_over_rect))
+                menu_items.append((text_retry, text_retry_rect))
 
-            # 2. 拡大したゲーム画面を (current_angle) だけ回転させて描画
-            if current_angle == 0:
-                screen.blit(base_display_surface, (0, 0))
-            else:
-                rotated_surface = pygame.transform.rotate(
-                    base_display_surface, current_angle
-                )
-                rotated_rect = rotated_surface.get_rect(
-                    center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2)
-                )
-                screen.blit(rotated_surface, rotated_rect)
-            
-            # ★★★ プレイ中のタイム表示 (右上) ★★★
-            time_text = f"Time: {play_time_seconds:.2f} s"
-            text_time = font_time.render(time_text, True, WHITE)
-            text_time_rect = text_time.get_rect(
-                topright=(SCREEN_WIDTH - 10, 10) # 右端から10px、上端から10px
-            )
-            screen.blit(text_time, text_time_rect)
-            
-        # ★★★ TITLE_SCREEN の描画 (新規追加) ★★★
-        elif game_state == "TITLE_SCREEN":
-            screen.blit(text_title_name, text_title_name_rect)
-
-            # START GAME
-            color_start = WHITE if title_menu_selection == 0 else (100, 100, 100)
-            text_start_game_render = font.render("START GAME", True, color_start)
-            screen.blit(text_start_game_render, text_start_game_rect)
-
-            # BEST TIME
-            color_best = WHITE if title_menu_selection == 1 else (100, 100, 100)
-            text_best_time_menu_render = font.render("BEST TIME", True, color_best)
-            screen.blit(text_best_time_menu_render, text_best_time_menu_rect)
-
-        # ★★★ BEST_TIME_SCREEN の描画 (新規追加) ★★★
-        elif game_state == "BEST_TIME_SCREEN":
-            screen.blit(dark_overlay, (0, 0)) # 暗転レイヤー
-            
-            # タイトル
-            text_bt_title = font_title.render("BEST TIME", True, WHITE)
-            text_bt_title_rect = text_bt_title.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 150))
-            screen.blit(text_bt_title, text_bt_title_rect)
-
-            # 記録の表示
-            if best_time_display is not None:
-                bt_text = f"{best_time_display:.2f} s"
-            else:
-                bt_text = "--- NO RECORD ---"
-            
-            text_bt_record = font.render(bt_text, True, KEY_COLOR)
-            text_bt_record_rect = text_bt_record.get_rect(center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
-            screen.blit(text_bt_record, text_bt_record_rect)
+            # ★★★ GAME_CLEAR の描画 ★★★
+            elif game_state == "GAME_CLEAR":
+                menu_items.append((text_game_clear, text_game_clear_rect))
+                menu_items.append((text_quit, text_quit_rect))
 
-            screen.blit(text_return_to_title, text_return_to_title_rect)
-            
-        # ★★★ GAME_OVER の描画 ★★★
-        elif game_state == "GAME_OVER":
-            screen.blit(dark_overlay, (0, 0))
-            screen.blit(text_game_over, text_game_over_rect)
-            screen.blit(text_retry, text_retry_rect)
-            
-        # ★★★ GAME_CLEAR の描画 ★★★
-        elif game_state == "GAME_CLEAR":
-            screen.blit(dark_overlay, (0, 0))
-            screen.blit(text_game_clear, text_game_clear_rect)
-            screen.blit(text_quit, text_quit_rect)
-            
-            # ★★★ クリア時の最終タイムを表示 (final_clear_timeを使用) ★★★
-            if final_clear_time is not None:
-                final_time_text = f"Time: {final_clear_time:.2f} s"
-            else:
-                final_time_text = "Time: 0.00 s" # 念のため
-            
-            text_final_time = font_time.render(final_time_text, True, WHITE)
-            text_final_time_rect = text_final_time.get_rect(
-                center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 80)
-            )
-            screen.blit(text_final_time, text_final_time_rect)
+                # ★★★ クリア時の最終タイムを表示 (final_clear_timeを使用) ★★★
+                if final_clear_time is not None:
+                    final_time_text = f"Time: {final_clear_time:.2f} s"
+                else:
+                    final_time_text = "Time: 0.00 s" # 念のため
 
-        pygame.display.flip()
+                text_final_time = TEXT_CACHE.render(font_time, final_time_text, WHITE)
+                text_final_time_rect = text_final_time.get_rect(
+                    center=(SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 80)
+                )
+                menu_items.append((text_final_time, text_final_time_rect))
+
+            # プロファイラを重ねるときは、毎フレーム全体を描き直して flip する
+            partial_update = USE_DIRTY_RECT_MENUS and not PROFILER.overlay_visible
+            if not partial_update:
+                menu_screen.invalidate()
+            dirty_rects = menu_screen.draw(GAME_BACKGROUND_COLOR, overlay, menu_items)
+        PROFILER.mark("hud")
+
+        # ★ プロファイラの表示 (F3 で表示しているときのみ)
+        PROFILER.draw(screen, font_debug)
+        PROFILER.mark("overlay")
+
+        if partial_update:
+            # 変わった範囲だけを画面に送る。何も変わっていなければ次はイベントを待つ
+            if dirty_rects:
+                pygame.display.update(dirty_rects)
+            else:
+                menu_idle = True
+        else:
+            pygame.display.flip()
+        PROFILER.mark("flip")
         clock.tick(FPS)
+        PROFILER.mark("idle")
+        PROFILER.end_frame()
 
 
 # -----------------------------------------------------------------
@@ -0,0 +1,259 @@
+"""マトリックスキューブ ステージ検証の一括実行
+
+画面を出さずに、ステージファイル x 入力 (リプレイ / 入力スクリプト) x シード の
+組み合わせを multiprocessing のプロセスプールで全コアに分けてシミュレートし、
+ステージごとに クリアできるか・クリアタイム・ミスの原因別の回数・
+1秒あたりのシミュレーションティック数 を表示する。
+
+    python batch_runner.py                                  # levels/*.txt x replays/*.mxr
+    python batch_runner.py levels/stage1.txt --inputs run.txt replays/best_run.mxr
+    python batch_runner.py --seeds 8 --jobs 4 --json report.json
+
+入力スクリプトは1行に「ティック数 キー」を書いたテキストファイル
+(キーは L / R / J の組み合わせ、何も押さないときは '-'。'#' 以降はコメント)。
+J は押しっぱなしとして扱い、押し始めのティックでジャンプ、離したティックで
+ジャンプを止める。
+
+    60 R      # 1秒右へ走る
+    12 RJ     # 走りながらジャンプ
+    30 -
+"""
+
+import os
+
+# ★ pygame を読み込む前に、ウィンドウを出さないドライバを指定する
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+# ★ Matrix は読み込み時に自分のフォルダへ chdir するので、その前の場所を覚えておく
+LAUNCH_DIR = os.getcwd()
+
+import argparse
+import collections
+import glob
+import json
+import multiprocessing
+import sys
+import time
+
+import Matrix
+
+DEATH_CAUSES = ("Spike", "FallingSpike", "PatrollingSpike", "Arrow", "fall")
+SCRIPT_KEYS = {"L": "left", "R": "right", "J": "jump"}
+
+
+def resolve(path):
+    """コマンドラインで渡されたパスを、起動したフォルダ基準の絶対パスにする"""
+    return os.path.normpath(os.path.join(LAUNCH_DIR, path))
+
+
+def display_name(path):
+    """表示用のパス (起動したフォルダの下なら相対パス)"""
+    relative = os.path.relpath(path, LAUNCH_DIR)
+    return path if relative.startswith("..") else relative
+
+
+# --- 入力 ---
+def parse_input_script(text, name="<script>"):
+    """入力スクリプトを、リプレイと同じ 1ティック 1バイトの入力コードにする"""
+    codes = bytearray()
+    jump_held = False
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        try:
+            ticks_text, keys = line.split()
+            ticks = int(ticks_text)
+        except ValueError:
+            raise ValueError(f"{name}:{line_number}: 「ティック数 キー」の形式ではありません")
+        keys = "" if keys == "-" else keys.upper()
+        if ticks < 0 or any(key not in SCRIPT_KEYS for key in keys):
+            raise ValueError(f"{name}:{line_number}: 不正な入力です ({line})")
+
+        jump = "J" in keys
+        for tick in range(ticks):
+            codes.append(
+                Matrix.encode_input(
+                    Matrix.InputState(
+                        left="L" in keys,
+                        right="R" in keys,
+                        jump_pressed=tick == 0 and jump and not jump_held,
+                        jump_released=tick == 0 and jump_held and not jump,
+                    )
+                )
+            )
+        if ticks:
+            jump_held = jump
+    return bytes(codes)
+
+
+def load_inputs(paths):
+    """入力ファイルを読み込み、(名前, シード or None, チェックサム or None, 入力コード) を返す
+
+    .mxr はリプレイとして読み、記録したときのシードとステージのチェックサムを使う。
+    """
+    inputs = []
+    for path in paths:
+        name = display_name(path)
+        if path.endswith(".mxr"):
+            replay = Matrix.Replay.load(path)
+            inputs.append((name, replay.seed, replay.checksum, replay.inputs))
+        else:
+            with open(path, encoding="utf-8") as f:
+                inputs.append((name, None, None, parse_input_script(f.read(), name)))
+    return inputs
+
+
+# --- ワーカー (プールの各プロセスで動く) ---
+def run_job(job):
+    """1つのステージを1つの入力で最後まで (または入力が尽きるまで) 進める"""
+    level_path, input_name, seed, codes = job
+    level = Matrix.load_level(level_path)  # 親プロセスで作ったキャッシュを mmap で読む
+
+    sim = Matrix.GameSim(level, seed=seed)
+    inputs = Matrix.REPLAY_INPUTS
+    step = sim.step
+    start = time.perf_counter()  # (ステージの構築は含めず、ティックを進める時間だけ測る)
+    for code in codes:
+        if not sim.is_running:
+            break
+        step(inputs[code & 0x0F])
+    elapsed = time.perf_counter() - start
+
+    state = sim.state if not sim.is_running else "UNFINISHED"
+    return {
+        "level": level_path,
+        "input": input_name,
+        "seed": seed,
+        "state": state,
+        "clear_time": sim.clear_time,
+        "death_cause": sim.death_cause if state == "GAME_OVER" else None,
+        "ticks": sim.sim_tick,
+        "seconds": elapsed,
+    }
+
+
+# --- 集計 ---
+def build_jobs(level_paths, inputs, seeds):
+    """ステージ x 入力 x シード の組み合わせを作る
+
+    リプレイは記録したステージ (チェックサムが一致するもの) でだけ、記録時のシードで動かす。
+    """
+    jobs = []
+    for level_path in level_paths:
+        checksum = Matrix.level_checksum(Matrix.load_level(level_path))
+        for name, replay_seed, replay_checksum, codes in inputs:
+            if replay_checksum is not None:
+                if replay_checksum == checksum:
+                    jobs.append((level_path, name, replay_seed, codes))
+            else:
+                for seed in range(seeds):
+                    jobs.append((level_path, name, seed, codes))
+    return jobs
+
+
+def summarize(level_paths, results):
+    """ワーカーの結果をステージごとにまとめる"""
+    report = {}
+    for level_path in level_paths:
+        runs = [r for r in results if r["level"] == level_path]
+        clear_times = [r["clear_time"] for r in runs if r["state"] == "GAME_CLEAR"]
+        deaths = collections.Counter(
+            r["death_cause"] for r in runs if r["state"] == "GAME_OVER"
+        )
+        ticks = sum(r["ticks"] for r in runs)
+        seconds = sum(r["seconds"] for r in runs)
+        report[display_name(level_path)] = {
+            "runs": len(runs),
+            "clearable": bool(clear_times),
+            "clears": len(clear_times),
+            "best_clear_time": min(clear_times) if clear_times else None,
+            "deaths": {cause: deaths[cause] for cause in DEATH_CAUSES},
+            "unfinished": sum(1 for r in runs if r["state"] == "UNFINISHED"),
+            "ticks": ticks,
+            "ticks_per_second": ticks / seconds if seconds > 0 else 0.0,
+            "results": sorted(
+                ({k: v for k, v in r.items() if k != "level"} for r in runs),
+                key=lambda r: (r["input"], r["seed"]),
+            ),
+        }
+    return report
+
+
+def print_report(report):
+    for name, level in report.items():
+        best = level["best_clear_time"]
+        best_text = f"{best:.2f} s" if best is not None else "-"
+        deaths = " / ".join(f"{cause} {level['deaths'][cause]}" for cause in DEATH_CAUSES)
+        print(f"--- {name} ---")
+        print(
+            f"  クリア {level['clears']}/{level['runs']} (ベスト {best_text}), "
+            f"未完了 {level['unfinished']}, {level['ticks_per_second']:.0f} ティック/秒"
+        )
+        print(f"  ミス: {deaths}")
+        if not level["clearable"]:
+            print("  ※ どの入力でもクリアできませんでした")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ステージ検証の一括実行")
+    parser.add_argument(
+        "levels", nargs="*",
+        help=f"ステージのテキストファイル (省略時は {Matrix.LEVEL_DIR}/*.txt)",
+    )
+    parser.add_argument(
+        "--inputs", nargs="+", metavar="FILE",
+        help=f"リプレイ (.mxr) または入力スクリプト (省略時は {Matrix.REPLAY_DIR}/*.mxr)",
+    )
+    parser.add_argument(
+        "--seeds", type=int, default=1, help="入力スクリプトを何通りのシードで動かすか"
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="ワーカープロセスの数"
+    )
+    parser.add_argument("--json", metavar="FILE", help="結果を JSON ファイルにも保存する")
+    args = parser.parse_args(argv)
+
+    if args.levels:
+        level_paths = [resolve(path) for path in args.levels]
+    else:
+        level_paths = sorted(glob.glob(os.path.abspath(os.path.join(Matrix.LEVEL_DIR, "*.txt"))))
+    if args.inputs:
+        input_paths = [resolve(path) for path in args.inputs]
+    else:
+        input_paths = sorted(glob.glob(os.path.abspath(os.path.join(Matrix.REPLAY_DIR, "*.mxr"))))
+    if not level_paths or not input_paths:
+        print("エラー: ステージと入力 (リプレイまたは入力スクリプト) を1つ以上指定してください")
+        sys.exit(1)
+
+    try:
+        inputs = load_inputs(input_paths)
+        # ★ キャッシュを先に作っておき、ワーカーは mmap で読むだけにする
+        jobs = build_jobs(level_paths, inputs, max(1, args.seeds))
+    except (OSError, UnicodeError, ValueError) as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(max(1, args.jobs)) as pool:
+        results = list(pool.imap_unordered(run_job, jobs))
+    wall_time = time.perf_counter() - start
+
+    report = summarize(level_paths, results)
+    print_report(report)
+    total_ticks = sum(r["ticks"] for r in results)
+    print(
+        f"{len(jobs)} 回のプレイ / {total_ticks} ティックを {wall_time:.2f} 秒で実行 "
+        f"({max(1, args.jobs)} プロセス, 全体 {total_ticks / max(wall_time, 1e-9):.0f} ティック/秒)"
+    )
+
+    if args.json:
+        path = resolve(args.json)
+        with open(path, "w") as f:
+            json.dump({"wall_seconds": wall_time, "levels": report}, f, indent=2)
+        print(f"結果を {path} に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""マトリックスキューブ 毎フレーム処理のベンチマーク
+
+画面を出さずに (SDL のダミードライバで) pygame を動かし、main ループの
+重い処理を1つずつ計測する。LEVEL_MAP と、それを 10倍 / 100倍 に並べた
+合成マップで計測し、フレームごとの所要時間のパーセンタイルを JSON に保存する。
+
+    python benchmark.py                       # 1x / 10x / 100x を計測
+    python benchmark.py --scales 1 10 --frames 300 --output bench.json
+"""
+
+import os
+
+# ★ pygame を読み込む前に、ウィンドウを出さないドライバを指定する
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import json
+import math
+import platform
+import random
+import time
+
+import pygame
+
+import Matrix
+
+DEFAULT_SCALES = (1, 10, 100)
+DEFAULT_FRAMES = 600
+DEFAULT_OUTPUT = "benchmark_results.json"
+NUM_BENCH_ARROWS = 50  # 矢と壁の衝突判定で飛ばしておく矢の数
+NUM_DENSE_ARROWS = 2000  # 矢とプレイヤーの衝突判定 (ブロードフェーズ) の計測用
+NUM_DENSE_STARS = 20000  # 星を増やしたときの計測用
+
+
+# --- 合成マップ ---
+def scale_level(level_map, factor):
+    """level_map を縦横に並べて、タイル数がおよそ factor 倍のマップを作る
+
+    スタート地点 '@' は左上の1枚だけに残す。
+    """
+    if factor <= 1:
+        return list(level_map)
+    # できるだけ正方形に近い 横 x 縦 の並べ方を選ぶ (10 -> 5x2, 100 -> 10x10)
+    cols = next(
+        c for c in range(math.ceil(math.sqrt(factor)), factor + 1) if factor % c == 0
+    )
+    rows = factor // cols
+    width = max(len(row) for row in level_map)
+    padded = [row.ljust(width) for row in level_map]
+
+    scaled = []
+    for tile_y in range(rows):
+        for row in padded:
+            line = []
+            for tile_x in range(cols):
+                if tile_x == 0 and tile_y == 0:
+                    line.append(row)
+                else:
+                    line.append(row.replace("@", " "))
+            scaled.append("".join(line))
+    return scaled
+
+
+# --- 計測 ---
+def summarize(samples_ns):
+    """ナノ秒のサンプル列から、ミリ秒単位の統計を作る"""
+    samples = sorted(samples_ns)
+    count = len(samples)
+
+    def percentile(p):
+        index = min(count - 1, max(0, math.ceil(p / 100 * count) - 1))
+        return samples[index] / 1e6
+
+    return {
+        "count": count,
+        "mean_ms": sum(samples) / count / 1e6,
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": samples[-1] / 1e6,
+    }
+
+
+def time_frames(frames, func):
+    """func(frame) を frames 回呼び、1回ごとの所要時間を返す"""
+    samples = []
+    clock = time.perf_counter_ns
+    for frame in range(frames):
+        start = clock()
+        func(frame)
+        samples.append(clock() - start)
+    return samples
+
+
+def scripted_controls(frame):
+    """右へ走りながら定期的にジャンプする入力 (壁キックも起きるように左右を切り替える)"""
+    going_right = (frame // 240) % 2 == 0
+    return Matrix.InputState(
+        left=not going_right,
+        right=going_right,
+        jump_pressed=frame % 45 == 0,
+        jump_released=frame % 45 == 20,
+    )
+
+
+def spread_arrows(sim, count, rng):
+    """マップ中の空きマスに矢を置く (矢と壁の衝突判定の計測用)"""
+    arrows = pygame.sprite.Group()
+    width = sim.level_width - 40
+    height = sim.level_height - 8
+    while len(arrows) < count:
+        x = rng.randrange(0, max(1, width))
+        y = rng.randrange(0, max(1, height))
+        arrow = Matrix.Arrow(x, y, rng.choice((-1, 1)))
+        if not sim.tile_map.collides(arrow.rect):
+            arrows.add(arrow)
+    return arrows
+
+
+def bench_level(level_map, frames, setup_runs):
+    results = {}
+
+    # 1. setup_level (ステージ構築)
+    results["setup_level"] = summarize(
+        time_frames(setup_runs, lambda frame: Matrix.setup_level(level_map))
+    )
+
+    sim = Matrix.GameSim(level_map, seed=0)
+    player = sim.player
+    start_pos = sim.start_pos
+    results["tiles"] = len(sim.tile_map)
+    results["sprites"] = len(sim.all_sprites)
+
+    # 2. Player.update (足場との衝突判定)
+    def player_step(frame):
+        controls = scripted_controls(frame)
+        if controls.jump_pressed:
+            player.jump(sim.gravity_direction, controls)
+        player.update(sim.tile_map, sim.gravity_direction, controls)
+        if not player.rect.colliderect((0, 0, sim.level_width, sim.level_height)):
+            player.reset_position(*start_pos)
+
+    player.reset_position(*start_pos)
+    results["player_update"] = summarize(time_frames(frames, player_step))
+    player.reset_position(*start_pos)
+
+    # 3. 矢と壁の衝突 (タイルマップの配列を座標で引く)
+    arrows = spread_arrows(sim, NUM_BENCH_ARROWS, random.Random(0))
+    results["arrows_vs_tile_map"] = summarize(
+        time_frames(
+            frames,
+            lambda frame: [sim.tile_map.collides(arrow.rect) for arrow in arrows],
+        )
+    )
+
+    # 3b. 大量の矢とプレイヤー (全部にマスク判定 / 配列で候補を絞ってからマスク判定)
+    dense_arrows = spread_arrows(sim, NUM_DENSE_ARROWS, random.Random(1))
+    broadphase_arrows = Matrix.BroadphaseGroup(dense_arrows)
+    probe = pygame.sprite.Sprite()
+    probe.rect = player.rect.copy()
+    probe.mask = player.mask
+
+    def move_probe(frame):
+        probe.rect.topleft = (
+            (frame * 37) % max(1, sim.level_width - 30),
+            (frame * 23) % max(1, sim.level_height - 30),
+        )
+        return probe
+
+    results["arrows_vs_player_spritecollide"] = summarize(
+        time_frames(
+            frames,
+            lambda frame: pygame.sprite.spritecollide(
+                move_probe(frame), dense_arrows, False, pygame.sprite.collide_mask
+            ),
+        )
+    )
+    results["arrows_vs_player_broadphase"] = summarize(
+        time_frames(
+            frames, lambda frame: broadphase_arrows.query_mask(move_probe(frame))
+        )
+    )
+
+    # 4. トゲとのマスク判定
+    results["spike_mask_collision"] = summarize(
+        time_frames(
+            frames,
+            lambda frame: pygame.sprite.spritecollide(
+                player, sim.spikes, False, pygame.sprite.collide_mask
+            ),
+        )
+    )
+
+    # 5〜7. 描画 (星空 / スプライトの blit / 拡大と回転)
+    screen = pygame.display.get_surface()
+    game_surface = pygame.Surface((Matrix.GAME_WIDTH, Matrix.GAME_HEIGHT))
+    presenter = Matrix.PresentStage(screen)
+    star_field = Matrix.StarField(sim.level_width, sim.level_height, rng=random.Random(0))
+    dense_star_field = Matrix.StarField(
+        sim.level_width,
+        sim.level_height,
+        count=NUM_DENSE_STARS,
+        layers=((0.25, 0.6), (Matrix.PARALLAX_FACTOR, 0.4)),
+        rng=random.Random(1),
+    )
+    static_sprites = [s for s in sim.all_sprites if Matrix.StaticLayer.is_static(s)]
+    static_layer = Matrix.StaticLayer(
+        static_sprites, sim.level_width, sim.level_height, sim.tile_map
+    )
+    streamed_layer = Matrix.LevelStreamer(sim.tile_map, static_sprites)
+
+    def camera_at(frame):
+        # カメラをマップ全体に往復させる
+        span_x = max(1, sim.level_width - Matrix.GAME_WIDTH)
+        span_y = max(1, sim.level_height - Matrix.GAME_HEIGHT)
+        return (frame * 7) % span_x, (frame * 3) % span_y
+
+    results["star_field"] = summarize(
+        time_frames(
+            frames, lambda frame: star_field.draw(game_surface, *camera_at(frame))
+        )
+    )
+    results["star_field_dense_2_layers"] = summarize(
+        time_frames(
+            frames, lambda frame: dense_star_field.draw(game_surface, *camera_at(frame))
+        )
+    )
+    results["sprite_blit_all"] = summarize(
+        time_frames(
+            frames,
+            lambda frame: Matrix.draw_world(game_surface, sim, None, *camera_at(frame)),
+        )
+    )
+    results["sprite_blit_static_layer"] = summarize(
+        time_frames(
+            frames,
+            lambda frame: Matrix.draw_world(
+                game_surface, sim, static_layer, *camera_at(frame)
+            ),
+        )
+    )
+    results["sprite_blit_streamed_layer"] = summarize(
+        time_frames(
+            frames,
+            lambda frame: Matrix.draw_world(
+                game_surface, sim, streamed_layer, *camera_at(frame)
+            ),
+        )
+    )
+    streamed_layer.close()
+    results["present_scale"] = summarize(
+        time_frames(frames, lambda frame: presenter.present(screen, game_surface, 0))
+    )
+    results["present_scale_flip"] = summarize(
+        time_frames(frames, lambda frame: presenter.present(screen, game_surface, 180))
+    )
+    results["present_scale_rotate"] = summarize(
+        time_frames(
+            frames,
+            lambda frame: presenter.present(screen, game_surface, (frame * 6) % 360),
+        )
+    )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="毎フレーム処理のベンチマーク")
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=list(DEFAULT_SCALES),
+        help="LEVEL_MAP を何倍に並べたマップで計測するか",
+    )
+    parser.add_argument(
+        "--frames", type=int, default=DEFAULT_FRAMES, help="1項目あたりの計測フレーム数"
+    )
+    parser.add_argument(
+        "--setup-runs", type=int, default=5, help="setup_level の計測回数"
+    )
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="結果の JSON ファイル")
+    args = parser.parse_args(argv)
+
+    pygame.init()
+    pygame.display.set_mode((Matrix.SCREEN_WIDTH, Matrix.SCREEN_HEIGHT))
+    # 足場の模様 (TEXTURE_RANDOM) と発射台のタイマー (random) を毎回同じにする
+    # (星の配置は StarField にシード付きの乱数を渡す)
+    Matrix.TEXTURE_RANDOM.seed(0)
+    random.seed(0)
+
+    report = {
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "frames": args.frames,
+        "levels": {},
+    }
+    for scale in args.scales:
+        level_map = scale_level(Matrix.LEVEL_MAP, scale)
+        print(f"--- {scale}x ({len(level_map[0])} x {len(level_map)} マス) ---")
+        results = bench_level(level_map, args.frames, args.setup_runs)
+        report["levels"][f"{scale}x"] = results
+        for name, stats in results.items():
+            if isinstance(stats, dict):
+                print(
+                    f"{name:34s} p50 {stats['p50_ms']:8.3f} ms"
+                    f"  p99 {stats['p99_ms']:8.3f} ms"
+                )
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"結果を {args.output} に保存しました。")
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()